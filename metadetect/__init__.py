@@ -5,9 +5,12 @@ from .metadetect import (
     do_metadetect,
     Metadetect,
 )
+from .driver import run_many
 from . import detect
 from . import metadetect
 from . import fitting
+from . import moments
+from . import driver
 
 from . import util
 from . import defaults
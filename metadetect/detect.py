@@ -9,6 +9,8 @@ DM stack detection
 """
 from __future__ import print_function
 import logging
+from collections.abc import Sequence
+
 import numpy as np
 import esutil as eu
 
@@ -16,6 +18,8 @@ from ngmix.medsreaders import NGMixMEDS, MultiBandNGMixMEDS
 from meds.util import get_image_info_struct
 
 from . import defaults
+from . import procflags
+from .util import get_obs_stats, count_in_boxes, set_obs_flags
 
 logger = logging.getLogger(__name__)
 
@@ -25,14 +29,29 @@ FWHM_FAC = 2*np.sqrt(2*np.log(2))
 class MEDSInterface(NGMixMEDS):
     """
     Wrap a full image with a MEDS-like interface
+
+    If stamp_cubes is given, the cutouts are read-only views into the stamps
+    of all objects held in it for the given band. The weight cutouts are
+    copied for the weight types other than 'weight' since those zero pixels
+    of the weight cutout in place.
+
+    If shared_psf is True, the PSF observation is made once and the same
+    object is used for all stamps.
     """
-    def __init__(self, obs, seg, cat):
+    def __init__(
+        self, obs, seg, cat, stamp_cubes=None, band=None, shared_psf=False,
+    ):
         self.obs = obs
         self.seg = seg
         self._image_types = (
             'image', 'weight', 'seg', 'bmask', 'noise')
         self._cat = cat
         self._image_info = get_image_info_struct(1, 20)
+        self._stamp_cubes = stamp_cubes
+        self._band = band
+        self._shared_psf = shared_psf
+        self._psf_obs = None
+        self._copy_weight = False
 
     def has_psf(self):
         return True
@@ -43,6 +62,34 @@ class MEDSInterface(NGMixMEDS):
         """
         return self.obs.psf.image.copy()
 
+    def get_psf_obs(self, iobj, icutout):
+        """
+        get an observation of the psf
+
+        If shared_psf is True, this is the same object for all stamps, so any
+        fit results set on it are shared as well.
+        """
+        if not self._shared_psf:
+            return super().get_psf_obs(iobj, icutout)
+
+        if self._psf_obs is None:
+            self._psf_obs = super().get_psf_obs(iobj, icutout)
+        return self._psf_obs
+
+    def get_obs(self, iobj, icutout, weight_type='weight'):
+        """
+        get an ngmix observation for the indicated entry
+
+        See ngmix.medsreaders.NGMixMEDS.get_obs.
+        """
+        self._copy_weight = (
+            self._stamp_cubes is not None and weight_type != 'weight'
+        )
+        try:
+            return super().get_obs(iobj, icutout, weight_type=weight_type)
+        finally:
+            self._copy_weight = False
+
     def get_cutout(self, iobj, icutout, type='image'):
         """
         Get a single cutout for the indicated entry
@@ -67,6 +114,12 @@ class MEDSInterface(NGMixMEDS):
         if type == 'psf':
             return self.get_psf(iobj, icutout)
 
+        if self._stamp_cubes is not None:
+            cutout = self._stamp_cubes.get_cutout(iobj, self._band, type)
+            if type == 'weight' and self._copy_weight:
+                cutout = cutout.copy()
+            return cutout
+
         im = self._get_type_image(type)
         dims = im.shape
 
@@ -151,6 +204,244 @@ class MEDSInterface(NGMixMEDS):
         return obox, box
 
 
+class StampCubes(object):
+    """
+    The stamps of all objects and bands in contiguous arrays.
+
+    For each image type, the stamps of the objects with the same box size are
+    gathered into an array of shape (nobj, nband, box_size, box_size) the
+    first time a stamp of that type is requested. The stamps of objects that
+    are fully in the image are gathered at once and only those that hit the
+    edge of the image are padded with the default values. The arrays are
+    read-only since they are shared by all of the objects and bands, so the
+    stamps must be copied before they are changed.
+
+    parameters
+    ----------
+    mbobs: ngmix.MultiBandObsList
+        The data.
+    seg: array
+        The seg map for the objects.
+    cat: array
+        The catalog of the objects with the box sizes and start rows and
+        columns of the stamps. See MEDSifier.
+    skip: array, optional
+        If not None, a boolean array that is True for the objects whose stamps
+        are not needed. Their stamps are not gathered and requesting them
+        raises a ValueError.
+    """
+    def __init__(self, mbobs, seg, cat, skip=None):
+        self.mbobs = mbobs
+        self.seg = seg
+        self.cat = cat
+
+        box_sizes = cat['box_size']
+        if skip is None:
+            skip = np.zeros(box_sizes.size, dtype=bool)
+
+        self._inds = {}
+        self._slots = np.full(box_sizes.size, -1, dtype=np.int64)
+        for box_size in np.unique(box_sizes[~skip]):
+            inds, = np.where((box_sizes == box_size) & ~skip)
+            self._inds[box_size] = inds
+            self._slots[inds] = np.arange(inds.size)
+
+        self._cubes = {}
+
+    def get_cutout(self, iobj, band, type):
+        """
+        get a view of the stamp of an object in a band
+
+        parameters
+        ----------
+        iobj: int
+            The index of the object.
+        band: int
+            The index of the band.
+        type: string
+            The image type. Allowed values are 'image', 'weight', 'seg', 'bmask'
+            and 'noise'.
+
+        returns
+        -------
+        The stamp as a read-only view into the array of stamps.
+        """
+        if self._slots[iobj] < 0:
+            raise ValueError("the stamps of object %d are skipped" % iobj)
+
+        box_size = self.cat['box_size'][iobj]
+        return self.get_cube(box_size, type)[self._slots[iobj], band]
+
+    def get_cube(self, box_size, type):
+        """
+        get the stamps of the objects with a box size
+
+        parameters
+        ----------
+        box_size: int
+            The box size.
+        type: string
+            The image type. See get_cutout.
+
+        returns
+        -------
+        The stamps as a read-only array of shape (nobj, nband, box_size,
+        box_size) for the objects with this box size in the order of the
+        catalog, without the skipped objects.
+        """
+        if type not in self._cubes:
+            self._cubes[type] = {}
+
+        cubes = self._cubes[type]
+        if box_size not in cubes:
+            cubes[box_size] = self._make_cube(box_size, type)
+
+        return cubes[box_size]
+
+    def _make_cube(self, box_size, type):
+        if type not in defaults.DEFAULT_IMAGE_VALUES:
+            raise ValueError("bad cutout type: '%s'" % type)
+
+        inds = self._inds.get(box_size, np.zeros(0, dtype=np.int64))
+        start_rows = self.cat['orig_start_row'][inds, 0]
+        start_cols = self.cat['orig_start_col'][inds, 0]
+
+        images = [self._get_type_image(band, type) for band in range(len(self.mbobs))]
+        dims = images[0].shape
+
+        cube = np.zeros(
+            (inds.size, len(images), box_size, box_size),
+            dtype=np.result_type(*images),
+        )
+
+        is_inside = (
+            (start_rows >= 0)
+            & (start_rows + box_size <= dims[0])
+            & (start_cols >= 0)
+            & (start_cols + box_size <= dims[1])
+        )
+        inside, = np.where(is_inside)
+        edge, = np.where(~is_inside)
+
+        for band, im in enumerate(images):
+            if inside.size > 0:
+                windows = np.lib.stride_tricks.sliding_window_view(
+                    im, (box_size, box_size),
+                )
+                cube[inside, band] = windows[start_rows[inside], start_cols[inside]]
+
+            for i in edge:
+                stamp = cube[i, band]
+                stamp[:, :] = defaults.DEFAULT_IMAGE_VALUES[type]
+
+                row_start = min(max(start_rows[i], 0), dims[0])
+                row_end = min(max(start_rows[i] + box_size, 0), dims[0])
+                col_start = min(max(start_cols[i], 0), dims[1])
+                col_end = min(max(start_cols[i] + box_size, 0), dims[1])
+                stamp[
+                    row_start - start_rows[i]:row_end - start_rows[i],
+                    col_start - start_cols[i]:col_end - start_cols[i],
+                ] = im[row_start:row_end, col_start:col_end]
+
+        cube.flags.writeable = False
+        return cube
+
+    def _get_type_image(self, band, type):
+        if type == 'seg':
+            return self.seg
+
+        obs = self.mbobs[band][0]
+        if type == 'image':
+            return obs.image
+        elif type == 'weight':
+            return obs.weight
+        elif type == 'bmask':
+            return obs.bmask
+        elif type == 'noise':
+            return obs.noise
+
+
+class LazyMBObsList(Sequence):
+    """
+    A sequence of the ngmix.MultiBandObsList of objects in a MEDS-like
+    interface. Each one is made the first time it is accessed and kept, so
+    the stamps and observations of objects that are never accessed are not
+    made.
+
+    Indexing with an integer gives the MultiBandObsList and slicing gives a
+    list of them, as for the list returned by get_mbobs_list. The method take
+    gives a sequence of a subset of the objects that shares the observations
+    already made.
+
+    parameters
+    ----------
+    mbm: MultiBandNGMixMEDS
+        The MEDS-like interface, see MEDSifier.get_multiband_meds.
+    weight_type: string, optional
+        The weight type for the stamps. Default is 'weight'.
+    stamp_flags: array, optional
+        If not None, the flags of the stamps of all objects in mbm with shape
+        (nobj, nband), see MEDSifier.get_stamp_flags. They are set for the
+        observations with metadetect.util.set_obs_flags, so they must be
+        the same as those of the stamps.
+    bmask_flags: int, optional
+        The bits in the bit mask used for stamp_flags. Default is 0.
+    indices: array, optional
+        The indices of the objects in mbm that are in the sequence. Default is
+        all of them.
+    """
+    def __init__(
+        self, mbm, weight_type='weight', stamp_flags=None, bmask_flags=0,
+        indices=None, _mbobs=None,
+    ):
+        self.mbm = mbm
+        self.weight_type = weight_type
+        self.stamp_flags = stamp_flags
+        self.bmask_flags = bmask_flags
+
+        if indices is None:
+            indices = np.arange(mbm.size)
+        self.indices = np.asarray(indices, dtype=np.int64)
+
+        # the observations made so far by the index of the object in mbm
+        self._mbobs = {} if _mbobs is None else _mbobs
+
+    def __len__(self):
+        return self.indices.size
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._get_mbobs(iobj) for iobj in self.indices[i]]
+
+        return self._get_mbobs(self.indices[i])
+
+    def take(self, inds):
+        """
+        get a sequence of the objects with indices inds into this sequence
+        """
+        return LazyMBObsList(
+            self.mbm,
+            weight_type=self.weight_type,
+            stamp_flags=self.stamp_flags,
+            bmask_flags=self.bmask_flags,
+            indices=self.indices[inds],
+            _mbobs=self._mbobs,
+        )
+
+    def _get_mbobs(self, iobj):
+        iobj = int(iobj)
+        if iobj not in self._mbobs:
+            mbobs = self.mbm.get_mbobs(iobj, weight_type=self.weight_type)
+            if self.stamp_flags is not None:
+                for obslist, flags in zip(mbobs, self.stamp_flags[iobj]):
+                    set_obs_flags(
+                        obslist[0], bmask_flags=self.bmask_flags, flags=flags,
+                    )
+            self._mbobs[iobj] = mbobs
+
+        return self._mbobs[iobj]
+
+
 class MEDSifier(object):
     """
     very simple MEDS maker for images. Assumes the images are perfectly
@@ -185,19 +476,87 @@ class MEDSifier(object):
         self._set_detim()
         self._run_sep()
 
-    def get_multiband_meds(self):
+    def get_multiband_meds(self, stamp_cubes=False, shared_psf=False, skip=None):
         """
         get a MultiBandMEDS object holding all bands
+
+        If stamp_cubes is True, the stamps of each image type are extracted
+        for all objects and bands at once into a StampCubes the first time
+        they are needed and the cutouts are views into it. The stamps of the
+        objects with skip set to True are not extracted, see StampCubes.
+
+        If shared_psf is True, the stamps in each band all reference a single
+        PSF observation.
         """
 
+        if stamp_cubes:
+            cubes = StampCubes(
+                mbobs=self.mbobs, seg=self.seg, cat=self.cat, skip=skip,
+            )
+        else:
+            cubes = None
+
         mlist = []
         for band in range(self.nband):
-            m = self.get_meds(band)
+            m = self.get_meds(band, stamp_cubes=cubes, shared_psf=shared_psf)
             mlist.append(m)
 
         return MultiBandNGMixMEDS(mlist)
 
-    def get_meds(self, band):
+    def get_stamp_flags(self, bmask_flags):
+        """
+        get the flags of the stamps of all objects and bands
+
+        The flags are computed from the full images with summed-area tables,
+        so no stamps are cut. They are the same as those of the stamps with
+        weight type 'weight', see metadetect.util.get_obs_flags.
+
+        parameters
+        ----------
+        bmask_flags: int
+            The bits in the bit mask that flag a stamp.
+
+        returns
+        -------
+        flags: array
+            An array of shape (nobj, nband). The flags are procflags.ZERO_WEIGHTS
+            if no pixel in the stamp has a positive weight, ORed with
+            procflags.EDGE_HIT if any pixel has one of bmask_flags set.
+        """
+        start_rows = self.cat['orig_start_row'][:, 0]
+        start_cols = self.cat['orig_start_col'][:, 0]
+        box_sizes = self.cat['box_size']
+
+        # the pixels of the stamps off of the image are set to the defaults
+        if (defaults.DEFAULT_IMAGE_VALUES['bmask'] & bmask_flags) != 0:
+            dims = self.mbobs[0][0].image.shape
+            nrow = (
+                np.clip(start_rows + box_sizes, 0, dims[0])
+                - np.clip(start_rows, 0, dims[0])
+            )
+            ncol = (
+                np.clip(start_cols + box_sizes, 0, dims[1])
+                - np.clip(start_cols, 0, dims[1])
+            )
+            is_clipped = nrow * ncol < box_sizes**2
+        else:
+            is_clipped = np.zeros(box_sizes.size, dtype=bool)
+
+        flags = np.zeros((box_sizes.size, self.nband), dtype=np.int32)
+        for band, obslist in enumerate(self.mbobs):
+            obs = obslist[0]
+
+            nwgt = count_in_boxes(obs.weight > 0, start_rows, start_cols, box_sizes)
+            flags[nwgt == 0, band] |= procflags.ZERO_WEIGHTS
+
+            nbad = count_in_boxes(
+                (obs.bmask & bmask_flags) != 0, start_rows, start_cols, box_sizes,
+            )
+            flags[(nbad > 0) | is_clipped, band] |= procflags.EDGE_HIT
+
+        return flags
+
+    def get_meds(self, band, stamp_cubes=None, shared_psf=False):
         """
         get fake MEDS interface to the specified band
         """
@@ -207,15 +566,15 @@ class MEDSifier(object):
             obs=obs,
             seg=self.seg,
             cat=self.cat,
+            stamp_cubes=stamp_cubes,
+            band=band,
+            shared_psf=shared_psf,
         )
 
     def _get_image_vars(self):
         vars = []
         for obslist in self.mbobs:
-            obs = obslist[0]
-            weight = obs.weight
-            w = np.where(weight > 0)
-            medw = np.median(weight[w])
+            medw = get_obs_stats(obslist[0])["median_weight"]
             vars.append(1/medw)
         return np.array(vars)
 
@@ -0,0 +1,145 @@
+"""
+Code to run metadetect over many slices with a pool of warm worker processes.
+"""
+import copy
+import logging
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+from .metadetect import do_metadetect
+
+logger = logging.getLogger(__name__)
+
+
+def run_many(
+    config, mbobs_iter, seeds, n_workers=1, max_in_flight=None,
+    shear_band_combs=None, det_band_combs=None,
+):
+    """Run metadetect on many multi-band observations.
+
+    The work is done by a pool of persistent worker processes. Each worker
+    imports the dependencies and compiles the numba code once when it
+    starts, so the per-slice startup cost is only paid once per worker. At most
+    `max_in_flight` slices are sent to the workers at any time so that the
+    input iterator is consumed lazily and memory use stays flat.
+
+    Parameters
+    ----------
+    config: dict
+        Configuration dictionary. See `do_metadetect` for the details.
+    mbobs_iter: iterable of ngmix.MultiBandObsList
+        The observations for each slice. This iterable is consumed lazily.
+    seeds: iterable of int
+        The seed for the random number generator for each slice.
+    n_workers: int, optional
+        The number of worker processes. If one or less, the slices are run
+        serially in this process. Default is 1.
+    max_in_flight: int, optional
+        The maximum number of slices sent to the workers at once. Default of
+        None uses twice the number of workers.
+    shear_band_combs: list of list of int, optional
+        See `do_metadetect` for the details.
+    det_band_combs: list of list of int or str, optional
+        See `do_metadetect` for the details.
+
+    Yields
+    ------
+    slice_id: int
+        The index of the slice in `mbobs_iter`.
+    res: dict or None
+        The metadetect result for the slice. See `do_metadetect`.
+    """
+    kwargs = {
+        "shear_band_combs": shear_band_combs,
+        "det_band_combs": det_band_combs,
+    }
+
+    if n_workers is None or n_workers <= 1:
+        for slice_id, (mbobs, seed) in enumerate(zip(mbobs_iter, seeds)):
+            yield slice_id, _run_slice(config, mbobs, seed, kwargs)
+        return
+
+    if max_in_flight is None:
+        max_in_flight = 2 * n_workers
+    max_in_flight = max(max_in_flight, 1)
+
+    in_flight = {}
+    with ProcessPoolExecutor(
+        max_workers=n_workers, initializer=_init_worker,
+    ) as executor:
+        try:
+            for slice_id, (mbobs, seed) in enumerate(zip(mbobs_iter, seeds)):
+                while len(in_flight) >= max_in_flight:
+                    yield from _yield_done(in_flight)
+
+                fut = executor.submit(_run_slice, config, mbobs, seed, kwargs)
+                in_flight[fut] = slice_id
+
+            while len(in_flight) > 0:
+                yield from _yield_done(in_flight)
+        finally:
+            # if the caller stops early, do not run the remaining slices
+            for fut in in_flight:
+                fut.cancel()
+
+
+def _yield_done(in_flight):
+    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+    for fut in done:
+        slice_id = in_flight.pop(fut)
+        yield slice_id, fut.result()
+
+
+def _run_slice(config, mbobs, seed, kwargs):
+    # metadetect can modify the config so we always make a copy
+    return do_metadetect(
+        copy.deepcopy(config),
+        mbobs,
+        np.random.RandomState(seed=seed),
+        **kwargs,
+    )
+
+
+def _init_worker():
+    """
+    import the dependencies and compile the numba code in a worker process
+    """
+    import galsim  # noqa
+    import sxdes  # noqa
+    import ngmix
+
+    from . import masking
+    from . import moments
+    from .interpolate import _get_nearby_good_pixels
+
+    dims = (16, 16)
+    xm = np.array([8.0])
+    ym = np.array([8.0])
+    rm = np.array([2.0])
+    masking.make_foreground_bmask(
+        xm=xm, ym=ym, rm=rm, dims=dims, symmetrize=False, mask_bit_val=1,
+    )
+    masking.make_foreground_apodization_mask(
+        xm=xm, ym=ym, rm=rm, dims=dims, symmetrize=False, ap_rad=1.0,
+    )
+    masking._build_square_apodization_mask(1.0, np.ones(dims))
+
+    bad_msk = np.zeros(dims, dtype=bool)
+    bad_msk[8, 8] = True
+    _get_nearby_good_pixels(bad_msk, 1, 4, 1)
+
+    # this compiles the numba code in ngmix and here used for the moments
+    cen = (dims[0] - 1) / 2
+    obs = ngmix.Observation(
+        image=np.ones(dims),
+        weight=np.ones(dims),
+        jacobian=ngmix.DiagonalJacobian(scale=0.2, row=cen, col=cen),
+    )
+    ngmix.gaussmom.GaussMom(fwhm=1.2).go(obs)
+    moments.measure_moments_batch(
+        fitter=ngmix.gaussmom.GaussMom(fwhm=1.2), obs_list=[obs],
+    )
+    moments.measure_admom_batch(obs_list=[obs], T_guess=[0.5])
+
+    logger.debug("worker initialized")
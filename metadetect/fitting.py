@@ -1,7 +1,11 @@
 import logging
 import copy
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import hashlib
 
 import numpy as np
+from numba import njit
 
 import ngmix
 import ngmix.prepsfmom
@@ -15,11 +19,19 @@ from ngmix.runners import Runner, PSFRunner
 from ngmix.guessers import SimplePSFGuesser
 from ngmix.fitting import Fitter
 
-from .util import Namer
+from .util import (
+    Namer, get_obs_cache, get_obs_flags, get_obs_stats, obs_cache_scope,
+    writeable,
+)
 from . import procflags
+from .moments import measure_admom_batch, measure_moments_batch_multi
+from .detect import CatalogMEDSifier
 
 MAX_NUM_SHEAR_BANDS = 6
 
+# the default number of objects fit together by a worker, see fit_mbobs_list_joint
+JOINT_FIT_CHUNK_SIZE = 16
+
 logger = logging.getLogger(__name__)
 
 if parse_version(ngmix.__version__) < parse_version("2.1.0"):
@@ -37,6 +49,11 @@ def fit_mbobs_gauss(
     obj_runner=None,
     psf_runner=None,
     coadd=False,
+    psf_fit_cache=None,
+    out=None,
+    coadd_obs=None,
+    guess=None,
+    fit_stats=None,
 ):
     """Fit a multiband obs using a Gaussian fit.
 
@@ -59,6 +76,26 @@ def fit_mbobs_gauss(
         `get_gauss_psf_runner` is called.
     coadd : bool, optional
         If True, coadd the mbobs over all bands and then fit. Default is False.
+    psf_fit_cache : dict, optional
+        If not None, the PSF fits are stored in and reused from this dictionary
+        for PSF observations with identical images, weights and Jacobians.
+        Default is None.
+    out : np.ndarray, optional
+        A length one structured array to write the results into, for example a
+        slice of the output of `get_wavg_output_buffer`. It must be set to the
+        default values. Default of None allocates a new array.
+    coadd_obs : ngmix.Observation, optional
+        If given and `coadd` is True, this coadd of the shear bands is fit
+        instead of the one made with `make_coadd_obs`. See
+        `make_coadd_obs_list`. Default is None.
+    guess : np.void, optional
+        If not None, an element of the output of `get_fit_guesses`. Its T and g
+        are used for the first try of the object fit if T is finite. Default is
+        None.
+    fit_stats : dict, optional
+        If not None, the number of fits, warm started fits, tries and function
+        evaluations are added to the entries "nfit", "nwarm", "ntry" and "niter".
+        Default is None.
 
     Returns
     -------
@@ -68,7 +105,7 @@ def fit_mbobs_gauss(
     if shear_bands is None:
         shear_bands = list(range(len(mbobs)))
 
-    res = get_wavg_output_struct(len(mbobs), "gauss", shear_bands=shear_bands)
+    res = _get_wavg_output_row(out, len(mbobs), "gauss", shear_bands)
 
     flags = 0
     for obslist in mbobs:
@@ -81,17 +118,13 @@ def fit_mbobs_gauss(
             continue
 
         for obs in obslist:
-            if not np.any(obs.weight > 0):
-                flags |= procflags.ZERO_WEIGHTS
-
-            if np.any((obs.bmask & bmask_flags) != 0):
-                flags |= procflags.EDGE_HIT
+            flags |= get_obs_flags(obs, bmask_flags=bmask_flags)
 
     if any(s >= len(mbobs) for s in shear_bands):
         flags |= procflags.INCONSISTENT_BANDS
 
     if coadd:
-        if flags == 0:
+        if flags == 0 and coadd_obs is None:
             # first we coadd the shear bands
             coadd_obs, coadd_flags = make_coadd_obs(mbobs, shear_bands=shear_bands)
             flags |= coadd_flags
@@ -105,20 +138,26 @@ def fit_mbobs_gauss(
                 shear_mbobs.append(mbobs[band])
 
     if flags == 0:
+        if psf_runner is None:
+            psf_runner = get_gauss_psf_runner(rng)
+        if psf_fit_cache is not None:
+            psf_runner = _CachedPSFRunner(
+                psf_runner, psf_fit_cache.setdefault("gauss", {}),
+            )
+
+        if obj_runner is None:
+            obj_runner = get_gauss_obj_runner(
+                rng,
+                len(shear_mbobs),
+                shear_mbobs[0][0].jacobian.get_scale(),
+            )
+        obj_runner, warm = _get_warm_start_runner(obj_runner, guess)
+
         try:
             ores = bootstrap(
                 shear_mbobs,
-                get_gauss_obj_runner(
-                    rng,
-                    len(shear_mbobs),
-                    shear_mbobs[0][0].jacobian.get_scale(),
-                )
-                if obj_runner is None else obj_runner,
-                psf_runner=(
-                    get_gauss_psf_runner(rng)
-                    if psf_runner is None
-                    else psf_runner
-                ),
+                obj_runner,
+                psf_runner=psf_runner,
             )
         except BootPSFFailure:
             flags |= procflags.PSF_FAILURE
@@ -129,6 +168,7 @@ def fit_mbobs_gauss(
             flags |= procflags.PSF_FAILURE
 
     if flags == 0:
+        _add_fit_stats(fit_stats, ores, "nfev", warm)
         res["gauss_obj_flags"] = ores["flags"]
         res["gauss_T_flags"] = ores["flags"]
         if ores["flags"] == 0:
@@ -155,11 +195,11 @@ def fit_mbobs_gauss(
                 for obs in obslist:
                     pflags |= obs.psf.meta["result"]["flags"]
                     if obs.psf.meta["result"]["flags"] == 0:
-                        msk = obs.weight > 0
-                        if not np.any(msk):
+                        obs_stats = get_obs_stats(obs)
+                        if not obs_stats["any_pos_weight"]:
                             pflags |= procflags.ZERO_WEIGHTS
                         else:
-                            _wgt = np.median(obs.weight[msk])
+                            _wgt = obs_stats["median_weight"]
                             psf_T_sum += obs.psf.meta["result"]["T"] * _wgt
                             psf_g_sum += (
                                 obs.psf.meta["result"]["g"]
@@ -271,9 +311,12 @@ def _make_ml_prior(rng, scale, nband):
     return prior
 
 
+@obs_cache_scope()
 def fit_mbobs_list_joint(
     *, mbobs_list, fitter_name, bmask_flags, rng, shear_bands=None,
-    symmetrize=True, coadd=False,
+    symmetrize=True, coadd=False, psf_fit_cache=None, coadd_obs_list=None,
+    guesses=None, fit_stats=None, n_workers=None, chunk_size=None, batch=False,
+    executor=None,
 ):
     """Fit the ojects in a list of ngmix.MultiBandObsList using a joint fitter.
 
@@ -298,12 +341,147 @@ def fit_mbobs_list_joint(
     coadd : bool, optional
         If True, coadd the mbobs over all bands and then fit. Default is False.
         Ignored for adaptive moments which always coadds.
+    psf_fit_cache : dict, optional
+        If not None, the PSF fits are stored in and reused from this dictionary
+        for PSF observations with identical images, weights and Jacobians, so
+        that a PSF is fit only once instead of once per object. Since the fits
+        use `rng`, the results differ at the level of the fitting tolerances
+        from those made without the cache. Default is None.
+    coadd_obs_list : list of ngmix.Observation, optional
+        If not None, the coadds of the shear bands for each object, e.g. from
+        `make_coadd_obs_list`. They are used instead of coadding the bands of each
+        object if the bands are coadded. Default is None.
+    guesses : np.ndarray, optional
+        If not None, the initial guesses for each object from `get_fit_guesses`,
+        e.g. from the results of another fitter. Default is None.
+    fit_stats : dict, optional
+        If not None, the number of fits, warm started fits, tries and iterations
+        are added to the entries "nfit", "nwarm", "ntry" and "niter". They are
+        logged in any case. Default is None.
+    n_workers : int, optional
+        If not None, the objects are fit in chunks of `chunk_size` objects with
+        a pool of this many processes. Each object is fit with its own random
+        number stream seeded from `rng`, so the results do not depend on the
+        number of workers. They do depend on `chunk_size` if `psf_fit_cache` is
+        used, since each chunk has its own copy of the cache. Default of None
+        fits the objects serially with `rng`.
+    chunk_size : int, optional
+        The number of objects in each chunk if `n_workers` is not None. Default
+        of None uses `JOINT_FIT_CHUNK_SIZE`.
+    batch : bool, optional
+        If True, the adaptive moments of all objects are measured together with
+        `fit_mbobs_list_admom_batch` and `n_workers` is ignored. Only supported
+        for adaptive moments. Default is False.
+    executor : concurrent.futures.Executor, optional
+        If not None and `n_workers` is not None, the chunks are fit with this
+        executor instead of a pool of `n_workers` processes made for this call,
+        so that a single pool can be reused for many calls. Default is None.
 
     Returns
     -------
     res : np.ndarray
         A structured array of the fitting results.
     """
+    fit_func, kwargs = _get_joint_fit_func_and_kwargs(
+        mbobs_list=mbobs_list,
+        fitter_name=fitter_name,
+        rng=rng,
+        shear_bands=shear_bands,
+        symmetrize=symmetrize,
+        coadd=coadd,
+    )
+
+    if len(mbobs_list) == 0:
+        return None
+
+    # the results are written into a single array if we can
+    out = _get_mbobs_list_output_buffer(
+        mbobs_list,
+        "am" if fit_func is fit_mbobs_admom else "gauss",
+        shear_bands,
+    )
+
+    if fit_stats is None:
+        fit_stats = {}
+    for key in ["nfit", "nwarm", "ntry", "niter"]:
+        fit_stats.setdefault(key, 0)
+    _fit_stats = dict(fit_stats)
+
+    if batch:
+        if fit_func is not fit_mbobs_admom:
+            raise ValueError(
+                "batch fits are not supported for joint fitter '%s'" % fitter_name
+            )
+        res = fit_mbobs_list_admom_batch(
+            mbobs_list=mbobs_list,
+            bmask_flags=bmask_flags,
+            rng=rng,
+            shear_bands=shear_bands,
+            symmetrize=symmetrize,
+            psf_fit_cache=psf_fit_cache,
+            out=out,
+            coadd_obs_list=coadd_obs_list,
+            guesses=guesses,
+            fit_stats=fit_stats,
+        )
+    elif n_workers is not None:
+        res = _fit_mbobs_list_joint_chunks(
+            mbobs_list=mbobs_list,
+            fitter_name=fitter_name,
+            bmask_flags=bmask_flags,
+            rng=rng,
+            shear_bands=shear_bands,
+            symmetrize=symmetrize,
+            coadd=coadd,
+            psf_fit_cache=psf_fit_cache,
+            coadd_obs_list=coadd_obs_list,
+            guesses=guesses,
+            fit_stats=fit_stats,
+            n_workers=n_workers,
+            chunk_size=chunk_size,
+            executor=executor,
+        )
+        if out is not None:
+            for i, _res in enumerate(res):
+                out[i] = _res[0]
+    else:
+        if psf_fit_cache is not None:
+            kwargs["psf_fit_cache"] = psf_fit_cache
+
+        res = []
+        for i, mbobs in enumerate(mbobs_list):
+            _res = fit_func(
+                mbobs=mbobs,
+                bmask_flags=bmask_flags,
+                shear_bands=shear_bands,
+                rng=rng,
+                out=out[i:i + 1] if out is not None else None,
+                coadd_obs=coadd_obs_list[i] if coadd_obs_list is not None else None,
+                guess=guesses[i] if guesses is not None else None,
+                fit_stats=fit_stats,
+                **kwargs,
+            )
+            res.append(_res)
+
+    logger.info(
+        "fitter %s: %d fits (%d warm started) with %d tries and %d iterations",
+        fitter_name,
+        *[
+            fit_stats[key] - _fit_stats[key]
+            for key in ["nfit", "nwarm", "ntry", "niter"]
+        ],
+    )
+
+    if out is not None:
+        return out
+    else:
+        return np.hstack(res)
+
+
+def _get_joint_fit_func_and_kwargs(
+    *, mbobs_list, fitter_name, rng, shear_bands, symmetrize, coadd,
+):
+    """get the function to fit each object and its runners and options"""
     if fitter_name in ["am", "admom"]:
         fit_func = fit_mbobs_admom
         kwargs = {"runner": get_admom_runner(rng), 'symmetrize': symmetrize}
@@ -324,21 +502,309 @@ def fit_mbobs_list_joint(
     else:
         raise RuntimeError("Joint fitter '%s' not recognized!" % fitter_name)
 
+    return fit_func, kwargs
+
+
+def _fit_mbobs_list_joint_chunks(
+    *, mbobs_list, fitter_name, bmask_flags, rng, shear_bands, symmetrize, coadd,
+    psf_fit_cache, coadd_obs_list, guesses, fit_stats, n_workers, chunk_size,
+    executor,
+):
+    """fit the objects in chunks with a random number stream for each object,
+    returns the list of results for each object"""
+    if chunk_size is None:
+        chunk_size = JOINT_FIT_CHUNK_SIZE
+
+    # the seeds are drawn for all objects at once so that the results do not
+    # depend on how the work is distributed
+    seeds = rng.randint(low=1, high=2**30, size=len(mbobs_list))
+
+    tasks = []
+    for start in range(0, len(mbobs_list), chunk_size):
+        end = start + chunk_size
+        tasks.append(dict(
+            mbobs_list=mbobs_list[start:end],
+            seeds=seeds[start:end],
+            fitter_name=fitter_name,
+            bmask_flags=bmask_flags,
+            shear_bands=shear_bands,
+            symmetrize=symmetrize,
+            coadd=coadd,
+            psf_fit_cache=psf_fit_cache,
+            coadd_obs_list=(
+                coadd_obs_list[start:end] if coadd_obs_list is not None else None
+            ),
+            guesses=guesses[start:end] if guesses is not None else None,
+        ))
+
+    if n_workers <= 1 or len(tasks) <= 1:
+        chunk_results = [_fit_mbobs_chunk_joint(**task) for task in tasks]
+    elif executor is not None:
+        chunk_results = _run_chunks(executor, tasks)
+    else:
+        with ProcessPoolExecutor(
+            max_workers=min(n_workers, len(tasks))
+        ) as executor:
+            chunk_results = _run_chunks(executor, tasks)
+
     res = []
-    for i, mbobs in enumerate(mbobs_list):
-        _res = fit_func(
+    for _res, _psf_fit_cache, _fit_stats in chunk_results:
+        res.extend(_res)
+
+        # the PSF fits from the chunks are kept in order so that later calls
+        # see the same cache for any number of workers
+        if psf_fit_cache is not None:
+            for name, cache in _psf_fit_cache.items():
+                for key, pres in cache.items():
+                    psf_fit_cache.setdefault(name, {}).setdefault(key, pres)
+
+        for key, val in _fit_stats.items():
+            fit_stats[key] = fit_stats.get(key, 0) + val
+
+    return res
+
+
+def _run_chunks(executor, tasks):
+    futures = [executor.submit(_fit_mbobs_chunk_joint, **task) for task in tasks]
+    return [fut.result() for fut in futures]
+
+
+@obs_cache_scope()
+def _fit_mbobs_chunk_joint(
+    *, mbobs_list, seeds, fitter_name, bmask_flags, shear_bands, symmetrize, coadd,
+    psf_fit_cache, coadd_obs_list, guesses,
+):
+    """
+    fit a chunk of objects, reseeding the random number generator of the
+    runners for each object
+
+    This function is at the module level so that it can be sent to worker
+    processes.
+    """
+    rng = np.random.RandomState()
+    fit_func, kwargs = _get_joint_fit_func_and_kwargs(
+        mbobs_list=mbobs_list,
+        fitter_name=fitter_name,
+        rng=rng,
+        shear_bands=shear_bands,
+        symmetrize=symmetrize,
+        coadd=coadd,
+    )
+
+    # each chunk starts from the cache at the time the chunks are made
+    if psf_fit_cache is not None:
+        psf_fit_cache = {
+            name: dict(cache) for name, cache in psf_fit_cache.items()
+        }
+        kwargs["psf_fit_cache"] = psf_fit_cache
+
+    fit_stats = {}
+    res = []
+    for i, (mbobs, seed) in enumerate(zip(mbobs_list, seeds)):
+        rng.seed(seed)
+        res.append(fit_func(
             mbobs=mbobs,
             bmask_flags=bmask_flags,
             shear_bands=shear_bands,
             rng=rng,
+            coadd_obs=coadd_obs_list[i] if coadd_obs_list is not None else None,
+            guess=guesses[i] if guesses is not None else None,
+            fit_stats=fit_stats,
             **kwargs,
+        ))
+
+    return res, psf_fit_cache, fit_stats
+
+
+def get_fit_guesses(res, model, *, target, fwhm=None, fwhm_reg=0):
+    """Get initial guesses for a joint fitter from the results of a fitter.
+
+    The T and shape of each object are converted from those measured by the
+    fitter to those fit by the target. The dilution of the moments by the
+    weight function of the weighted average fitters is removed, treating the
+    weight of the ksigma fitter as a Gaussian with the same FWHM, and the
+    regularization of the shapes by `fwhm_reg` is undone. Then the PSF is
+    removed for the Gaussian fit of the pre-PSF profile, or added for the
+    adaptive moments of the observed profile. The conversions are exact for
+    Gaussian objects and PSFs.
+
+    Parameters
+    ----------
+    res : np.ndarray
+        The results of the fitter, e.g. from `fit_mbobs_list_wavg`.
+    model : str
+        The model or "kind" of the fitter, used as the prefix of the columns.
+        It starts with one of "wmom", "pgauss", "ksigma", "am" or "gauss".
+    target : str
+        The joint fitter the guesses are for, either "am" or "gauss".
+    fwhm : float, optional
+        The FWHM of the weight function of the weighted average fitters. It is
+        required for them. Default is None.
+    fwhm_reg : float, optional
+        The FWHM used to regularize the shapes of the weighted average fitters.
+        Default is 0.
+
+    Returns
+    -------
+    guesses : np.ndarray
+        A structured array with the guesses for T and g for each object. T is NaN
+        for the objects without a usable result.
+    """
+    kind = model.split("_")[0]
+    if kind not in ["wmom", "pgauss", "ksigma", "am", "gauss"]:
+        raise ValueError("Cannot make guesses from the model '%s'" % model)
+    if target not in ["am", "gauss"]:
+        raise ValueError("Cannot make guesses for the target '%s'" % target)
+    is_wavg = kind in ["wmom", "pgauss", "ksigma"]
+    if is_wavg and fwhm is None:
+        raise ValueError("The weight FWHM is required for the model '%s'" % model)
+
+    n = Namer(front=model)
+    T = res[n("T")]
+    g = res[n("g")]
+    psf_T = res[n("psf_T")]
+    psf_g = res[n("psf_g")]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # the moments fitters measure e, the Gaussian fit measures g
+        if kind == "gauss":
+            e = _g_to_e(g)
+            psf_e = _g_to_e(psf_g)
+        else:
+            e = g
+            psf_e = psf_g
+
+        if fwhm_reg > 0:
+            T_reg = fwhm_to_T(fwhm_reg)
+            e = e * ((T + T_reg) / T)[:, np.newaxis]
+
+        mom = _T_e_to_mom(T, e)
+        psf_mom = _T_e_to_mom(psf_T, psf_e)
+
+        # for Gaussians the inverse moments of the weighted profile are the sum
+        # of those of the profile and the weight
+        if is_wavg:
+            T_w = fwhm_to_T(fwhm)
+            w_inv = np.array([2 / T_w, 0, 2 / T_w])
+            mom = _inv_mom(_inv_mom(mom) - w_inv)
+            psf_mom = _inv_mom(_inv_mom(psf_mom) - w_inv)
+
+        is_pre_psf = kind in ["pgauss", "ksigma", "gauss"]
+        if target == "gauss" and not is_pre_psf:
+            mom = mom - psf_mom
+        elif target == "am" and is_pre_psf:
+            mom = mom + psf_mom
+
+        T, e = _mom_to_T_e(mom)
+        g = _e_to_g(e)
+
+        guesses = np.zeros(len(res), dtype=[("T", "f8"), ("g", "f8", 2)])
+        guesses["T"] = np.nan
+        msk = (
+            (res[n("flags")] == 0)
+            & np.isfinite(T)
+            & (T > 0)
+            & np.all(np.isfinite(g), axis=1)
+            & (np.sum(e**2, axis=1) < 1)
         )
-        res.append(_res)
+    guesses["T"][msk] = T[msk]
+    guesses["g"][msk] = g[msk]
+    return guesses
 
-    if len(res) > 0:
-        return np.hstack(res)
-    else:
-        return None
+
+def _T_e_to_mom(T, e):
+    """convert T and e to the moments (Irr, Irc, Icc)"""
+    return np.stack(
+        [T * (1 - e[:, 0]) / 2, T * e[:, 1] / 2, T * (1 + e[:, 0]) / 2],
+        axis=1,
+    )
+
+
+def _mom_to_T_e(mom):
+    """convert the moments (Irr, Irc, Icc) to T and e"""
+    T = mom[:, 0] + mom[:, 2]
+    e = np.stack([(mom[:, 2] - mom[:, 0]) / T, 2 * mom[:, 1] / T], axis=1)
+    return T, e
+
+
+def _inv_mom(mom):
+    """invert the matrices of the moments (Irr, Irc, Icc)"""
+    det = mom[:, 0] * mom[:, 2] - mom[:, 1]**2
+    return np.stack(
+        [mom[:, 2] / det, -mom[:, 1] / det, mom[:, 0] / det], axis=1,
+    )
+
+
+def _e_to_g(e):
+    esq = np.sum(e**2, axis=1)
+    return e / (1 + np.sqrt(1 - esq))[:, np.newaxis]
+
+
+def _g_to_e(g):
+    gsq = np.sum(g**2, axis=1)
+    return 2 * g / (1 + gsq)[:, np.newaxis]
+
+
+class _WarmStartGuesser(object):
+    """A guesser that puts T and g into the first guess of another guesser and
+    uses the guesses of the other guesser for any retries.
+
+    Parameters
+    ----------
+    guesser : ngmix guesser
+        The guesser. It returns either a Gaussian mixture or an array of the
+        parameters of a simple model.
+    T : float
+        The guess for T.
+    g : array-like
+        The guess for g.
+    """
+    def __init__(self, guesser, T, g):
+        self.guesser = guesser
+        self.T = T
+        self.g = g
+        self.ncall = 0
+
+    def __call__(self, *args, **kwargs):
+        guess = self.guesser(*args, **kwargs)
+        self.ncall += 1
+        if self.ncall > 1:
+            return guess
+
+        if isinstance(guess, ngmix.GMix):
+            row, col = guess.get_cen()
+            return ngmix.GMixModel(
+                [row, col, self.g[0], self.g[1], self.T, guess.get_flux()],
+                "gauss",
+            )
+        else:
+            guess = np.array(guess, dtype="f8", copy=True)
+            guess[..., 2:4] = self.g
+            guess[..., 4] = self.T
+            return guess
+
+
+def _get_warm_start_runner(runner, guess):
+    """make a runner that starts from the guess, returns the runner and whether it
+    is warm started"""
+    if guess is None or not np.isfinite(guess["T"]):
+        return runner, False
+
+    return Runner(
+        fitter=runner.fitter,
+        guesser=_WarmStartGuesser(runner.guesser, guess["T"], guess["g"]),
+        ntry=runner.ntry,
+    ), True
+
+
+def _add_fit_stats(fit_stats, fres, niter_key, warm):
+    if fit_stats is None:
+        return
+
+    fit_stats["nfit"] = fit_stats.get("nfit", 0) + 1
+    fit_stats["nwarm"] = fit_stats.get("nwarm", 0) + int(warm)
+    fit_stats["ntry"] = fit_stats.get("ntry", 0) + fres.get("ntry", 1)
+    fit_stats["niter"] = fit_stats.get("niter", 0) + fres.get(niter_key, 0)
 
 
 def get_admom_runner(rng):
@@ -360,6 +826,11 @@ def fit_mbobs_admom(
     shear_bands=None,
     runner=None,
     symmetrize=True,
+    psf_fit_cache=None,
+    out=None,
+    coadd_obs=None,
+    guess=None,
+    fit_stats=None,
 ):
     """Fit a multiband obs using adaptive moments.
 
@@ -382,6 +853,25 @@ def fit_mbobs_admom(
         `get_admom_runner` is called.
     symmetrize : bool, optional
         If True, apply 4-fold symmetry to the mask+weight map. Default is True.
+    psf_fit_cache : dict, optional
+        If not None, the PSF fits are stored in and reused from this dictionary
+        for PSF observations with identical images, weights and Jacobians.
+        Default is None.
+    out : np.ndarray, optional
+        A length one structured array to write the results into, for example a
+        slice of the output of `get_wavg_output_buffer`. It must be set to the
+        default values. Default of None allocates a new array.
+    coadd_obs : ngmix.Observation, optional
+        If given, this coadd of the shear bands is fit instead of the one made
+        with `make_coadd_obs`. See `make_coadd_obs_list`. Default is None.
+    guess : np.void, optional
+        If not None, an element of the output of `get_fit_guesses`. Its T and g
+        are used for the first try of the object fit if T is finite. Default is
+        None.
+    fit_stats : dict, optional
+        If not None, the number of fits, warm started fits, tries and iterations
+        are added to the entries "nfit", "nwarm", "ntry" and "niter". Default is
+        None.
 
     Returns
     -------
@@ -392,8 +882,188 @@ def fit_mbobs_admom(
     nband = len(mbobs)
     if shear_bands is None:
         shear_bands = list(range(len(mbobs)))
-    res = get_wavg_output_struct(nband, "am", shear_bands=shear_bands)
+    res = _get_wavg_output_row(out, nband, "am", shear_bands)
+
+    flags, pres, obs = _prep_mbobs_admom(
+        mbobs=mbobs,
+        bmask_flags=bmask_flags,
+        shear_bands=shear_bands,
+        runner=runner,
+        symmetrize=symmetrize,
+        psf_fit_cache=psf_fit_cache,
+        coadd_obs=coadd_obs,
+        res=res,
+    )
+
+    if flags == 0:
+        # then fit the object
+        obj_runner, warm = _get_warm_start_runner(runner, guess)
+        try:
+            gres = obj_runner.go(obs)
+        except Exception:
+            flags |= procflags.OBJ_FAILURE
+            # replace no attempt
+            res["am_flags"] = flags
+        else:
+            _add_fit_stats(fit_stats, gres, "numiter", warm)
+            _set_admom_obj_res(res=res, gres=gres, pres=pres)
+
+    else:
+        # this branch ensures noattempt remains set
+        res["am_flags"] |= flags
+
+    return res
 
+
+@obs_cache_scope()
+def fit_mbobs_list_admom_batch(
+    *,
+    mbobs_list,
+    bmask_flags,
+    rng,
+    shear_bands=None,
+    symmetrize=True,
+    psf_fit_cache=None,
+    out=None,
+    coadd_obs_list=None,
+    guesses=None,
+    fit_stats=None,
+):
+    """Fit a list of multiband obs using adaptive moments measured in batches.
+
+    The shear bands of each object are coadded and the PSFs are fit as in
+    `fit_mbobs_admom`. The adaptive moments of the objects are then iterated
+    together with `metadetect.moments.measure_admom_batch`, starting from the
+    guesses if given and otherwise from the PSF T. The objects for which the
+    batch measurement fails are fit again with the ngmix runner. The output
+    columns and flags are the same as those of `fit_mbobs_admom`.
+
+    Parameters
+    ----------
+    mbobs_list : a list of ngmix.MultiBandObsList
+        The observations to use for shear measurement.
+    bmask_flags : int
+        Observations with these bits set in the bmask are not fit.
+    rng : np.random.RandomState
+        Random state for fitting the PSFs and the objects that are fit again.
+    shear_bands : list of int, optional
+        A list of indices into each mbobs that denotes which band is used for shear.
+        Default is to use all bands.
+    symmetrize : bool, optional
+        If True, apply 4-fold symmetry to the mask+weight map. Default is True.
+    psf_fit_cache : dict, optional
+        If not None, the PSF fits are stored in and reused from this dictionary
+        for PSF observations with identical images, weights and Jacobians.
+        Default is None.
+    out : np.ndarray, optional
+        A structured array to write the results into, for example the output of
+        `get_wavg_output_buffer`. It must be set to the default values. Default
+        of None allocates a new array if the objects all have the same number
+        of bands.
+    coadd_obs_list : list of ngmix.Observation, optional
+        If not None, the coadds of the shear bands for each object. See
+        `fit_mbobs_admom`. Default is None.
+    guesses : np.ndarray, optional
+        If not None, the initial guesses for each object from `get_fit_guesses`.
+        Default is None.
+    fit_stats : dict, optional
+        If not None, the number of fits, warm started fits, tries and iterations
+        are added to the entries "nfit", "nwarm", "ntry" and "niter". Default is
+        None.
+
+    Returns
+    -------
+    res : np.ndarray
+        A structured array of the fitting results.
+    """
+    if len(mbobs_list) == 0:
+        return None
+
+    runner = get_admom_runner(rng)
+    if out is None:
+        out = _get_mbobs_list_output_buffer(mbobs_list, "am", shear_bands)
+
+    all_res = []
+    fit_inds = []
+    fit_obs = []
+    fit_pres = []
+    for i, mbobs in enumerate(mbobs_list):
+        _shear_bands = (
+            list(range(len(mbobs))) if shear_bands is None else shear_bands
+        )
+        res = _get_wavg_output_row(
+            out[i:i + 1] if out is not None else None,
+            len(mbobs),
+            "am",
+            _shear_bands,
+        )
+        all_res.append(res)
+
+        flags, pres, obs = _prep_mbobs_admom(
+            mbobs=mbobs,
+            bmask_flags=bmask_flags,
+            shear_bands=_shear_bands,
+            runner=runner,
+            symmetrize=symmetrize,
+            psf_fit_cache=psf_fit_cache,
+            coadd_obs=coadd_obs_list[i] if coadd_obs_list is not None else None,
+            res=res,
+        )
+        if flags != 0:
+            # this ensures noattempt remains set
+            res["am_flags"] |= flags
+            continue
+
+        fit_inds.append(i)
+        fit_obs.append(obs)
+        fit_pres.append(pres)
+
+    # the objects start from the guesses, or from the PSF if there are none
+    T_guess = np.array([
+        pres["T"] if pres["flags"] == 0 else np.nan for pres in fit_pres
+    ])
+    g_guess = np.zeros((len(fit_inds), 2))
+    warm = np.zeros(len(fit_inds), dtype=bool)
+    if guesses is not None and len(fit_inds) > 0:
+        _guesses = guesses[fit_inds]
+        warm = np.isfinite(_guesses["T"])
+        T_guess[warm] = _guesses["T"][warm]
+        g_guess[warm] = _guesses["g"][warm]
+
+    all_gres = measure_admom_batch(
+        obs_list=fit_obs, T_guess=T_guess, g_guess=g_guess,
+    )
+
+    for i, obs, pres, gres, _warm in zip(
+        fit_inds, fit_obs, fit_pres, all_gres, warm,
+    ):
+        res = all_res[i]
+        ntry = 1
+        if gres["flags"] != 0:
+            try:
+                gres = runner.go(obs)
+            except Exception:
+                # replace no attempt
+                res["am_flags"] = procflags.OBJ_FAILURE
+                continue
+            ntry += gres.get("ntry", 1)
+
+        _add_fit_stats(fit_stats, dict(gres, ntry=ntry), "numiter", _warm)
+        _set_admom_obj_res(res=res, gres=gres, pres=pres)
+
+    if out is not None:
+        return out
+    else:
+        return np.hstack(all_res)
+
+
+def _prep_mbobs_admom(
+    *, mbobs, bmask_flags, shear_bands, runner, symmetrize, psf_fit_cache,
+    coadd_obs, res,
+):
+    """check the data, coadd the shear bands and fit the PSF for adaptive moments,
+    returns the flags, the PSF fit result and the observation to fit for the
+    object"""
     flags = 0
     for obslist in mbobs:
         if len(obslist) == 0:
@@ -405,21 +1075,25 @@ def fit_mbobs_admom(
             continue
 
         for obs in obslist:
-            if not np.any(obs.weight > 0):
-                flags |= procflags.ZERO_WEIGHTS
-
-            if np.any((obs.bmask & bmask_flags) != 0):
-                flags |= procflags.EDGE_HIT
+            flags |= get_obs_flags(obs, bmask_flags=bmask_flags)
 
-    if flags == 0:
+    if flags == 0 and coadd_obs is None:
         # first we coadd the shear bands
         coadd_obs, coadd_flags = make_coadd_obs(mbobs, shear_bands=shear_bands)
         flags |= coadd_flags
 
+    pres = None
     if flags == 0:
         # then fit the PSF
         try:
-            pres = runner.go(coadd_obs.psf)
+            if psf_fit_cache is not None:
+                pres = _go_cached(
+                    runner,
+                    coadd_obs.psf,
+                    psf_fit_cache.setdefault("am", {}),
+                )
+            else:
+                pres = runner.go(coadd_obs.psf)
         except Exception:
             flags |= procflags.PSF_FAILURE
         else:
@@ -428,41 +1102,74 @@ def fit_mbobs_admom(
                 res["am_psf_g"] = pres["e"]
                 res["am_psf_T"] = pres["T"]
 
-    if flags == 0:
-        # then fit the object
-        if symmetrize:
-            sym_coadd_obs = symmetrize_obs_weights(coadd_obs)
-        else:
-            sym_coadd_obs = coadd_obs
-        try:
-            gres = runner.go(sym_coadd_obs)
-        except Exception:
-            flags |= procflags.OBJ_FAILURE
-            # replace no attempt
-            res["am_flags"] = flags
-        else:
-            res["am_T_flags"] = gres["T_flags"]
-            if gres["T_flags"] == 0:
-                res["am_T"] = gres["T"]
-                res["am_T_err"] = gres["T_err"]
-                if pres["flags"] == 0:
-                    res["am_T_ratio"] = res["am_T"] / res["am_psf_T"]
+    if flags != 0:
+        return flags, pres, None
 
-            res["am_obj_flags"] = gres["flags"]
-            if gres["flags"] == 0:
-                res["am_s2n"] = gres["s2n"]
-                res["am_g"] = gres["e"]
-                res["am_g_cov"] = gres["e_cov"]
+    if symmetrize:
+        coadd_obs = get_symmetrized_obs(coadd_obs)
+    return flags, pres, coadd_obs
 
-            # this replaces the flags so they are zero and unsets the default of
-            # no attempt
-            res["am_flags"] = (res["am_psf_flags"] | res["am_obj_flags"])
 
-    else:
-        # this branch ensures noattempt remains set
-        res["am_flags"] |= flags
+def _set_admom_obj_res(*, res, gres, pres):
+    res["am_T_flags"] = gres["T_flags"]
+    if gres["T_flags"] == 0:
+        res["am_T"] = gres["T"]
+        res["am_T_err"] = gres["T_err"]
+        if pres["flags"] == 0:
+            res["am_T_ratio"] = res["am_T"] / res["am_psf_T"]
 
-    return res
+    res["am_obj_flags"] = gres["flags"]
+    if gres["flags"] == 0:
+        res["am_s2n"] = gres["s2n"]
+        res["am_g"] = gres["e"]
+        res["am_g_cov"] = gres["e_cov"]
+
+    # this replaces the flags so they are zero and unsets the default of
+    # no attempt
+    res["am_flags"] = (res["am_psf_flags"] | res["am_obj_flags"])
+
+
+def _go_cached(runner, obs, cache):
+    """Run the runner on the observation, reusing the result from `cache` for
+    observations with identical content."""
+    key = _get_psf_obs_hash(obs)
+    if key not in cache:
+        cache[key] = runner.go(obs)
+    return cache[key]
+
+
+class _CachedPSFRunner(object):
+    """A wrapper for an ngmix PSFRunner that reuses the PSF fits from `cache` for
+    PSF observations with identical content.
+
+    Parameters
+    ----------
+    psf_runner : ngmix.runners.PSFRunner
+        The runner used to fit PSFs that are not in the cache.
+    cache : dict
+        The dictionary of PSF fits keyed on the PSF observation hash.
+    """
+    def __init__(self, psf_runner, cache):
+        self.psf_runner = psf_runner
+        self.cache = cache
+
+    def go(self, obs):
+        if isinstance(obs, ngmix.MultiBandObsList):
+            for obslist in obs:
+                self.go(obslist)
+        elif isinstance(obs, ngmix.ObsList):
+            for _obs in obs:
+                self.go(_obs)
+        else:
+            key = _get_psf_obs_hash(obs.psf)
+            if key in self.cache:
+                pres = self.cache[key]
+                obs.psf.meta["result"] = pres
+                if pres["flags"] == 0:
+                    obs.psf.set_gmix(pres.get_gmix())
+            else:
+                self.psf_runner.go(obs)
+                self.cache[key] = obs.psf.meta["result"]
 
 
 def make_coadd_obs(mbobs, shear_bands=None):
@@ -534,14 +1241,13 @@ def make_coadd_obs(mbobs, shear_bands=None):
     # first make the weights
     wgts = np.zeros(len(shear_bands))
     for i, band in enumerate(shear_bands):
-        obs = mbobs[band][0]
-        msk = obs.weight > 0
-        if not np.any(msk):
+        obs_stats = get_obs_stats(mbobs[band][0])
+        if not obs_stats["any_pos_weight"]:
             flags |= procflags.ZERO_WEIGHTS
             # let's not waste time since we are missing a band
             return None, flags
         else:
-            wgts[i] = np.median(obs.weight[msk])
+            wgts[i] = obs_stats["median_weight"]
     wgts /= np.sum(wgts)
 
     # finish coadding
@@ -633,6 +1339,62 @@ def make_coadd_obs(mbobs, shear_bands=None):
     return cobs, flags
 
 
+def make_coadd_obs_list(
+    *, mbobs, shear_bands, cat, seg=None, weight_type="weight",
+):
+    """Coadd the shear bands of full images once and cut stamps for each object
+    from the coadd.
+
+    The bands are weighted by the median weight of the full images instead
+    of the stamps, so the results differ slightly from those made with
+    `make_coadd_obs` for each object.
+
+    Parameters
+    ----------
+    mbobs : ngmix.MultiBandObsList
+        The full images.
+    shear_bands : list of int, optional
+        A list of indices into each mbobs that denotes which band is used for shear.
+        Default is to use all bands.
+    cat : np.ndarray
+        The catalog of objects with the columns 'x', 'y', 'box_size' and
+        optionally 'number'.
+    seg : np.ndarray, optional
+        The seg map of the objects. It is required for the 'uberseg' weight
+        type. Default is None.
+    weight_type : str, optional
+        The weight type for the stamps. Default is 'weight'.
+
+    Returns
+    -------
+    coadd_obs_list : list of ngmix.Observation or None
+        The coadd stamp for each object. None is returned if the coadd could not
+        be made or if there is only one shear band.
+    """
+    if shear_bands is None:
+        shear_bands = list(range(len(mbobs)))
+
+    if len(shear_bands) < 2:
+        return None
+
+    coadd_obs, flags = make_coadd_obs(mbobs, shear_bands=shear_bands)
+    if flags != 0:
+        return None
+
+    medsifier = CatalogMEDSifier(
+        ngmix.observation.get_mb_obs(coadd_obs),
+        cat['x'],
+        cat['y'],
+        cat['box_size'],
+        number=cat['number'] if 'number' in cat.dtype.names else None,
+        seg=seg,
+    )
+    mbobs_list = medsifier.get_multiband_meds(
+        stamp_cubes=True, shared_psf=True,
+    ).get_mbobs_list(weight_type=weight_type)
+    return [_mbobs[0][0] for _mbobs in mbobs_list]
+
+
 def get_coellip_ngauss(name):
     ngauss = int(name[7:])
     return ngauss
@@ -672,9 +1434,11 @@ def fit_all_psfs(mbobs, rng):
             raise BootPSFFailure("failed to measure psfs: %s" % flags)
 
 
+@obs_cache_scope()
 def fit_mbobs_list_wavg(
     *, mbobs_list, fitter, bmask_flags, shear_bands=None, fwhm_reg=0,
-    symmetrize=True,
+    symmetrize=True, band_res_cache=None, psf_res_cache=None, batch=False,
+    fourier_cache=None,
 ):
     """Fit the ojects in a list of ngmix.MultiBandObsList using a weighted average
     over bands.
@@ -702,12 +1466,49 @@ def fit_mbobs_list_wavg(
         Gaussian with FWHM `fwhm_reg`.
     symmetrize : bool, optional
         If True, apply 4-fold symmetry to the mask+weight map. Default is True.
+    band_res_cache : dict, optional
+        If not None, the per-band fit results are stored in and reused from
+        this dictionary. The per-band results do not depend on `shear_bands`,
+        so passing the same dictionary for calls with different `shear_bands`
+        but the same observations avoids refitting each band. Default is None.
+    psf_res_cache : dict, optional
+        If not None, the PSF fit results are stored in and reused from this
+        dictionary for PSF observations with identical images, weights and
+        Jacobians. Default is None.
+    batch : bool, optional
+        If True, measure the moments for all objects and bands at once with
+        `metadetect.moments.measure_moments_batch` instead of running the fitter
+        per object and band. The results agree with the default to floating
+        point precision. Default is False.
+    fourier_cache : metadetect.moments.FourierCache, optional
+        If not None and `batch` is True, the Fourier-space kernels and PSF
+        transforms for the pre-PSF moments fitters are looked up in and stored
+        to this cache. Default is None.
 
     Returns
     -------
     res : np.ndarray
         A structured array of the fitting results.
     """
+    if batch:
+        return fit_mbobs_list_wavg_multi(
+            mbobs_list=mbobs_list,
+            fitters=[fitter],
+            bmask_flags=bmask_flags,
+            shear_bands=shear_bands,
+            fwhm_regs=[fwhm_reg],
+            symmetrize=symmetrize,
+            band_res_cache=band_res_cache,
+            psf_res_cache=psf_res_cache,
+            fourier_cache=fourier_cache,
+        )[0]
+
+    if len(mbobs_list) == 0:
+        return None
+
+    # the results are written into a single array if we can
+    out = _get_mbobs_list_output_buffer(mbobs_list, fitter.kind, shear_bands)
+
     res = []
     for i, mbobs in enumerate(mbobs_list):
 
@@ -718,13 +1519,16 @@ def fit_mbobs_list_wavg(
             shear_bands=shear_bands,
             fwhm_reg=fwhm_reg,
             symmetrize=symmetrize,
+            band_res_cache=band_res_cache,
+            psf_res_cache=psf_res_cache,
+            out=out[i:i + 1] if out is not None else None,
         )
         res.append(_res)
 
-    if len(res) > 0:
-        return np.hstack(res)
+    if out is not None:
+        return out
     else:
-        return None
+        return np.hstack(res)
 
 
 def fit_mbobs_wavg(
@@ -735,6 +1539,9 @@ def fit_mbobs_wavg(
     shear_bands=None,
     fwhm_reg=0,
     symmetrize=True,
+    band_res_cache=None,
+    psf_res_cache=None,
+    out=None,
 ):
     """Fit the object in the ngmix.MultiBandObsList using a weighted average
     over bands.
@@ -762,33 +1569,282 @@ def fit_mbobs_wavg(
         Gaussian with FWHM `fwhm_reg`.
     symmetrize : bool, optional
         If True, apply 4-fold symmetry to the mask+weight map. Default is True.
+    band_res_cache : dict, optional
+        If not None, the per-band fit results are stored in and reused from
+        this dictionary. The per-band results do not depend on `shear_bands`,
+        so passing the same dictionary for calls with different `shear_bands`
+        but the same observations avoids refitting each band. Default is None.
+    psf_res_cache : dict, optional
+        If not None, the PSF fit results are stored in and reused from this
+        dictionary for PSF observations with identical images, weights and
+        Jacobians. Default is None.
+    out : np.ndarray, optional
+        A length one structured array to write the results into, for example a
+        slice of the output of `get_wavg_output_buffer`. It must be set to the
+        default values. Default of None allocates a new array.
 
     Returns
     -------
     res : np.ndarray
         A structured array of the fitting results.
     """
-    nband = len(mbobs)
-    all_res = []
-    all_psf_res = []
-    all_is_shear_band = []
-    all_wgts = []
-    all_flags = []
-
-    if shear_bands is None:
-        shear_bands = list(range(nband))
-
     if fitter.kind == 'am':
         assert len(mbobs) == 1, 'Use only one band for adaptive moments'
 
-    for band in range(nband):
-        all_is_shear_band.append(True if band in shear_bands else False)
-        fres = _fit_obslist(
-            obslist=mbobs[band],
+    all_fres = []
+    for obslist in mbobs:
+        all_fres.append(_fit_obslist(
+            obslist=obslist,
             fitter=fitter,
             bmask_flags=bmask_flags,
             symmetrize=symmetrize,
+            band_res_cache=band_res_cache,
+            psf_res_cache=psf_res_cache,
+        ))
+
+    return _combine_band_fit_results(
+        all_fres=all_fres,
+        model=fitter.kind,
+        shear_bands=shear_bands,
+        fwhm_reg=fwhm_reg,
+        out=out,
+    )
+
+
+@obs_cache_scope()
+def fit_mbobs_list_wavg_multi(
+    *, mbobs_list, fitters, bmask_flags, shear_bands=None, fwhm_regs=None,
+    symmetrize=True, band_res_cache=None, psf_res_cache=None, fourier_cache=None,
+):
+    """Fit the ojects in a list of ngmix.MultiBandObsList using a weighted average
+    over bands for several fitters at once.
+
+    The data for each band are checked and symmetrized once for all of the
+    fitters and the moments are measured with
+    `metadetect.moments.measure_moments_batch_multi`, so that the pre-PSF
+    moments fitters share the FFTs of the stamps and PSFs. The results for
+    each fitter are identical to those from `fit_mbobs_list_wavg` with
+    `batch=True`.
+
+    Parameters
+    ----------
+    mbobs_list : a list of ngmix.MultiBandObsList
+        The observations to use for shear measurement.
+    fitters : list of ngmix fitters
+        The fitters to use per band per MultiBandObsList. See
+        `metadetect.moments.supports_batch`.
+    bmask_flags : int
+        Observations with these bits set in the bmask are not fit.
+    shear_bands : list of int, optional
+        A list of indices into each mbobs that denotes which band is used for shear.
+        Default is to use all bands.
+    fwhm_regs : list of float, optional
+        The regularization FWHM for each fitter. See `fit_mbobs_list_wavg`.
+        Default of None uses zero for all fitters.
+    symmetrize : bool, optional
+        If True, apply 4-fold symmetry to the mask+weight map. Default is True.
+    band_res_cache : dict, optional
+        See `fit_mbobs_list_wavg`. Default is None.
+    psf_res_cache : dict, optional
+        See `fit_mbobs_list_wavg`. Default is None.
+    fourier_cache : metadetect.moments.FourierCache, optional
+        See `fit_mbobs_list_wavg`. Default is None.
+
+    Returns
+    -------
+    res : list of np.ndarray
+        A structured array of the fitting results for each fitter.
+    """
+    if fwhm_regs is None:
+        fwhm_regs = [0] * len(fitters)
+    if band_res_cache is None:
+        band_res_cache = {}
+    if psf_res_cache is None:
+        psf_res_cache = {}
+
+    # first we check the data for each band and collect the bands to fit
+    # the bands are fit for all fitters if any of them needs them
+    all_fres_list = []
+    to_fit = []
+    for mbobs in mbobs_list:
+        all_fres = []
+        for obslist in mbobs:
+            keys = [
+                _get_band_res_key(
+                    obslist=obslist,
+                    fitter=fitter,
+                    bmask_flags=bmask_flags,
+                    symmetrize=symmetrize,
+                )
+                for fitter in fitters
+            ]
+            if all(
+                key in band_res_cache
+                and band_res_cache[key][0] is obslist
+                and band_res_cache[key][1] is fitter
+                for key, fitter in zip(keys, fitters)
+            ):
+                fres = [band_res_cache[key][2] for key in keys]
+            else:
+                _fres, obs = _prep_obslist(
+                    obslist=obslist,
+                    bmask_flags=bmask_flags,
+                    symmetrize=symmetrize,
+                )
+                fres = [dict(_fres) for _ in fitters]
+                if _fres["flags"] == 0:
+                    to_fit.append((fres, obs))
+                for key, fitter, fitter_fres in zip(keys, fitters, fres):
+                    band_res_cache[key] = (obslist, fitter, fitter_fres)
+            all_fres.append(fres)
+        all_fres_list.append(all_fres)
+
+    # then we measure all of the objects and PSFs at once
+    if len(to_fit) > 0:
+        all_obj_res = measure_moments_batch_multi(
+            fitters=fitters,
+            obs_list=[obs for _, obs in to_fit],
+            fourier_cache=fourier_cache,
         )
+        all_psf_res = _fit_psf_obs_batch_multi(
+            psf_obs_list=[obs.psf for _, obs in to_fit],
+            fitters=fitters,
+            psf_res_cache=psf_res_cache,
+            fourier_cache=fourier_cache,
+        )
+        for k, (fres, _) in enumerate(to_fit):
+            for i in range(len(fitters)):
+                fres[i]["obj_res"] = all_obj_res[i][k]
+                fres[i]["psf_res"] = all_psf_res[i][k]
+                _log_fit_failures(fres[i])
+
+    all_res = []
+    for i, (fitter, fwhm_reg) in enumerate(zip(fitters, fwhm_regs)):
+        if len(all_fres_list) > 0:
+            all_res.append(_combine_band_fit_results_arrays(
+                all_fres_list=[
+                    [fres[i] for fres in all_fres] for all_fres in all_fres_list
+                ],
+                model=fitter.kind,
+                shear_bands=shear_bands,
+                fwhm_reg=fwhm_reg,
+            ))
+        else:
+            all_res.append(None)
+
+    return all_res
+
+
+def is_fixed_by_stamp_flags(*, stamp_flags, is_wavg, symmetrize, exact=True):
+    """Find the objects whose fitting results are fixed by the flags of their
+    stamps, so that they do not need to be fit.
+
+    The joint fitters do not fit an object if any band is flagged. The weighted
+    average fitters measure the unflagged bands, and symmetrizing the weights
+    can flag more bands, so their results are only fixed if every band is
+    flagged with `procflags.ZERO_WEIGHTS`, or with any flag if the weights are
+    not symmetrized.
+
+    Parameters
+    ----------
+    stamp_flags : np.ndarray
+        The flags of the stamps with shape (nobj, nband). See
+        `metadetect.detect.MEDSifier.get_stamp_flags`.
+    is_wavg : bool
+        If True, the fitter is a weighted average fitter, otherwise it is one
+        of the joint fitters.
+    symmetrize : bool
+        If True, the fitter symmetrizes the weights.
+    exact : bool, optional
+        If False, the stamps can have more flags than `stamp_flags`, e.g. with
+        `procflags.ZERO_WEIGHTS` for weights zeroed outside of the seg map, and
+        only the objects with `procflags.ZERO_WEIGHTS` set in every band are
+        fixed. Default is True.
+
+    Returns
+    -------
+    is_fixed : np.ndarray
+        A boolean array of length nobj.
+    """
+    stamp_flags = np.asarray(stamp_flags)
+    zero_weights = (stamp_flags & procflags.ZERO_WEIGHTS) != 0
+    if not exact:
+        return np.all(zero_weights, axis=1)
+
+    if is_wavg:
+        if symmetrize:
+            return np.all(zero_weights, axis=1)
+        else:
+            return np.all(stamp_flags != 0, axis=1)
+    else:
+        return np.any(stamp_flags != 0, axis=1)
+
+
+def make_flagged_fit_res(*, stamp_flags, model, is_wavg, shear_bands=None, fwhm_reg=0):
+    """Make the fitting results of objects that are not fit because of the flags
+    of their stamps. See `is_fixed_by_stamp_flags`.
+
+    The results are the same as those of the fitters for stamps with these
+    flags.
+
+    Parameters
+    ----------
+    stamp_flags : np.ndarray
+        The flags of the stamps with shape (nobj, nband).
+    model : str
+        The model or "kind" of fitter.
+    is_wavg : bool
+        If True, the fitter is a weighted average fitter, otherwise it is one
+        of the joint fitters.
+    shear_bands : list of int, optional
+        A list of indices into each mbobs that denotes which band is used for shear.
+        Default is to use all bands.
+    fwhm_reg : float, optional
+        See `fit_mbobs_wavg`. Default is 0.
+
+    Returns
+    -------
+    res : np.ndarray
+        A structured array of the fitting results.
+    """
+    stamp_flags = np.asarray(stamp_flags)
+    nobj, nband = stamp_flags.shape
+    if shear_bands is None:
+        shear_bands = list(range(nband))
+
+    if is_wavg:
+        return _combine_band_fit_results_arrays(
+            all_fres_list=[
+                [
+                    {"flags": int(flags), "wgt": 0, "obj_res": None, "psf_res": None}
+                    for flags in _stamp_flags
+                ]
+                for _stamp_flags in stamp_flags
+            ],
+            model=model,
+            shear_bands=shear_bands,
+            fwhm_reg=fwhm_reg,
+        )
+    else:
+        # the joint fitters keep NO_ATTEMPT set and add the flags of all bands
+        res = get_wavg_output_buffer(nobj, nband, model, shear_bands=shear_bands)
+        res[model + "_flags"] |= np.bitwise_or.reduce(stamp_flags, axis=1)
+        return res
+
+
+def _combine_band_fit_results(*, all_fres, model, shear_bands, fwhm_reg, out=None):
+    nband = len(all_fres)
+    all_res = []
+    all_psf_res = []
+    all_is_shear_band = []
+    all_wgts = []
+    all_flags = []
+
+    if shear_bands is None:
+        shear_bands = list(range(nband))
+
+    for band, fres in enumerate(all_fres):
+        all_is_shear_band.append(True if band in shear_bands else False)
         all_wgts.append(fres["wgt"])
         all_res.append(fres["obj_res"])
         all_psf_res.append(fres["psf_res"])
@@ -799,87 +1855,286 @@ def fit_mbobs_wavg(
         all_psf_res=all_psf_res,
         all_is_shear_band=all_is_shear_band,
         all_wgts=all_wgts,
-        model=fitter.kind,
+        model=model,
         all_flags=all_flags,
         shear_bands=shear_bands,
         fwhm_reg=fwhm_reg,
+        out=out,
+    )
+
+
+def _combine_band_fit_results_arrays(*, all_fres_list, model, shear_bands, fwhm_reg):
+    """Combine the per-band fit results for a list of objects with
+    `combine_fit_results_wavg_arrays`."""
+    nobj = len(all_fres_list)
+    nband = len(all_fres_list[0])
+    if any(len(all_fres) != nband for all_fres in all_fres_list):
+        # this does not happen for metadetect, but we fall back to the
+        # per-object combination if it does
+        return np.hstack([
+            _combine_band_fit_results(
+                all_fres=all_fres,
+                model=model,
+                shear_bands=shear_bands,
+                fwhm_reg=fwhm_reg,
+            )
+            for all_fres in all_fres_list
+        ])
+
+    sums = np.zeros((nobj, nband, 6))
+    sums_cov = np.zeros((nobj, nband, 6, 6))
+    sums_norm = np.full((nobj, nband), np.nan)
+    psf_sums = np.zeros((nobj, nband, 6))
+    psf_sums_cov = np.zeros((nobj, nband, 6, 6))
+    psf_sums_norm = np.full((nobj, nband), np.nan)
+    wgts = np.zeros((nobj, nband))
+    flags = np.zeros((nobj, nband), dtype=np.int64)
+    band_flux = np.full((nobj, nband), np.nan)
+    band_flux_err = np.full((nobj, nband), np.nan)
+    band_flux_flags = np.zeros((nobj, nband), dtype=np.int64)
+    for i, all_fres in enumerate(all_fres_list):
+        for band, fres in enumerate(all_fres):
+            wgts[i, band] = fres["wgt"]
+            flags[i, band] = fres["flags"]
+            obj_res = fres["obj_res"]
+            psf_res = fres["psf_res"]
+            if obj_res is None or psf_res is None:
+                # we mark this band as missing
+                flags[i, band] |= procflags.MISSING_BAND
+                continue
+
+            sums[i, band] = obj_res[MOMNAME][:6]
+            sums_cov[i, band] = obj_res[MOMNAME + "_cov"][:6, :6]
+            sums_norm[i, band] = obj_res.get(MOMNAME + "_norm", np.nan)
+            psf_sums[i, band] = psf_res[MOMNAME][:6]
+            psf_sums_cov[i, band] = psf_res[MOMNAME + "_cov"][:6, :6]
+            psf_sums_norm[i, band] = psf_res.get(MOMNAME + "_norm", np.nan)
+            band_flux[i, band] = obj_res["flux"]
+            band_flux_err[i, band] = obj_res["flux_err"]
+            band_flux_flags[i, band] = obj_res["flux_flags"]
+
+    return combine_fit_results_wavg_arrays(
+        sums=sums,
+        sums_cov=sums_cov,
+        sums_norm=sums_norm,
+        psf_sums=psf_sums,
+        psf_sums_cov=psf_sums_cov,
+        psf_sums_norm=psf_sums_norm,
+        wgts=wgts,
+        flags=flags,
+        band_flux=band_flux,
+        band_flux_err=band_flux_err,
+        band_flux_flags=band_flux_flags,
+        model=model,
+        shear_bands=shear_bands,
+        fwhm_reg=fwhm_reg,
     )
 
 
+def _get_band_res_key(*, obslist, fitter, bmask_flags, symmetrize):
+    # we keep references to the obslist and fitter in the cache so that
+    # their ids cannot be reused by other objects
+    return (id(obslist), id(fitter), bmask_flags, symmetrize)
+
+
 def _fit_obslist(
     *,
     obslist,
     fitter,
     bmask_flags,
     symmetrize,
+    band_res_cache=None,
+    psf_res_cache=None,
 ):
-    if len(obslist) == 0:
-        # we will flag this later
-        res = {}
-        res["flags"] = 0
-        res["flags"] |= procflags.MISSING_BAND
-        res["wgt"] = 0
-        res["obj_res"] = None
-        res["psf_res"] = None
-        return res
-    else:
-        return _fit_obs(
-            obs=obslist[0],
+    if band_res_cache is not None:
+        key = _get_band_res_key(
+            obslist=obslist,
+            fitter=fitter,
+            bmask_flags=bmask_flags,
+            symmetrize=symmetrize,
+        )
+        if key in band_res_cache:
+            _obslist, _fitter, res = band_res_cache[key]
+            if _obslist is obslist and _fitter is fitter:
+                return res
+
+        res = _fit_obslist(
+            obslist=obslist,
             fitter=fitter,
             bmask_flags=bmask_flags,
             symmetrize=symmetrize,
+            psf_res_cache=psf_res_cache,
         )
+        band_res_cache[key] = (obslist, fitter, res)
+        return res
 
+    res, obs = _prep_obslist(
+        obslist=obslist,
+        bmask_flags=bmask_flags,
+        symmetrize=symmetrize,
+    )
+    if res["flags"] == 0:
+        _fit_obs(
+            res=res,
+            obs=obs,
+            fitter=fitter,
+            psf_res_cache=psf_res_cache,
+        )
+    return res
 
-def _fit_obs(
-    *,
-    obs,
-    fitter,
-    bmask_flags,
-    symmetrize,
-):
-    if isinstance(fitter, ngmix.prepsfmom.PrePSFMom):
-        psf_go_kwargs = {"no_psf": True}
-    else:
-        psf_go_kwargs = {}
 
+def _prep_obslist(*, obslist, bmask_flags, symmetrize):
+    """Check the data in the obslist and compute the weight for the band.
+
+    The returned observation has symmetrized weights if requested. It is None
+    if the band should not be fit, in which case the flags are set.
+    """
     res = {}
-    flags = 0
+    res["flags"] = 0
+    res["wgt"] = 0
+    res["obj_res"] = None
+    res["psf_res"] = None
+
+    if len(obslist) == 0:
+        # we will flag this later
+        res["flags"] |= procflags.MISSING_BAND
+        return res, None
+
+    obs = obslist[0]
+    flags = get_obs_flags(obs, bmask_flags=bmask_flags)
+    if flags != 0 and ((flags & procflags.ZERO_WEIGHTS) != 0 or not symmetrize):
+        # symmetrizing the weights cannot change these flags
+        res["flags"] |= flags
+        return res, None
 
     if symmetrize:
-        obs = symmetrize_obs_weights(obs)
+        obs = get_symmetrized_obs(obs)
 
-    if not np.any(obs.weight > 0):
-        flags |= procflags.ZERO_WEIGHTS
+    obs_stats = get_obs_stats(obs)
+    if not obs_stats["any_pos_weight"]:
+        res["flags"] |= procflags.ZERO_WEIGHTS
 
-    if np.any((obs.bmask & bmask_flags) != 0):
-        flags |= procflags.EDGE_HIT
+    if (obs_stats["bmask_or"] & bmask_flags) != 0:
+        res["flags"] |= procflags.EDGE_HIT
 
-    if flags != 0:
+    if res["flags"] != 0:
         # we will flag this later
-        res["flags"] = flags
-        res["wgt"] = 0
-        res["obj_res"] = None
-        res["psf_res"] = None
+        return res, None
+
+    res["wgt"] = obs_stats["median_weight"]
+    return res, obs
+
+
+def _fit_obs(*, res, obs, fitter, psf_res_cache=None):
+    if isinstance(fitter, ngmix.prepsfmom.PrePSFMom):
+        psf_go_kwargs = {"no_psf": True}
     else:
-        res["flags"] = flags
-        res["wgt"] = np.median(obs.weight[obs.weight > 0])
-        res["obj_res"] = fitter.go(obs)
-        res["psf_res"] = fitter.go(obs.psf, **psf_go_kwargs)
+        psf_go_kwargs = {}
+
+    res["obj_res"] = fitter.go(obs)
+    res["psf_res"] = _fit_psf_obs(
+        psf_obs=obs.psf,
+        fitter=fitter,
+        psf_go_kwargs=psf_go_kwargs,
+        psf_res_cache=psf_res_cache,
+    )
 
-        if fitter.kind == "am" and MOMNAME == "mom":
-            res["obj_res"]["mom"] = res["obj_res"]["sums"]
-            res["obj_res"]["mom_cov"] = res["obj_res"]["sums_cov"]
-            res["psf_res"]["mom"] = res["psf_res"]["sums"]
-            res["psf_res"]["mom_cov"] = res["psf_res"]["sums_cov"]
+    if fitter.kind == "am" and MOMNAME == "mom":
+        res["obj_res"]["mom"] = res["obj_res"]["sums"]
+        res["obj_res"]["mom_cov"] = res["obj_res"]["sums_cov"]
+        res["psf_res"]["mom"] = res["psf_res"]["sums"]
+        res["psf_res"]["mom_cov"] = res["psf_res"]["sums_cov"]
 
-        if res["obj_res"]["flags"] != 0:
-            logger.debug("per band fitter failed: %s" % res["obj_res"]['flagstr'])
+    _log_fit_failures(res)
 
-        if res["psf_res"]["flags"] != 0:
-            logger.debug("per band psf fitter failed: %s" % res["psf_res"]['flagstr'])
 
-    return res
+def _log_fit_failures(res):
+    if res["obj_res"]["flags"] != 0:
+        logger.debug("per band fitter failed: %s" % res["obj_res"]['flagstr'])
+
+    if res["psf_res"]["flags"] != 0:
+        logger.debug("per band psf fitter failed: %s" % res["psf_res"]['flagstr'])
+
+
+def _fit_psf_obs(*, psf_obs, fitter, psf_go_kwargs, psf_res_cache):
+    """Run the fitter on the PSF observation, reusing the result from
+    `psf_res_cache` for PSF observations with identical content.
+
+    The stamps for all objects in a band usually have copies of the same PSF
+    image, so the PSF result only needs to be computed once per band.
+    """
+    if psf_res_cache is None:
+        return fitter.go(psf_obs, **psf_go_kwargs)
+
+    # we keep a reference to the fitter in the cache so that its id cannot be
+    # reused by another fitter
+    key = (id(fitter), _get_psf_obs_hash(psf_obs))
+    if key in psf_res_cache:
+        _fitter, psf_res = psf_res_cache[key]
+        if _fitter is fitter:
+            return psf_res
+
+    psf_res = fitter.go(psf_obs, **psf_go_kwargs)
+    psf_res_cache[key] = (fitter, psf_res)
+    return psf_res
+
+
+def _fit_psf_obs_batch_multi(
+    *, psf_obs_list, fitters, psf_res_cache, fourier_cache=None,
+):
+    """Measure the PSF observations with `measure_moments_batch_multi`, measuring
+    each distinct PSF only once and reusing the results from `psf_res_cache`."""
+    psf_hashes = [_get_psf_obs_hash(psf_obs) for psf_obs in psf_obs_list]
+
+    new_obs = {}
+    for psf_hash, psf_obs in zip(psf_hashes, psf_obs_list):
+        if all(
+            (id(fitter), psf_hash) in psf_res_cache
+            and psf_res_cache[(id(fitter), psf_hash)][0] is fitter
+            for fitter in fitters
+        ):
+            continue
+        new_obs.setdefault(psf_hash, psf_obs)
+
+    if len(new_obs) > 0:
+        # we never deconvolve the PSF from itself
+        new_res = measure_moments_batch_multi(
+            fitters=fitters,
+            obs_list=list(new_obs.values()),
+            no_psf=True,
+            fourier_cache=fourier_cache,
+        )
+        for fitter, _new_res in zip(fitters, new_res):
+            for psf_hash, psf_res in zip(new_obs, _new_res):
+                psf_res_cache[(id(fitter), psf_hash)] = (fitter, psf_res)
+
+    return [
+        [psf_res_cache[(id(fitter), psf_hash)][1] for psf_hash in psf_hashes]
+        for fitter in fitters
+    ]
+
+
+def _get_psf_obs_hash(psf_obs):
+    # the hash is kept with the observation so that PSF observations shared
+    # by many stamps are only hashed once
+    jac = psf_obs.jacobian
+    jac_pars = np.array(
+        list(jac.get_cen()) + [
+            jac.dudrow, jac.dudcol, jac.dvdrow, jac.dvdcol,
+        ],
+        dtype="f8",
+    )
+    cache = get_obs_cache(psf_obs)
+    if "psf_hash" in cache and np.array_equal(cache["psf_hash"][0], jac_pars):
+        return cache["psf_hash"][1]
+
+    hsh = hashlib.sha1()
+    for arr in [psf_obs.image, psf_obs.weight]:
+        hsh.update(str((arr.shape, arr.dtype.str)).encode("ascii"))
+        hsh.update(np.ascontiguousarray(arr).tobytes())
+    hsh.update(jac_pars.tobytes())
+    cache["psf_hash"] = (jac_pars, hsh.hexdigest())
+    return cache["psf_hash"][1]
 
 
 def _sum_bands_wavg(
@@ -1139,7 +2394,7 @@ def _make_mom_res(*, raw_mom, raw_mom_cov, raw_flux, raw_flux_var, fwhm_reg):
 
 def _combine_fit_results_wavg(
     *, all_res, all_psf_res, all_is_shear_band, all_wgts, model, all_flags, shear_bands,
-    fwhm_reg,
+    fwhm_reg, out=None,
 ):
     tot_nband = len(all_res)
     nband = (
@@ -1159,7 +2414,7 @@ def _combine_fit_results_wavg(
 
     n = Namer(front=model)
 
-    data = get_wavg_output_struct(tot_nband, model, shear_bands=shear_bands)
+    data = _get_wavg_output_row(out, tot_nband, model, shear_bands)
 
     if (
         tot_nband == 0
@@ -1304,6 +2559,342 @@ def _combine_fit_results_wavg(
     return data
 
 
+def combine_fit_results_wavg_arrays(
+    *, sums, sums_cov, sums_norm, psf_sums, psf_sums_cov, psf_sums_norm, wgts,
+    flags, band_flux, band_flux_err, band_flux_flags, model, shear_bands=None,
+    fwhm_reg=0,
+):
+    """Combine the per-band moments of many objects using a weighted average
+    over bands.
+
+    This function is a vectorized version of the per-object combination done in
+    `fit_mbobs_wavg` and produces the same output columns. Bands with non-zero
+    `flags` are treated as not measured.
+
+    Parameters
+    ----------
+    sums : np.ndarray
+        The moment sums of the objects, shape (nobj, nband, 6).
+    sums_cov : np.ndarray
+        The covariances of the moment sums, shape (nobj, nband, 6, 6).
+    sums_norm : np.ndarray
+        The sums of the moments weight function, shape (nobj, nband). Use NaN if
+        the fitter does not report it.
+    psf_sums : np.ndarray
+        The moment sums of the PSFs, shape (nobj, nband, 6).
+    psf_sums_cov : np.ndarray
+        The covariances of the PSF moment sums, shape (nobj, nband, 6, 6).
+    psf_sums_norm : np.ndarray
+        The sums of the PSF moments weight function, shape (nobj, nband).
+    wgts : np.ndarray
+        The weight of each band, shape (nobj, nband).
+    flags : np.ndarray
+        The flags for each band, shape (nobj, nband).
+    band_flux : np.ndarray
+        The flux of each band, shape (nobj, nband).
+    band_flux_err : np.ndarray
+        The flux error of each band, shape (nobj, nband).
+    band_flux_flags : np.ndarray
+        The flux flags of each band, shape (nobj, nband).
+    model : str
+        The model or "kind" of fitter.
+    shear_bands : list of int, optional
+        A list of indices of the bands used for shear. Default is to use all
+        bands.
+    fwhm_reg : float, optional
+        The FWHM used to regularize the shapes. See `fit_mbobs_list_wavg`.
+        Default is 0.
+
+    Returns
+    -------
+    res : np.ndarray
+        A structured array of the fitting results, one per object.
+    """
+    wgts = np.asarray(wgts, dtype=np.float64)
+    flags = np.asarray(flags, dtype=np.int64)
+    nobj, tot_nband = wgts.shape
+
+    if shear_bands is None:
+        shear_bands = list(range(tot_nband))
+    is_shear_band = np.array(
+        [band in shear_bands for band in range(tot_nband)], dtype=bool,
+    )
+    nband = int(np.sum(is_shear_band))
+
+    n = Namer(front=model)
+
+    data = get_wavg_output_buffer(nobj, tot_nband, model, shear_bands=shear_bands)
+    if nobj == 0:
+        return data
+
+    if tot_nband == 0 or nband == 0:
+        psf_flags = np.full(nobj, procflags.MISSING_BAND, dtype=np.int64)
+        mdet_flags = np.full(nobj, procflags.MISSING_BAND, dtype=np.int64)
+        flux_flags = np.full(
+            (nobj, tot_nband), procflags.MISSING_BAND, dtype=np.int64,
+        )
+        band_flux = np.full((nobj, tot_nband), np.nan)
+        band_flux_err = np.full((nobj, tot_nband), np.nan)
+    else:
+        sum_data = _sum_bands_wavg_arrays(
+            sums=sums,
+            sums_cov=sums_cov,
+            sums_norm=sums_norm,
+            is_shear_band=is_shear_band,
+            wgts=wgts,
+            flags=flags,
+        )
+        mdet_flags = sum_data["final_flags"].copy()
+
+        psf_sum_data = _sum_bands_wavg_arrays(
+            sums=psf_sums,
+            sums_cov=psf_sums_cov,
+            sums_norm=psf_sums_norm,
+            is_shear_band=is_shear_band,
+            wgts=wgts,
+            flags=flags,
+            wgt_sums=sums,
+            wgt_sums_norm=sums_norm,
+        )
+        psf_flags = psf_sum_data["final_flags"].copy()
+
+        # the objects and PSFs are measured in the same bands, so the bands used
+        # in the two sums are always consistent
+        has_res = flags == 0
+        flux_flags = flags | np.where(
+            has_res,
+            np.asarray(band_flux_flags, dtype=np.int64),
+            procflags.MISSING_BAND,
+        )
+        band_flux = np.where(has_res, band_flux, np.nan)
+        band_flux_err = np.where(has_res, band_flux_err, np.nan)
+
+    psf_ok = psf_flags == 0
+    if np.any(psf_ok):
+        wgt_sum = psf_sum_data["wgt_sum"][psf_ok]
+        psf_momres = _make_mom_res_arrays(
+            raw_mom=psf_sum_data["raw_mom"][psf_ok] / wgt_sum[:, None],
+            raw_mom_cov=(
+                psf_sum_data["raw_mom_cov"][psf_ok] / (wgt_sum**2)[:, None, None]
+            ),
+            raw_flux=psf_sum_data["flux"][psf_ok] / wgt_sum,
+            raw_flux_var=psf_sum_data["flux_var"][psf_ok] / (wgt_sum**2),
+            fwhm_reg=0,
+        )
+        psf_flags[psf_ok] |= psf_momres["flags"]
+        data[n("psf_g")][psf_ok] = psf_momres["e"]
+        data[n("psf_T")][psf_ok] = psf_momres["T"]
+
+    mdet_ok = mdet_flags == 0
+    if np.any(mdet_ok):
+        wgt_sum = sum_data["wgt_sum"][mdet_ok]
+        momres = _make_mom_res_arrays(
+            raw_mom=sum_data["raw_mom"][mdet_ok] / wgt_sum[:, None],
+            raw_mom_cov=(
+                sum_data["raw_mom_cov"][mdet_ok] / (wgt_sum**2)[:, None, None]
+            ),
+            raw_flux=sum_data["flux"][mdet_ok] / wgt_sum,
+            raw_flux_var=sum_data["flux_var"][mdet_ok] / (wgt_sum**2),
+            fwhm_reg=fwhm_reg,
+        )
+        mdet_flags[mdet_ok] |= momres["flags"]
+        for col in ['s2n', 'T', 'T_err', 'T_flags']:
+            data[n(col)][mdet_ok] = momres[col]
+        for col in ['e', 'e_cov']:
+            data[n(col.replace('e', 'g'))][mdet_ok] = momres[col]
+
+        ratio_ok = mdet_ok & (psf_flags == 0)
+        data[n('T_ratio')][ratio_ok] = (
+            data[n('T')][ratio_ok] / data[n('psf_T')][ratio_ok]
+        )
+
+    mdet_flags[psf_flags != 0] |= procflags.PSF_FAILURE
+
+    if tot_nband > 1:
+        data[n('band_flux')] = band_flux
+        data[n('band_flux_err')] = band_flux_err
+        data[n('band_flux_flags')] = flux_flags
+    elif tot_nband == 1:
+        data[n('band_flux')] = band_flux[:, 0]
+        data[n('band_flux_err')] = band_flux_err[:, 0]
+        data[n('band_flux_flags')] = flux_flags[:, 0]
+    else:
+        data[n('band_flux_flags')] = procflags.MISSING_BAND
+
+    data[n('psf_flags')] = psf_flags
+    data[n('obj_flags')] = mdet_flags
+    data[n('flags')] = mdet_flags | np.bitwise_or.reduce(flux_flags, axis=1)
+
+    if np.any(data[n('flags')] != 0):
+        logger.debug(
+            "fitter failed for %d of %d objects",
+            np.sum(data[n('flags')] != 0),
+            nobj,
+        )
+
+    return data
+
+
+def _sum_bands_wavg_arrays(
+    *, sums, sums_cov, sums_norm, is_shear_band, wgts, flags, wgt_sums=None,
+    wgt_sums_norm=None,
+):
+    """A vectorized version of `_sum_bands_wavg` for the inputs to
+    `combine_fit_results_wavg_arrays`. The entries `wgt_sums` and `wgt_sums_norm`
+    take the place of the moments in `all_wgt_res`."""
+    sums = np.asarray(sums, dtype=np.float64)
+    sums_cov = np.asarray(sums_cov, dtype=np.float64)
+    sums_norm = np.asarray(sums_norm, dtype=np.float64)
+
+    has_res = flags == 0
+    issb = np.broadcast_to(is_shear_band[None, :], flags.shape)
+    used = issb & has_res
+
+    # the input flags mark very basic failures and are ORed across all bands
+    final_flags = np.bitwise_or.reduce(np.where(issb, flags, 0), axis=1)
+    final_flags[np.any(issb & ~has_res, axis=1)] |= procflags.MISSING_BAND
+    final_flags[np.any(issb & (wgts <= 0), axis=1)] |= procflags.ZERO_WEIGHTS
+
+    mom_norm = np.where(np.isfinite(sums_norm), sums_norm, 1.0)
+
+    flux_mom_ratio = np.ones_like(wgts)
+    if wgt_sums is not None:
+        wgt_sums = np.asarray(wgt_sums, dtype=np.float64)
+        wgt_sums_norm = np.asarray(wgt_sums_norm, dtype=np.float64)
+        both_norm = np.isfinite(sums_norm) & np.isfinite(wgt_sums_norm)
+        zero_flux = sums[..., 5] == 0
+        zero_wgt_norm = both_norm & (wgt_sums_norm == 0) & ~zero_flux
+        with np.errstate(divide="ignore", invalid="ignore"):
+            flux_mom_ratio = np.where(
+                both_norm,
+                wgt_sums[..., 5] / wgt_sums_norm / sums[..., 5] * sums_norm,
+                wgt_sums[..., 5] / sums[..., 5],
+            )
+        flux_mom_ratio[zero_flux | zero_wgt_norm] = 1.0
+        final_flags[
+            np.any(used & (zero_flux | zero_wgt_norm), axis=1)
+        ] |= procflags.ZERO_WEIGHTS
+
+    # the bands that are not used are zeroed so that missing values do not
+    # propagate into the sums
+    wgts = np.where(used, wgts, 0.0)
+    fac = np.where(used, wgts * flux_mom_ratio / mom_norm, 0.0)
+    sums = np.where(used[..., None], sums, 0.0)
+    sums_cov = np.where(used[..., None, None], sums_cov, 0.0)
+
+    wgt_sum = np.sum(wgts, axis=1)
+    final_flags[np.any(used, axis=1) & (wgt_sum <= 0)] |= procflags.ZERO_WEIGHTS
+
+    return dict(
+        raw_mom=np.sum(fac[..., None] * sums, axis=1),
+        raw_mom_cov=np.sum((fac**2)[..., None, None] * sums_cov, axis=1),
+        wgt_sum=wgt_sum,
+        final_flags=final_flags,
+        flux=np.sum(wgts * sums[..., 5], axis=1),
+        flux_var=np.sum(wgts**2 * sums_cov[..., 5, 5], axis=1),
+    )
+
+
+def _make_mom_res_arrays(*, raw_mom, raw_mom_cov, raw_flux, raw_flux_var, fwhm_reg):
+    """A vectorized version of `_make_mom_res` that returns only the columns used
+    for the weighted average outputs."""
+    momres_t = _make_mom_result_arrays(raw_mom, raw_mom_cov)
+
+    if fwhm_reg > 0:
+        T_reg = fwhm_to_T(fwhm_reg)
+
+        # see _make_mom_res for the details
+        amat = np.eye(6)
+        amat[4, 5] = T_reg
+
+        nan_cen = np.isnan(raw_mom)
+        nan_cen[:, 2:] = False
+        reg_mom = np.where(nan_cen, 0, raw_mom)
+        reg_mom = np.matmul(reg_mom, amat.T)
+        reg_mom[nan_cen] = np.nan
+
+        reg_mom_cov = np.matmul(amat, np.matmul(raw_mom_cov, amat.T))
+        momres = _make_mom_result_arrays(reg_mom, reg_mom_cov)
+
+        # use old T
+        for col in ["T", "T_err", "T_flags"]:
+            momres[col] = momres_t[col]
+        momres["flags"] |= momres_t["flags"]
+    else:
+        momres = momres_t
+
+    momres["flags"][raw_flux <= 0] |= ngmix.flags.NONPOS_FLUX
+
+    pos_var = raw_flux_var > 0
+    momres["s2n"] = np.full_like(raw_flux, np.nan)
+    momres["s2n"][pos_var] = raw_flux[pos_var] / np.sqrt(raw_flux_var[pos_var])
+    momres["flags"][~pos_var] |= ngmix.flags.NONPOS_VAR
+
+    return momres
+
+
+def _make_mom_result_arrays(sums, sums_cov):
+    """A vectorized version of the shape and size parts of
+    `ngmix.moments.make_mom_result`."""
+    nobj = sums.shape[0]
+    diag = np.diagonal(sums_cov, axis1=1, axis2=2)
+    flux = sums[:, 5]
+    msum = sums[:, 4]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pos_flux = flux > 0
+        pos_T_var = np.all(diag[:, 4:] > 0, axis=1)
+        T_ok = pos_T_var & pos_flux
+        T = np.full(nobj, np.nan)
+        T[T_ok] = msum[T_ok] / flux[T_ok]
+        T_err = np.full(nobj, np.nan)
+        T_err[T_ok] = _get_ratio_error_arrays(
+            msum, flux, diag[:, 4], diag[:, 5], sums_cov[:, 4, 5],
+        )[T_ok]
+        T_flags = np.where(
+            pos_T_var,
+            np.where(pos_flux, 0, ngmix.flags.NONPOS_FLUX),
+            ngmix.flags.NONPOS_VAR,
+        ).astype(np.int64)
+
+        pos_var = np.all(diag[:, 2:] > 0, axis=1)
+        pos_size = msum > 0
+        flags = np.where(
+            pos_var,
+            np.where(
+                pos_flux,
+                np.where(pos_size, 0, ngmix.flags.NONPOS_SIZE),
+                ngmix.flags.NONPOS_FLUX,
+            ),
+            ngmix.flags.NONPOS_VAR,
+        ).astype(np.int64)
+
+        e_ok = pos_var & pos_flux & pos_size
+        e = np.full((nobj, 2), np.nan)
+        e[e_ok] = sums[e_ok, 2:4] / msum[e_ok, None]
+        e_err = np.full((nobj, 2), np.nan)
+        for i in range(2):
+            e_err[e_ok, i] = _get_ratio_error_arrays(
+                sums[:, 2 + i], msum, diag[:, 2 + i], diag[:, 4],
+                sums_cov[:, 2 + i, 4],
+            )[e_ok]
+
+    e_cov = np.zeros((nobj, 2, 2))
+    e_cov[:, 0, 0] = e_err[:, 0]**2
+    e_cov[:, 1, 1] = e_err[:, 1]**2
+
+    return dict(
+        flags=flags, T=T, T_err=T_err, T_flags=T_flags, e=e, e_cov=e_cov,
+    )
+
+
+def _get_ratio_error_arrays(a, b, var_a, var_b, cov_ab):
+    rsq = (a / b)**2
+    var = rsq * (var_a / a**2 + var_b / b**2 - 2 * cov_ab / (a * b))
+    var[var < 0] = 0
+    return np.sqrt(var)
+
+
 def get_wavg_output_struct(nband, model, shear_bands=None):
     """
     make an output struct with default values set
@@ -1326,6 +2917,45 @@ def get_wavg_output_struct(nband, model, shear_bands=None):
     -------
     ndarray with fields
     """
+    return get_wavg_output_buffer(1, nband, model, shear_bands=shear_bands)
+
+
+def get_wavg_output_buffer(nobj, nband, model, shear_bands=None):
+    """
+    make an output array for nobj objects with default values set
+
+    The dtype and default values are computed once per set of inputs and
+    cached. See `get_wavg_output_struct` for the default values.
+
+    Parameters
+    ----------
+    nobj: int
+        Number of objects
+    nband: int
+        Number of bands
+    model: str
+        The model or "kind" of fitter
+    shear_bands : list of int, optional
+        A list of indices into each mbobs that denotes which band is used for shear.
+        If given, these are added to the output as a shear_bands field. If not given,
+        this field is left empty.
+
+    Returns
+    -------
+    ndarray with fields
+    """
+    return np.repeat(
+        _get_wavg_output_template(
+            nband,
+            model,
+            tuple(shear_bands) if shear_bands is not None else None,
+        ),
+        nobj,
+    )
+
+
+@functools.lru_cache(maxsize=128)
+def _get_wavg_output_template(nband, model, shear_bands):
     dt = _make_combine_fit_results_wavg_dtype(
         nband=nband, model=model, shear_bands=shear_bands
     )
@@ -1344,12 +2974,41 @@ def get_wavg_output_struct(nband, model, shear_bands=None):
             data[name] = np.nan
 
     if shear_bands is not None:
-        assert len(shear_bands) <= MAX_NUM_SHEAR_BANDS
-        data["shear_bands"] = "".join("%s" % b for b in sorted(shear_bands))
+        data["shear_bands"] = _get_shear_bands_str(shear_bands)
 
+    # this array is shared so we make sure it is not modified
+    data.flags.writeable = False
     return data
 
 
+def _get_shear_bands_str(shear_bands):
+    assert len(shear_bands) <= MAX_NUM_SHEAR_BANDS
+    return "".join("%s" % b for b in sorted(shear_bands))
+
+
+def _get_wavg_output_row(out, nband, model, shear_bands):
+    if out is None:
+        return get_wavg_output_struct(nband, model, shear_bands=shear_bands)
+
+    if shear_bands is not None:
+        out["shear_bands"] = _get_shear_bands_str(shear_bands)
+    return out
+
+
+def _get_mbobs_list_output_buffer(mbobs_list, model, shear_bands):
+    """Allocate the output for the objects in `mbobs_list`, or return None if the
+    objects do not all have the same number of bands."""
+    nband = len(mbobs_list[0])
+    if any(len(mbobs) != nband for mbobs in mbobs_list):
+        return None
+
+    if shear_bands is None:
+        shear_bands = list(range(nband))
+    return get_wavg_output_buffer(
+        len(mbobs_list), nband, model, shear_bands=shear_bands,
+    )
+
+
 def _make_combine_fit_results_wavg_dtype(nband, model, shear_bands):
     n = Namer(front=model)
     dt = [
@@ -1398,13 +3057,10 @@ def symmetrize_obs_weights(obs):
         A copy of the input observation with a symmetrized weight map.
     """
     sym_obs = obs.copy()
-    if np.any(obs.weight <= 0):
-        new_wgt = obs.weight.copy()
-        for k in [1, 2, 3]:
-            msk = np.rot90(obs.weight, k=k) <= 0
-            new_wgt[msk] = 0
+    if not get_obs_stats(obs)["all_pos_weight"]:
+        new_wgt = _symmetrize_weight(obs.weight)
 
-        with sym_obs.writeable():
+        with writeable(sym_obs):
             if not np.any(new_wgt > 0):
                 sym_obs.ignore_zero_weight = False
             sym_obs.weight[:, :] = new_wgt
@@ -1412,13 +3068,120 @@ def symmetrize_obs_weights(obs):
     return sym_obs
 
 
-def combine_fit_res(all_res):
+def get_symmetrized_obs(obs):
+    """Get an observation with 4-fold symmetry applied to its zero weight pixels.
+
+    Unlike `symmetrize_obs_weights`, the input observation is returned as is if
+    all of its weights are positive. Otherwise a new observation that shares
+    all of the data of the input except for the weight map is made once and kept
+    with `get_obs_cache`, so that it is shared by all of the fitters. The
+    returned observation must not be modified.
+
+    Parameters
+    ----------
+    obs : ngmix.Observation
+        The observation to symmetrize.
+
+    Returns
+    -------
+    sym_obs : ngmix.Observation
+        The input observation or an observation with a symmetrized weight map.
+    """
+    if get_obs_stats(obs)["all_pos_weight"]:
+        return obs
+
+    cache = get_obs_cache(obs)
+    if "sym_obs" not in cache:
+        new_wgt = _symmetrize_weight(obs.weight)
+
+        kwargs = {}
+        for name in ["bmask", "ormask", "noise", "mfrac", "psf", "gmix"]:
+            if getattr(obs, "has_" + name)():
+                kwargs[name] = getattr(obs, name)
+
+        cache["sym_obs"] = ngmix.Observation(
+            image=obs.image,
+            weight=new_wgt,
+            jacobian=obs.jacobian,
+            meta=obs.meta,
+            ignore_zero_weight=(
+                obs.ignore_zero_weight and bool(np.any(new_wgt > 0))
+            ),
+            **kwargs,
+        )
+
+    return cache["sym_obs"]
+
+
+def _symmetrize_weight(weight):
+    if weight.ndim != 2 or weight.shape[0] != weight.shape[1]:
+        raise ValueError("Only square weight maps can be symmetrized!")
+
+    new_wgt = np.empty_like(weight)
+    _symmetrize_weight_nb(weight, new_wgt)
+    return new_wgt
+
+
+@njit
+def _symmetrize_weight_nb(weight, new_wgt):
+    # a pixel is zeroed if any of its other rotations by 90 degrees has zero weight
+    n = weight.shape[0]
+    for i in range(n):
+        for j in range(n):
+            if (
+                weight[j, n - 1 - i] <= 0
+                or weight[n - 1 - i, n - 1 - j] <= 0
+                or weight[n - 1 - j, i] <= 0
+            ):
+                new_wgt[i, j] = 0
+            else:
+                new_wgt[i, j] = weight[i, j]
+
+
+def get_fit_res_dtype(*, models, nband):
+    """Get the dtype of the combined fit results for a set of fitters.
+
+    The dtype is the same as that of the output of `combine_fit_res` for the
+    results of the fitters, so that the output can be allocated before
+    the fitters are run.
+
+    Parameters
+    ----------
+    models : list of str
+        The model or "kind" of each fitter. The joint fitters use "gauss" and
+        "am".
+    nband : int
+        Number of bands.
+
+    Returns
+    -------
+    dt : list
+        The dtype as a list of tuples.
+    """
+    # the shared columns are kept with the first fitter just like in the
+    # output of combine_fit_res
+    dt = []
+    for i, model in enumerate(models):
+        for descr in _make_combine_fit_results_wavg_dtype(
+            nband=nband, model=model, shear_bands=None,
+        ):
+            if i == 0 or descr[0] != "shear_bands":
+                dt.append(descr)
+
+    return dt
+
+
+def combine_fit_res(all_res, out=None):
     """Combine fit result data structures.
 
     Parameters
     ----------
     all_res : list of np.ndarray
         The list of structured array results.
+    out : np.ndarray, optional
+        If given, the results are written into this array and it is returned.
+        It must have the same length as the results and contain all of their
+        columns. See `get_fit_res_dtype`. Default of None allocates a new array.
 
     Returns
     -------
@@ -1426,7 +3189,7 @@ def combine_fit_res(all_res):
         The combined results list.
     """
 
-    if len(all_res) == 1:
+    if len(all_res) == 1 and out is None:
         return all_res[0]
 
     dupe_cols = [
@@ -1459,7 +3222,14 @@ def combine_fit_res(all_res):
                     )
 
     if nobj > 0:
-        res = np.zeros(nobj, dtype=dt)
+        if out is not None:
+            if out.shape[0] != nobj:
+                raise RuntimeError(
+                    "The output must be the same length as the fit results!"
+                )
+            res = out
+        else:
+            res = np.zeros(nobj, dtype=dt)
         for i, _res in enumerate(all_res):
             for col in _res.dtype.names:
                 if col in dupe_cols:
@@ -1477,6 +3247,6 @@ def combine_fit_res(all_res):
         return res
     else:
         if any(_res is not None for _res in all_res):
-            return np.zeros(0, dtype=dt)
+            return np.zeros(0, dtype=dt if out is None else out.dtype)
         else:
             return None
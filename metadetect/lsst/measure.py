@@ -20,7 +20,7 @@ from lsst.pex.exceptions import (
 from ..procflags import (
     EDGE_HIT, ZERO_WEIGHTS, CENTROID_FAILURE, NO_ATTEMPT,
 )
-from ..fitting import fit_mbobs_wavg, get_wavg_output_struct
+from ..fitting import fit_mbobs_wavg, get_wavg_output_buffer
 
 from . import util
 from .util import ContextNoiseReplacer
@@ -220,17 +220,25 @@ def measure(
     nband = len(mbexp.filters)
     exp_bbox = mbexp.getBBox()
     wcs = mbexp.singles[0].getWcs()
-    results = []
 
     # bmasks will be different within the loop below due to the replacer
     bmasks = get_bmasks(sources=sources, exposure=detexp)
 
-    for i, source in enumerate(sources):
+    inds = [
+        i for i, source in enumerate(sources)
+        if source.get('deblend_nChild') == 0
+    ]
+    if len(inds) == 0:
+        return None
 
-        if source.get('deblend_nChild') != 0:
-            continue
+    # the results are written into a single array that we allocate up front
+    results = get_output_buffer(nobj=len(inds), nband=nband, model=fitter.kind)
+    default_res = results[0:1].copy()
 
+    for iobj, i in enumerate(inds):
+        source = sources[i]
         bmask = bmasks[i]
+        this_res = results[iobj:iobj + 1]
 
         flags = 0
         try:
@@ -239,11 +247,12 @@ def measure(
             )
 
             # TODO do something with bmask_flags?
-            this_res = fit_mbobs_wavg(
+            fit_mbobs_wavg(
                 mbobs=mbobs,
                 fitter=fitter,
                 bmask_flags=0,
                 fwhm_reg=fwhm_reg,
+                out=this_res,
             )
         except LengthError as err:
             # This is raised when a bbox hits an edge
@@ -259,21 +268,14 @@ def measure(
             flags = CENTROID_FAILURE
 
         if flags != 0:
-            this_res = get_wavg_output_struct(nband=nband, model=fitter.kind)
+            this_res[:] = default_res
             this_res[fitter.kind + '_flags'] = flags
 
-        res = get_output(
-            wcs=wcs, source=source, res=this_res,
+        _set_output(
+            output=this_res, wcs=wcs, source=source,
             bmask=bmask, stamp_size=stamp_size, exp_bbox=exp_bbox,
         )
 
-        results.append(res)
-
-    if len(results) > 0:
-        results = eu.numpy_util.combine_arrlist(results)
-    else:
-        results = None
-
     return results
 
 
@@ -672,6 +674,28 @@ def get_output_struct(res):
     return output
 
 
+def get_output_buffer(nobj, nband, model):
+    """
+    get an output array for nobj objects with default values set
+
+    Parameters
+    ----------
+    nobj: int
+        The number of objects
+    nband: int
+        The number of bands
+    model: str
+        The model or "kind" of fitter
+
+    Returns
+    -------
+    ndarray
+        Has the fields from metadetect.fitting.get_wavg_output_buffer, with new
+        fields added, see get_output_dtype
+    """
+    return get_output_struct(get_wavg_output_buffer(nobj, nband, model))
+
+
 def get_output(wcs, source, res, bmask, stamp_size, exp_bbox):
     """
     get the output structure, copying in results
@@ -698,9 +722,19 @@ def get_output(wcs, source, res, bmask, stamp_size, exp_bbox):
     ndarray
         Has the fields from res, with new fields added, see get_output_dtype
     """
-    import lsst.afw.image as afw_image
-
     output = get_output_struct(res)
+    _set_output(
+        output=output, wcs=wcs, source=source, bmask=bmask,
+        stamp_size=stamp_size, exp_bbox=exp_bbox,
+    )
+    return output
+
+
+def _set_output(*, output, wcs, source, bmask, stamp_size, exp_bbox):
+    """
+    copy the source information into the output, see get_output
+    """
+    import lsst.afw.image as afw_image
 
     orig_cen = source.getCentroid()
 
@@ -734,8 +768,6 @@ def get_output(wcs, source, res, bmask, stamp_size, exp_bbox):
     detected = afw_image.Mask.getPlaneBitMask('DETECTED')
     output['bmask'] = bmask & ~detected
 
-    return output
-
 
 class MissingDataError(Exception):
     """
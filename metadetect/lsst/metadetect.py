@@ -1,5 +1,6 @@
 import logging
 import numpy as np
+from numba import njit
 import ngmix
 from ngmix.gexceptions import BootPSFFailure
 
@@ -231,54 +232,80 @@ def measure_weighted_mfrac(
     if fwhm is None:
         fwhm = 1.2
 
-    ny, nx = mfrac.shape
-
-    gauss_wgt = ngmix.GMixModel(
-        [0, 0, 0, 0, ngmix.moments.fwhm_to_T(fwhm), 1],
-        'gauss',
-    )
     sigma = ngmix.moments.fwhm_to_sigma(fwhm)
     box_rad = int(round(sigma * 5))
 
-    mfracs = []
-    for i in range(x.shape[0]):
-        ix = int(np.floor(x[i] + 0.5))
-        iy = int(np.floor(y[i] + 0.5))
+    mfracs = np.zeros(x.shape[0])
+    _measure_weighted_mfrac_nb(
+        mfrac=np.asarray(mfrac, dtype=np.float64),
+        x=np.asarray(x, dtype=np.float64),
+        y=np.asarray(y, dtype=np.float64),
+        dvdrow=jac.dvdrow,
+        dvdcol=jac.dvdcol,
+        dudrow=jac.dudrow,
+        dudcol=jac.dudcol,
+        T=ngmix.moments.fwhm_to_T(fwhm),
+        box_rad=box_rad,
+        mfracs=mfracs,
+    )
+    return mfracs
 
-        xstart = ix - box_rad
-        xend = ix + box_rad + 1
-        ystart = iy - box_rad
-        yend = iy + box_rad + 1
-
-        if xstart < 0:
-            xstart = 0
-        if ystart < 0:
-            ystart = 0
-        if xend > nx:
-            xend = nx
-        if yend > ny:
-            yend = ny
-
-        sub_mfrac = mfrac[xstart:xend, ystart:yend]
-        if sub_mfrac.size == 0:
-            mfracs.append(1.0)
-        else:
-            cy, cx = (y[i] - ystart, x[i] - xstart)
-            this_jac = jac.copy()
-            this_jac.set_cen(row=cy, col=cx)
 
-            obs = ngmix.Observation(
-                image=sub_mfrac,
-                jacobian=this_jac,
-            )
+@njit
+def _measure_weighted_mfrac_nb(
+    mfrac, x, y, dvdrow, dvdcol, dudrow, dudcol, T, box_rad, mfracs,
+):
+    """
+    fill mfracs with the Gaussian-weighted averages of mfrac at each position
 
-            stats = gauss_wgt.get_weighted_sums(obs, maxrad=box_rad)
+    This is the same computation as ngmix.GMix.get_weighted_sums with the
+    image and Jacobian of each box, where the box is clipped as done
+    previously with the x and y ranges applied to the rows and columns
+    of mfrac respectively.
+    """
+    ny, nx = mfrac.shape
+    maxrad2 = box_rad**2
 
-            # this is the weighted average in the image using the
-            # Gaussian as the weight.
-            mfracs.append(stats["sums"][5] / stats["wsum"])
+    for i in range(x.shape[0]):
+        ix = int(np.floor(x[i] + 0.5))
+        iy = int(np.floor(y[i] + 0.5))
 
-    return np.array(mfracs)
+        xstart = max(ix - box_rad, 0)
+        xend = min(ix + box_rad + 1, nx)
+        ystart = max(iy - box_rad, 0)
+        yend = min(iy + box_rad + 1, ny)
+
+        # this matches slicing the array as mfrac[xstart:xend, ystart:yend]
+        rstart = min(xstart, ny)
+        rend = min(max(xend, rstart), ny)
+        cstart = min(ystart, nx)
+        cend = min(max(yend, cstart), nx)
+
+        if rend <= rstart or cend <= cstart:
+            mfracs[i] = 1.0
+            continue
+
+        cy = y[i] - ystart
+        cx = x[i] - xstart
+
+        wsum = 0.0
+        mfrac_sum = 0.0
+        for row in range(rstart, rend):
+            drow = row - rstart - cy
+            for col in range(cstart, cend):
+                dcol = col - cstart - cx
+                v = dvdrow * drow + dvdcol * dcol
+                u = dudrow * drow + dudcol * dcol
+                rad2 = u * u + v * v
+                if rad2 < maxrad2:
+                    weight = np.exp(-rad2 / T)
+                    wsum += weight
+                    mfrac_sum += weight * mfrac[row, col]
+
+        if wsum > 0:
+            mfracs[i] = mfrac_sum / wsum
+        else:
+            mfracs[i] = np.nan
 
 
 def add_ormask(ormask, res):
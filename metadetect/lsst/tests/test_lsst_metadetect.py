@@ -9,7 +9,9 @@ import logging
 import ngmix
 import metadetect
 from metadetect import procflags
-from metadetect.lsst.metadetect import run_metadetect, get_fitter
+from metadetect.lsst.metadetect import (
+    run_metadetect, get_fitter, measure_weighted_mfrac,
+)
 from metadetect.lsst.configs import get_config
 from metadetect.lsst import util
 import descwl_shear_sims
@@ -461,6 +463,60 @@ def test_lsst_metadetect_mfrac_ormask(show=False):
             assert np.any(res[shear]["ormask"] & flag != 0)
 
 
+def _measure_weighted_mfrac_loop(*, mfrac, x, y, jac, fwhm):
+    # the original per-source implementation with ngmix observations
+    ny, nx = mfrac.shape
+
+    gauss_wgt = ngmix.GMixModel(
+        [0, 0, 0, 0, ngmix.moments.fwhm_to_T(fwhm), 1],
+        'gauss',
+    )
+    sigma = ngmix.moments.fwhm_to_sigma(fwhm)
+    box_rad = int(round(sigma * 5))
+
+    mfracs = []
+    for i in range(x.shape[0]):
+        ix = int(np.floor(x[i] + 0.5))
+        iy = int(np.floor(y[i] + 0.5))
+
+        xstart = max(ix - box_rad, 0)
+        xend = min(ix + box_rad + 1, nx)
+        ystart = max(iy - box_rad, 0)
+        yend = min(iy + box_rad + 1, ny)
+
+        sub_mfrac = mfrac[xstart:xend, ystart:yend]
+        if sub_mfrac.size == 0:
+            mfracs.append(1.0)
+        else:
+            this_jac = jac.copy()
+            this_jac.set_cen(row=y[i] - ystart, col=x[i] - xstart)
+            obs = ngmix.Observation(image=sub_mfrac, jacobian=this_jac)
+            stats = gauss_wgt.get_weighted_sums(obs, maxrad=box_rad)
+            mfracs.append(stats["sums"][5] / stats["wsum"])
+
+    return np.array(mfracs)
+
+
+@pytest.mark.parametrize('fwhm', [None, 0.8, 2.0])
+def test_lsst_measure_weighted_mfrac(fwhm):
+    rng = np.random.RandomState(seed=31)
+
+    mfrac = rng.uniform(size=(70, 70))
+    x = rng.uniform(size=100, low=0, high=70)
+    y = rng.uniform(size=100, low=0, high=70)
+    jac = ngmix.Jacobian(
+        row=35, col=35,
+        dudcol=0.2, dudrow=0.005,
+        dvdcol=-0.004, dvdrow=0.21,
+    )
+
+    mfracs = measure_weighted_mfrac(mfrac=mfrac, x=x, y=y, jac=jac, fwhm=fwhm)
+    expected = _measure_weighted_mfrac_loop(
+        mfrac=mfrac, x=x, y=y, jac=jac, fwhm=1.2 if fwhm is None else fwhm,
+    )
+    np.testing.assert_allclose(mfracs, expected, atol=1e-5)
+
+
 if __name__ == '__main__':
     # test_lsst_metadetect_am()
     test_lsst_masked_as_bright(show=True)
@@ -1,6 +1,7 @@
 from numba import njit
 import numpy as np
 from .interpolate import interpolate_image_at_mask
+from .util import writeable
 
 
 @njit
@@ -44,7 +45,7 @@ def apply_apodization_corrections(*, mbobs, ap_rad, mask_bit_val):
         for obslist in mbobs:
             for obs in obslist:
                 # the pixels list will be reset upon exiting
-                with obs.writeable():
+                with writeable(obs):
                     obs.image[msk] *= ap_mask[msk]
                     obs.noise[msk] *= ap_mask[msk]
                     obs.bmask[msk] |= mask_bit_val
@@ -167,7 +168,7 @@ def apply_foreground_masking_corrections(
         for obslist in mbobs:
             for obs in obslist:
                 # the pixels list will be reset upon exiting
-                with obs.writeable():
+                with writeable(obs):
                     obs.bmask |= expanded_bmask
 
 
@@ -204,7 +205,7 @@ def _apply_mask_interp(
         for obslist in mbobs:
             for obs in obslist:
                 # the pixels list will be reset upon exiting
-                with obs.writeable():
+                with writeable(obs):
                     obs.bmask |= fg_bmask
 
                     if hasattr(obs, "mfrac"):
@@ -277,7 +278,7 @@ def _apply_mask_apodize(
         for obslist in mbobs:
             for obs in obslist:
                 # the pixels list will be reset upon exiting
-                with obs.writeable():
+                with writeable(obs):
                     obs.image *= ap_mask
                     obs.noise *= ap_mask
                     obs.bmask[msk] |= mask_bit_val
@@ -1,5 +1,8 @@
+import copy
+import dataclasses
 import logging
 import time
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import ngmix
@@ -8,24 +11,86 @@ import esutil as eu
 
 from . import detect
 from . import fitting
+from . import moments
 from . import procflags
 from . import shearpos
-from .util import Namer
+from .util import Namer, get_obs_stats, obs_cache_scope
 from .mfrac import measure_mfrac
 from .fitting import (
     fit_mbobs_list_wavg,
+    fit_mbobs_list_wavg_multi,
     combine_fit_res,
     fit_mbobs_list_joint,
+    make_coadd_obs_list,
+    get_fit_guesses,
+    get_fit_res_dtype,
     MAX_NUM_SHEAR_BANDS,
 )
 
 logger = logging.getLogger(__name__)
 
+# the per-fitter options that can be given at the top level of the config
+# instead of in a list of fitters
+_FITTER_OPTIONS = [
+    "symmetrize", "coadd", "psf_fit_cache", "batch", "image_coadd", "guess_from",
+    "n_workers",
+]
+
+
+@dataclasses.dataclass
+class _FitterConfig:
+    """The configuration of one of the fitters, made from the config by
+    `Metadetect._set_fitter`.
+
+    Attributes
+    ----------
+    model : str
+        The model in the config.
+    fitter : ngmix fitter or str
+        The fitter for the weighted average fitters or the model name for the
+        joint fitters.
+    kind : str
+        The prefix of the columns of the fitter in the output.
+    fwhm : float
+        The FWHM of the weight function.
+    fwhm_reg : float
+        The FWHM used to regularize the moments, or zero.
+    is_wavg : bool
+        True for the weighted average fitters wmom, ksigma and pgauss.
+    symmetrize : bool
+        If True, the weight maps are symmetrized.
+    batch : bool
+        If True, the moments are measured in batch.
+    coadd : bool
+        If True, the bands are coadded for the gauss fitter.
+    psf_fit_cache : bool
+        If True, the PSF fits of the joint fitters are cached.
+    image_coadd : bool
+        If True, the stamps for the joint fitters are cut from a coadd image.
+    guess_from : str or None
+        The kind of the earlier fitter used for the initial guesses.
+    n_workers : int or None
+        The number of processes used for the joint fitters.
+    """
+    model: str
+    fitter: object
+    kind: str
+    fwhm: float
+    fwhm_reg: float = 0
+    is_wavg: bool = False
+    symmetrize: bool = True
+    batch: bool = False
+    coadd: bool = False
+    psf_fit_cache: bool = False
+    image_coadd: bool = False
+    guess_from: str = None
+    n_workers: int = None
+
 
 def do_metadetect(
     config, mbobs, rng, shear_band_combs=None,
     color_key_func=None, color_dep_mbobs=None,
-    det_band_combs=None,
+    det_band_combs=None, n_workers=None,
 ):
     """Run metadetect on the multi-band observations.
 
@@ -57,6 +122,11 @@ def do_metadetect(
     color_dep_mbobs: dict of mbobs, optional
         A dictionary of color-dependently rendered observations of the mbobs for use
         in color-dependent metadetect.
+    n_workers: int, optional
+        If not None, run the detection and measurements for each metacal type
+        with an independent random number stream and use a pool of this many
+        processes to do so. The results do not depend on the number of workers.
+        Default of None runs everything serially with `rng`.
 
     Returns
     -------
@@ -69,6 +139,7 @@ def do_metadetect(
         color_key_func=color_key_func,
         color_dep_mbobs=color_dep_mbobs,
         det_band_combs=det_band_combs,
+        n_workers=n_workers,
     )
     md.go()
     return md.result
@@ -127,6 +198,14 @@ class Metadetect(dict):
     color_dep_mbobs: dict of mbobs, optional
         A dictionary of color-dependently rendered observations of the mbobs for use
         in color-dependent metadetect.
+    n_workers: int, optional
+        If not None, run the detection and measurements for each metacal type
+        with an independent random number stream seeded from `rng` and use a
+        pool of this many processes to do so. The results do not depend on the
+        number of workers. Color-dependent metadetect always runs serially.
+        The joint fitters then fit their objects serially in each worker
+        instead of with pools of their own. Default of None runs everything
+        serially with `rng`.
     """
     def __init__(
         self, config, mbobs, rng, show=False,
@@ -134,8 +213,12 @@ class Metadetect(dict):
         color_key_func=None,
         color_dep_mbobs=None,
         det_band_combs=None,
+        n_workers=None,
     ):
         self._show = show
+        self._n_workers = n_workers
+        self._in_worker = False
+        self._joint_executor = None
 
         self._set_config(config)
         self.mbobs = mbobs
@@ -215,11 +298,7 @@ class Metadetect(dict):
             assert nepoch == 1, 'expected 1 epoch, got %d' % nepoch
 
             obs = obslist[0]
-            msk = obs.weight > 0
-            if not np.any(msk):
-                wgt = 0
-            else:
-                wgt = np.median(obs.weight[msk])
+            wgt = get_obs_stats(obs)["median_weight"]
             if hasattr(obs, "mfrac"):
                 mfrac += (obs.mfrac * wgt)
             wgts.append(wgt)
@@ -233,12 +312,11 @@ class Metadetect(dict):
 
     def _set_fitter(self):
         """
-        set the fitter to be used
+        set the fitters to be used, one _FitterConfig per fitter
         """
 
         def _get_fitter(cfg):
             model = cfg.get('model', 'wmom')
-            symmetrize = cfg.get("symmetrize", True)
 
             if "fwhm_smooth" in cfg.get("weight", {}):
                 kwargs = {"fwhm_smooth": cfg["weight"]["fwhm_smooth"]}
@@ -248,21 +326,18 @@ class Metadetect(dict):
             if model == 'wmom':
                 fitter = ngmix.gaussmom.GaussMom(fwhm=cfg["weight"]["fwhm"])
                 is_wavg = True
-                coadd = False
             elif model == 'ksigma':
                 fitter = ngmix.prepsfmom.KSigmaMom(
                     fwhm=cfg["weight"]["fwhm"],
                     **kwargs,
                 )
                 is_wavg = True
-                coadd = False
             elif model == "pgauss":
                 fitter = ngmix.prepsfmom.PGaussMom(
                     fwhm=cfg["weight"]["fwhm"],
                     **kwargs,
                 )
                 is_wavg = True
-                coadd = False
             elif model in ["admom", "am", "gauss"]:
                 # we pass the name to our codes
                 fitter = model
@@ -275,64 +350,75 @@ class Metadetect(dict):
                     cfg["weight"] = {}
                 if "fwhm" not in cfg["weight"]:
                     cfg["weight"]["fwhm"] = 1.2
-
-                coadd = cfg.get("coadd", False)
             else:
                 raise ValueError("bad model: '%s'" % model)
 
+            if is_wavg:
+                # the options of the joint fitters keep their defaults
+                opts = {}
+                batch = cfg.get("batch", False)
+                if batch and not moments.supports_batch(fitter):
+                    raise ValueError(
+                        "batch measurements are not supported for model '%s'" % model
+                    )
+            else:
+                opts = dict(
+                    coadd=cfg.get("coadd", False),
+                    psf_fit_cache=cfg.get("psf_fit_cache", False),
+                    image_coadd=cfg.get("image_coadd", False),
+                    guess_from=cfg.get("guess_from", None),
+                    n_workers=cfg.get("n_workers", None),
+                )
+                batch = model in ["admom", "am"] and cfg.get("batch", False)
+
             if "fwhm_reg" in cfg.get("weight", {}):
                 fwhm_reg = cfg["weight"]["fwhm_reg"]
                 fitter.kind = fitter.kind + "_reg%0.2f" % cfg["weight"]["fwhm_reg"]
             else:
                 fwhm_reg = 0
 
-            return (
-                model, fitter, cfg["weight"]["fwhm"], fwhm_reg,
-                is_wavg, symmetrize, coadd,
+            if is_wavg:
+                kind = fitter.kind
+            elif model in ["admom", "am"]:
+                kind = "am"
+            else:
+                kind = model
+
+            return _FitterConfig(
+                model=model,
+                fitter=fitter,
+                kind=kind,
+                fwhm=cfg["weight"]["fwhm"],
+                fwhm_reg=fwhm_reg,
+                is_wavg=is_wavg,
+                symmetrize=cfg.get("symmetrize", True),
+                batch=batch,
+                **opts,
             )
 
-        if "fitters" in self and (
-            "model" in self
-            or "weight" in self
-            or "symmetrize" in self
-            or "coadd" in self
+        if "fitters" in self and any(
+            name in self for name in ["model", "weight"] + _FITTER_OPTIONS
         ):
             raise RuntimeError(
                 "You can only specify one of fitters or "
-                "model+weight+symmetrize+coadd!"
+                "model+weight+%s!" % "+".join(_FITTER_OPTIONS)
             )
 
         if "fitters" in self:
-            fitters = []
-            fwhms = []
-            fwhm_regs = []
-            fitter_is_wavg = []
-            fitter_symmetrize = []
-            fitter_coadd = []
-            for fitter_cfg in self["fitters"]:
-                _, fitter, fwhm, fwhm_reg, is_wavg, symmetrize, coadd = _get_fitter(
-                    fitter_cfg
-                )
-                fitters.append(fitter)
-                fwhms.append(fwhm)
-                fwhm_regs.append(fwhm_reg)
-                fitter_is_wavg.append(is_wavg)
-                fitter_symmetrize.append(symmetrize)
-                fitter_coadd.append(coadd)
-            self._fitters = fitters
-            self._fwhms = fwhms
-            self._fwhm_regs = fwhm_regs
-            self._fitter_is_wavg = fitter_is_wavg
-            self._fitter_symmetrize = fitter_symmetrize
-            self._fitter_coadd = fitter_coadd
+            self._fitter_cfgs = [
+                _get_fitter(fitter_cfg) for fitter_cfg in self["fitters"]
+            ]
         else:
-            _, fitter, fwhm, fwhm_reg, is_wavg, symmetrize, coadd = _get_fitter(self)
-            self._fitters = [fitter]
-            self._fwhms = [fwhm]
-            self._fwhm_regs = [fwhm_reg]
-            self._fitter_is_wavg = [is_wavg]
-            self._fitter_symmetrize = [symmetrize]
-            self._fitter_coadd = [coadd]
+            self._fitter_cfgs = [_get_fitter(self)]
+
+        # the guesses for a fitter come from the results of an earlier fitter
+        models = self._get_fitter_models()
+        for i, fcfg in enumerate(self._fitter_cfgs):
+            if fcfg.guess_from is not None and fcfg.guess_from not in models[:i]:
+                raise ValueError(
+                    "The fitter '%s' for the guesses of fitter '%s' must come "
+                    "before it in the list of fitters!" % (fcfg.guess_from, models[i])
+                )
 
     @property
     def result(self):
@@ -345,15 +431,26 @@ class Metadetect(dict):
 
         return self._result
 
+    @obs_cache_scope()
     def go(self):
-        """Run metadetect and set the result."""
+        """Run metadetect and set the result.
+
+        The data computed from the pixels of the observations are kept only
+        while this method runs. See `metadetect.util.obs_cache_scope`. The
+        pool of processes for the joint fitters is shut down when it returns.
+        """
+        try:
+            self._go()
+        finally:
+            self._shutdown_joint_executor()
 
+    def _go(self):
         mfrac = self._get_mfrac(self.mbobs)
         any_all_zero_weight = False
         any_all_masked = False
         for obsl in self.mbobs:
             for obs in obsl:
-                if np.all(obs.weight == 0):
+                if get_obs_stats(obs)["all_zero_weight"]:
                     any_all_zero_weight = True
 
                 if np.all((obs.bmask & self['nodet_flags']) != 0):
@@ -377,23 +474,47 @@ class Metadetect(dict):
         # this indicates that a measurement should have been possible
         # we may find nothing, but that is a different thing
         all_res = {}
-        for shear_bands, det_bands in zip(
-            self._shear_band_combs, self._det_band_combs
-        ):
-            if self.color_key_func is not None and self.color_dep_mbobs is not None:
-                res = self._go_bands_with_color(shear_bands, mcal_res, det_bands)
-            else:
-                res = self._go_bands(shear_bands, mcal_res, det_bands)
-            if res is not None:
-                for k, v in res.items():
+        if self._n_workers is not None and self.color_key_func is None:
+            for k, vals in self._go_shear_types(mcal_res).items():
+                for v in vals:
                     if v is None:
                         continue
                     if k not in all_res:
                         all_res[k] = []
                     all_res[k].append(v)
-
+        else:
+            for shear_bands, det_bands in zip(
+                self._shear_band_combs, self._det_band_combs
+            ):
+                if (
+                    self.color_key_func is not None
+                    and self.color_dep_mbobs is not None
+                ):
+                    res = self._go_bands_with_color(shear_bands, mcal_res, det_bands)
+                else:
+                    res = self._go_bands(shear_bands, mcal_res, det_bands)
+                if res is not None:
+                    for k, v in res.items():
+                        if v is None:
+                            continue
+                        if k not in all_res:
+                            all_res[k] = []
+                        all_res[k].append(v)
+
+        # the results for a single shear band combination are used as is
         for k in all_res:
-            all_res[k] = np.hstack(all_res[k])
+            if len(all_res[k]) == 1:
+                all_res[k] = all_res[k][0]
+            else:
+                all_res[k] = np.hstack(all_res[k])
+
+        # the cached detections and stamps are not needed anymore
+        self._clear_shear_caches()
+
+        if any(fcfg.batch for fcfg in self._fitter_cfgs):
+            logger.info(
+                "fourier cache stats: %s", moments.get_fourier_cache().get_stats(),
+            )
 
         for mcal_type in self['metacal'].get(
             "types", ngmix.metacal.METACAL_MINIMAL_TYPES
@@ -405,52 +526,190 @@ class Metadetect(dict):
 
         self._result = all_res
 
+    def _go_shear_types(self, mcal_res):
+        """
+        run detection and measurements for each metacal type with its own
+        random number stream, possibly in a pool of processes
+
+        the result is a dict keyed on the metacal type holding a list of
+        results, one per shear band combination
+        """
+        band_data = []
+        for shear_bands, det_bands in zip(
+            self._shear_band_combs, self._det_band_combs
+        ):
+            kdata = self._get_mbobs_data(None, shear_bands)
+            band_data.append((
+                shear_bands,
+                det_bands,
+                # we leave out the metacal images since the workers only need
+                # the images for their own metacal type
+                {k: kdata[k] for k in ["mfrac", "bmask", "ormask", "psf_stats"]},
+            ))
+
+        # the seeds are drawn in the order of the metacal types so that the
+        # results do not depend on how the work is distributed
+        seeds = self.rng.randint(low=1, high=2**30, size=len(mcal_res))
+        tasks = [
+            (shear_str, shear_mbobs, seed)
+            for (shear_str, shear_mbobs), seed in zip(mcal_res.items(), seeds)
+        ]
+
+        if self._n_workers <= 1 or len(tasks) <= 1:
+            return {
+                shear_str: _go_shear_type(self, shear_mbobs, shear_str, band_data, seed)
+                for shear_str, shear_mbobs, seed in tasks
+            }
+
+        md = self._get_worker_copy()
+        with ProcessPoolExecutor(
+            max_workers=min(self._n_workers, len(tasks))
+        ) as executor:
+            futures = {
+                shear_str: executor.submit(
+                    _go_shear_type, md, shear_mbobs, shear_str, band_data, seed,
+                )
+                for shear_str, shear_mbobs, seed in tasks
+            }
+            return {shear_str: fut.result() for shear_str, fut in futures.items()}
+
+    def _get_worker_copy(self):
+        """
+        get a shallow copy of this object without the caches and other data
+        the workers do not need so that it is cheap to send to them
+        """
+        md = copy.copy(self)
+        for attr in [
+            "_mbobs_data_cache", "_mcalpsf_data_cache", "_shear_caches", "_result",
+        ]:
+            md.__dict__.pop(attr, None)
+        md.color_dep_mbobs = None
+
+        # the workers do not start pools of their own for the joint fitters
+        md._in_worker = True
+        md._joint_executor = None
+        return md
+
+    def _get_joint_pool(self, fcfg):
+        """
+        get the number of workers and the executor for the joint fits of a
+        fitter
+
+        All of the joint fits of a run share a single pool with the largest
+        number of workers of the joint fitters. In a metacal type worker, the
+        chunks are fit serially so that the pools are not nested. Since each
+        object has its own random number stream, the results are the same.
+        """
+        if fcfg.n_workers is None:
+            return None, None
+
+        if self._in_worker:
+            return 1, None
+
+        n_workers = max(
+            _fcfg.n_workers
+            for _fcfg in self._fitter_cfgs
+            if not _fcfg.is_wavg and _fcfg.n_workers is not None
+        )
+        if n_workers <= 1:
+            return fcfg.n_workers, None
+
+        if self._joint_executor is None:
+            self._joint_executor = ProcessPoolExecutor(max_workers=n_workers)
+        return fcfg.n_workers, self._joint_executor
+
+    def _shutdown_joint_executor(self):
+        if self._joint_executor is not None:
+            self._joint_executor.shutdown()
+            self._joint_executor = None
+
     def _go_bands(self, shear_bands, mcal_res, det_bands):
         kdata = self._get_mbobs_data(None, shear_bands)
 
         _result = {}
         for shear_str, shear_mbobs in mcal_res.items():
-            cat, mbobs_list = self._do_detect(
-                shear_mbobs,
-                det_bands,
-            )
-            _result[shear_str] = self._measure(
-                mbobs_list=mbobs_list,
+            _result[shear_str] = self._detect_and_measure(
+                shear_mbobs=shear_mbobs,
+                shear_str=shear_str,
                 shear_bands=shear_bands,
                 det_bands=det_bands,
-                cat=cat,
-                shear_str=shear_str,
-                mfrac=kdata["mfrac"],
-                bmask=kdata["bmask"],
-                ormask=kdata["ormask"],
-                psf_stats=kdata["psf_stats"],
+                kdata=kdata,
+                rng=self.rng,
             )
 
         return _result
 
+    def _detect_and_measure(
+        self, *, shear_mbobs, shear_str, shear_bands, det_bands, kdata, rng,
+    ):
+        cat, mbobs_list, stamp_flags = self._do_detect(
+            shear_mbobs,
+            det_bands,
+            shear_str=shear_str,
+        )
+        return self._measure(
+            mbobs_list=mbobs_list,
+            stamp_flags=stamp_flags,
+            shear_bands=shear_bands,
+            det_bands=det_bands,
+            cat=cat,
+            shear_str=shear_str,
+            shear_mbobs=shear_mbobs,
+            mfrac=kdata["mfrac"],
+            bmask=kdata["bmask"],
+            ormask=kdata["ormask"],
+            psf_stats=kdata["psf_stats"],
+            rng=rng,
+            band_res_cache=self._get_shear_cache(shear_str).setdefault(
+                "band_res", {},
+            ),
+            psf_res_cache=self._get_shear_cache(shear_str).setdefault(
+                "psf_res", {},
+            ),
+        )
+
     def _go_bands_with_color(self, shear_bands, mcal_res, det_bands):
         _result = {}
         for shear_str, shear_mbobs in mcal_res.items():
-            if not self._fitter_is_wavg[0]:
+            if not self._fitter_cfgs[0].is_wavg:
                 raise RuntimeError(
                     "Color-dependent metadetect can only run if first"
                     " fitter is one of wmom, pgauss, or ksigma!"
                 )
 
             # we first detect and get color of each detection
-            cat, mbobs_list = self._do_detect(shear_mbobs, det_bands)
+            cat, mbobs_list, stamp_flags = self._do_detect(
+                shear_mbobs, det_bands, shear_str=shear_str,
+            )
+            fit_inds = self._get_fit_inds(stamp_flags)
+            fit_mbobs_list = _take(mbobs_list, fit_inds)
             nocolor_data = fit_mbobs_list_wavg(
-                mbobs_list=mbobs_list,
-                fitter=self._fitters[0],
+                mbobs_list=fit_mbobs_list,
+                fitter=self._fitter_cfgs[0].fitter,
                 shear_bands=shear_bands,
                 bmask_flags=self.get("bmask_flags", 0),
+                band_res_cache=self._get_shear_cache(shear_str).setdefault(
+                    "band_res", {},
+                ),
+                psf_res_cache=self._get_shear_cache(shear_str).setdefault(
+                    "psf_res", {},
+                ),
+                batch=self._fitter_cfgs[0].batch,
+                fourier_cache=moments.get_fourier_cache(),
+            )
+            nocolor_data = self._add_flagged_res(
+                res=nocolor_data,
+                fcfg=self._fitter_cfgs[0],
+                fit_inds=fit_inds,
+                stamp_flags=stamp_flags,
+                shear_bands=shear_bands,
             )
             if nocolor_data is None:
                 _result[shear_str] = None
                 continue
 
             # now we map color to the mbobs for that color
-            n = Namer(self._fitters[0].kind)
+            n = Namer(self._fitter_cfgs[0].kind)
             col = n("band_flux")
             color_keys = [
                 self.color_key_func(nocolor_data[col][i])
@@ -485,6 +744,10 @@ class Metadetect(dict):
                     bmask=kdata["bmask"],
                     ormask=kdata["ormask"],
                     psf_stats=kdata["psf_stats"],
+                    rng=self.rng,
+                    psf_res_cache=self._get_shear_cache(shear_str).setdefault(
+                        "psf_res", {},
+                    ),
                 )
                 if _data is not None:
                     color_data.append(_data)
@@ -556,49 +819,173 @@ class Metadetect(dict):
 
         return self._mbobs_data_cache[key][sbkey]
 
+    def _get_fit_guesses(self, all_res, models, fcfg):
+        """the initial guesses for the fitter from the results of the first
+        fitter with the model fcfg.guess_from"""
+        if fcfg.guess_from is None:
+            return None
+
+        ind = models.index(fcfg.guess_from)
+        res = all_res[ind]
+        if res is None:
+            return None
+
+        gcfg = self._fitter_cfgs[ind]
+        return get_fit_guesses(
+            res,
+            gcfg.kind,
+            target=fcfg.kind,
+            fwhm=gcfg.fwhm if gcfg.is_wavg else None,
+            fwhm_reg=gcfg.fwhm_reg,
+        )
+
+    def _get_coadd_obs_list(
+        self, *, shear_mbobs, shear_bands, det_bands, cat, shear_str,
+    ):
+        """the shear bands are coadded once for the whole image and the stamps
+        are cut from the coadd, so the fitters can share them"""
+        if cat is None or len(cat) == 0:
+            return None
+
+        key = ("coadd", tuple(shear_bands), tuple(det_bands))
+        cache = self._get_shear_cache(shear_str)
+        if key not in cache:
+            cache[key] = make_coadd_obs_list(
+                mbobs=shear_mbobs,
+                shear_bands=shear_bands,
+                cat=cat,
+                seg=cache.get(("seg", tuple(det_bands)), None),
+                weight_type=self["meds"].get("weight_type", "weight"),
+            )
+        return cache[key]
+
     def _measure(
         self, *, mbobs_list, shear_bands, cat, shear_str, mfrac, bmask,
-        ormask, psf_stats, det_bands,
+        ormask, psf_stats, det_bands, rng, band_res_cache=None,
+        psf_res_cache=None, shear_mbobs=None, stamp_flags=None,
     ):
 
         t0 = time.time()
+
+        # the objects whose results are fixed by the flags of their stamps are
+        # not fit and their results are made from the flags
+        fit_inds = self._get_fit_inds(stamp_flags)
+        fit_mbobs_list = _take(mbobs_list, fit_inds)
+
+        # the batch weighted average fitters with the same symmetrization are
+        # run together so that the stamps are prepared once and the pre-PSF
+        # fitters share the FFTs of the stamps
+        multi_inds = {}
+        for i, fcfg in enumerate(self._fitter_cfgs):
+            if fcfg.is_wavg and fcfg.batch:
+                multi_inds.setdefault(fcfg.symmetrize, []).append(i)
+
+        multi_res = {}
+        for symm, inds in multi_inds.items():
+            if len(inds) < 2:
+                continue
+
+            ft0 = time.time()
+            fitters = [self._fitter_cfgs[i].fitter for i in inds]
+            res = fit_mbobs_list_wavg_multi(
+                mbobs_list=fit_mbobs_list,
+                fitters=fitters,
+                shear_bands=shear_bands,
+                bmask_flags=self.get("bmask_flags", 0),
+                fwhm_regs=[self._fitter_cfgs[i].fwhm_reg for i in inds],
+                symmetrize=symm,
+                band_res_cache=band_res_cache,
+                psf_res_cache=psf_res_cache,
+                fourier_cache=moments.get_fourier_cache(),
+            )
+            logger.info(
+                "fitters %s took %s seconds",
+                [fitter.kind for fitter in fitters],
+                time.time() - ft0,
+            )
+            multi_res.update(zip(inds, res))
+
+        for i, res in multi_res.items():
+            multi_res[i] = self._add_flagged_res(
+                res=res,
+                fcfg=self._fitter_cfgs[i],
+                fit_inds=fit_inds,
+                stamp_flags=stamp_flags,
+                shear_bands=shear_bands,
+            )
+
+        models = self._get_fitter_models()
         all_res = []
-        for fitter, fwhm_reg, is_wavg, symm, coadd in zip(
-            self._fitters, self._fwhm_regs,
-            self._fitter_is_wavg, self._fitter_symmetrize,
-            self._fitter_coadd,
-        ):
+        for i, fcfg in enumerate(self._fitter_cfgs):
+            if i in multi_res:
+                all_res.append(multi_res[i])
+                continue
+
             ft0 = time.time()
-            if is_wavg:
+            if fcfg.is_wavg:
                 res = fit_mbobs_list_wavg(
-                    mbobs_list=mbobs_list,
-                    fitter=fitter,
+                    mbobs_list=fit_mbobs_list,
+                    fitter=fcfg.fitter,
                     shear_bands=shear_bands,
                     bmask_flags=self.get("bmask_flags", 0),
-                    fwhm_reg=fwhm_reg,
-                    symmetrize=symm,
+                    fwhm_reg=fcfg.fwhm_reg,
+                    symmetrize=fcfg.symmetrize,
+                    band_res_cache=band_res_cache,
+                    psf_res_cache=psf_res_cache,
+                    batch=fcfg.batch,
+                    fourier_cache=moments.get_fourier_cache(),
                 )
             else:
+                n_workers, executor = self._get_joint_pool(fcfg)
                 res = fit_mbobs_list_joint(
-                    mbobs_list=mbobs_list,
-                    fitter_name=fitter,
+                    mbobs_list=fit_mbobs_list,
+                    fitter_name=fcfg.fitter,
                     shear_bands=shear_bands,
                     bmask_flags=self.get("bmask_flags", 0),
-                    rng=self.rng,
-                    symmetrize=symm,
-                    coadd=coadd,
+                    rng=rng,
+                    symmetrize=fcfg.symmetrize,
+                    coadd=fcfg.coadd,
+                    psf_fit_cache=(
+                        self._get_shear_cache(shear_str).setdefault("psf_fit", {})
+                        if fcfg.psf_fit_cache
+                        else None
+                    ),
+                    coadd_obs_list=_take(
+                        self._get_coadd_obs_list(
+                            shear_mbobs=shear_mbobs,
+                            shear_bands=shear_bands,
+                            det_bands=det_bands,
+                            cat=cat,
+                            shear_str=shear_str,
+                        )
+                        if fcfg.image_coadd and shear_mbobs is not None
+                        else None,
+                        fit_inds,
+                    ),
+                    guesses=_take(
+                        self._get_fit_guesses(all_res, models, fcfg),
+                        fit_inds,
+                    ),
+                    n_workers=n_workers,
+                    executor=executor,
+                    batch=fcfg.batch,
                 )
-            ft0 = time.time() - ft0
-            logger.info(
-                "fitter %s took %s seconds",
-                fitter.kind
-                if hasattr(fitter, "kind")
-                else fitter,
-                ft0,
+            res = self._add_flagged_res(
+                res=res,
+                fcfg=fcfg,
+                fit_inds=fit_inds,
+                stamp_flags=stamp_flags,
+                shear_bands=shear_bands,
             )
+            ft0 = time.time() - ft0
+            logger.info("fitter %s took %s seconds", fcfg.kind, ft0)
             all_res.append(res)
 
-        res = combine_fit_res(all_res)
+        # the fitter results are copied into the output for all of the fitters
+        # and the columns added below, which are then filled in place
+        res = combine_fit_res(
+            all_res, out=self._get_result_buffer(mbobs_list, stamp_flags),
+        )
 
         if res is not None:
             res = self._add_positions_and_psf(
@@ -615,44 +1002,112 @@ class Metadetect(dict):
 
         return res
 
+    def _get_fit_inds(self, stamp_flags):
+        """
+        get the indices of the objects to fit, the others have results that are
+        fixed by the flags of their stamps for all fitters
+
+        The stamps with weight types other than "weight" can have more flags,
+        since the weights are zeroed outside of the object, so only the
+        objects with zero weights in all bands are not fit for them.
+
+        None is returned if all objects are fit
+        """
+        if stamp_flags is None:
+            return None
+
+        exact = self["meds"].get("weight_type", "weight") == "weight"
+        is_fixed = np.ones(stamp_flags.shape[0], dtype=bool)
+        for fcfg in self._fitter_cfgs:
+            is_fixed &= fitting.is_fixed_by_stamp_flags(
+                stamp_flags=stamp_flags,
+                is_wavg=fcfg.is_wavg,
+                symmetrize=fcfg.symmetrize,
+                exact=exact,
+            )
+
+        if not np.any(is_fixed):
+            return None
+
+        return np.flatnonzero(~is_fixed)
+
+    def _add_flagged_res(self, *, res, fcfg, fit_inds, stamp_flags, shear_bands):
+        """
+        make the results of all objects from the results of the fit objects
+        and the flags of the stamps of the others
+        """
+        if fit_inds is None:
+            return res
+
+        all_res = fitting.make_flagged_fit_res(
+            stamp_flags=stamp_flags,
+            model=fcfg.kind,
+            is_wavg=fcfg.is_wavg,
+            shear_bands=shear_bands,
+            fwhm_reg=fcfg.fwhm_reg,
+        )
+        if res is not None:
+            all_res[fit_inds] = res
+        return all_res
+
+    def _get_fitter_models(self):
+        """
+        get the model or "kind" of each fitter used as the prefix of its
+        columns in the output
+        """
+        return [fcfg.kind for fcfg in self._fitter_cfgs]
+
+    def _get_result_buffer(self, mbobs_list, stamp_flags=None):
+        """
+        allocate the output for all of the fitters and the columns added in
+        _add_positions_and_psf at once
+
+        None is returned if there are no objects or if the objects do not all
+        have the same number of bands
+        """
+        if len(mbobs_list) == 0:
+            return None
+
+        if stamp_flags is not None:
+            # the objects that are not fit are not accessed
+            nband = stamp_flags.shape[1]
+        else:
+            nband = len(mbobs_list[0])
+            if any(len(mbobs) != nband for mbobs in mbobs_list):
+                return None
+
+        dt = get_fit_res_dtype(models=self._get_fitter_models(), nband=nband)
+        dt += [
+            descr for descr in _get_added_dtype()
+            if descr[0] not in [_descr[0] for _descr in dt]
+        ]
+        return np.zeros(len(mbobs_list), dtype=dt)
+
     def _add_positions_and_psf(
         self, *, cat, res, shear_str, mfrac, bmask, ormask, psf_stats, det_bands,
     ):
         """
         add catalog positions to the result
+
+        the columns are added to the result only if it does not have them
+        already, otherwise they are filled in place
         """
 
         new_dt = [
-            ('sx_row', 'f4'),
-            ('sx_col', 'f4'),
-            ('sx_row_noshear', 'f4'),
-            ('sx_col_noshear', 'f4'),
-            ('ormask', 'i4'),
-            ('mfrac', 'f4'),
-            ('bmask', 'i4'),
-            ('mfrac_img', 'f4'),
-            ('ormask_noshear', 'i4'),
-            ('mfrac_noshear', 'f4'),
-            ('bmask_noshear', 'i4'),
-            ("det_bands", "U%d" % MAX_NUM_SHEAR_BANDS),
+            descr for descr in _get_added_dtype()
+            if descr[0] not in res.dtype.names
         ]
-        if 'psfrec_flags' not in res.dtype.names:
-            new_dt += [
-                ('psfrec_flags', 'i4'),  # psfrec is the original psf
-                ('psfrec_g', 'f8', 2),
-                ('psfrec_T', 'f8'),
-            ]
-        newres = eu.numpy_util.add_fields(
-            res,
-            new_dt,
-        )
+        if len(new_dt) > 0:
+            newres = eu.numpy_util.add_fields(
+                res,
+                new_dt,
+            )
+        else:
+            newres = res
 
         assert len(det_bands) <= MAX_NUM_SHEAR_BANDS
         newres["det_bands"] = "".join("%s" % b for b in sorted(det_bands))
 
-        if 'psfrec_flags' not in res.dtype.names:
-            newres['psfrec_flags'] = procflags.NO_ATTEMPT
-
         newres['psfrec_flags'][:] = psf_stats['flags']
         newres['psfrec_g'][:, 0] = psf_stats['g1']
         newres['psfrec_g'][:, 1] = psf_stats['g2']
@@ -696,27 +1151,32 @@ class Metadetect(dict):
                 bmask_region,
             )
 
+            # the masks are dilated once and then sampled at both the sheared
+            # and unsheared positions
+            ormask = _dilate_mask(mask_region=ormask_region, mask=ormask)
+            bmask = _dilate_mask(mask_region=bmask_region, mask=bmask)
+
             newres["ormask"] = _fill_in_mask_col(
-                mask_region=ormask_region,
+                mask_region=1,
                 rows=newres['sx_row'],
                 cols=newres['sx_col'],
                 mask=ormask,
             )
             newres["ormask_noshear"] = _fill_in_mask_col(
-                mask_region=ormask_region,
+                mask_region=1,
                 rows=newres['sx_row_noshear'],
                 cols=newres['sx_col_noshear'],
                 mask=ormask,
             )
 
             newres["bmask"] = _fill_in_mask_col(
-                mask_region=bmask_region,
+                mask_region=1,
                 rows=newres['sx_row'],
                 cols=newres['sx_col'],
                 mask=bmask,
             )
             newres["bmask_noshear"] = _fill_in_mask_col(
-                mask_region=bmask_region,
+                mask_region=1,
                 rows=newres['sx_row_noshear'],
                 cols=newres['sx_col_noshear'],
                 mask=bmask,
@@ -729,7 +1189,7 @@ class Metadetect(dict):
                     y=newres["sx_row"],
                     box_sizes=cat["box_size"],
                     obs=obs,
-                    fwhm=self.get("mfrac_fwhm", self._fwhms[0]),
+                    fwhm=self.get("mfrac_fwhm", self._fitter_cfgs[0].fwhm),
                 )
 
                 newres["mfrac_noshear"] = measure_mfrac(
@@ -738,7 +1198,7 @@ class Metadetect(dict):
                     y=newres["sx_row_noshear"],
                     box_sizes=cat["box_size"],
                     obs=obs,
-                    fwhm=self.get("mfrac_fwhm", self._fwhms[0]),
+                    fwhm=self.get("mfrac_fwhm", self._fitter_cfgs[0].fwhm),
                 )
             else:
                 newres["mfrac"] = 0
@@ -746,10 +1206,44 @@ class Metadetect(dict):
 
         return newres
 
-    def _do_detect(self, mbobs, det_bands):
+    def _get_shear_cache(self, shear_str):
+        """
+        get the cache of data for a metacal type that is shared across the
+        shear band combinations
+        """
+        if not hasattr(self, "_shear_caches"):
+            self._shear_caches = {}
+
+        if shear_str not in self._shear_caches:
+            self._shear_caches[shear_str] = {}
+
+        return self._shear_caches[shear_str]
+
+    def _clear_shear_caches(self):
+        if hasattr(self, "_shear_caches"):
+            del self._shear_caches
+
+    def _do_detect(self, mbobs, det_bands, shear_str=None):
         """
         use a MEDSifier to run detection
+
+        The catalog, a detect.LazyMBObsList of the objects and the flags of
+        their stamps are returned. The objects whose fitting results are fixed
+        by the flags are not fit and no stamps are cut for them, see _measure.
+
+        If shear_str is given, the detections and stamps are cached for the
+        metacal type and set of detection bands so that they can be reused
+        for other shear band combinations.
         """
+        if shear_str is not None:
+            cache = self._get_shear_cache(shear_str)
+            cache_key = ("detect", tuple(det_bands))
+            if cache_key in cache:
+                logger.info(
+                    "using cached detections for %s %s", shear_str, det_bands,
+                )
+                return cache[cache_key]
+
         t0 = time.time()
         det_mbobs = ngmix.MultiBandObsList()
         for band in det_bands:
@@ -774,13 +1268,43 @@ class Metadetect(dict):
             seg=medsifier.seg,
             number=medsifier.cat['number'],
         )
-        mbm = all_medsifier.get_multiband_meds()
-        mbobs_list = mbm.get_mbobs_list(
-            weight_type=self["meds"].get("weight_type", "weight"),
+
+        # the flags of the stamps are found from the full images before any
+        # stamps are cut. They are the flags of the stamps with the weight type
+        # "weight", so they are set for those stamps and the fitters do not
+        # scan them, see _get_fit_inds for the other weight types
+        weight_type = self["meds"].get("weight_type", "weight")
+        bmask_flags = self.get("bmask_flags", 0)
+        stamp_flags = all_medsifier.get_stamp_flags(bmask_flags)
+
+        # the stamps of the objects that are not fit are not cut, and the
+        # observations of each object are made when it is fit
+        fit_inds = self._get_fit_inds(stamp_flags)
+        if fit_inds is not None:
+            logger.info(
+                "%d of %d objects not fit due to flags",
+                stamp_flags.shape[0] - fit_inds.size, stamp_flags.shape[0],
+            )
+            skip = np.ones(stamp_flags.shape[0], dtype=bool)
+            skip[fit_inds] = False
+        else:
+            skip = None
+        mbm = all_medsifier.get_multiband_meds(
+            stamp_cubes=True, shared_psf=True, skip=skip,
+        )
+        mbobs_list = detect.LazyMBObsList(
+            mbm,
+            weight_type=weight_type,
+            stamp_flags=stamp_flags if weight_type == "weight" else None,
+            bmask_flags=bmask_flags,
         )
         logger.info("detect took %s seconds", time.time() - t0)
 
-        return medsifier.cat, mbobs_list
+        if shear_str is not None:
+            cache[cache_key] = (medsifier.cat, mbobs_list, stamp_flags)
+            cache[("seg", tuple(det_bands))] = medsifier.seg
+
+        return medsifier.cat, mbobs_list, stamp_flags
 
     def _get_all_metacal(self, mbobs):
         """
@@ -825,6 +1349,61 @@ class Metadetect(dict):
         return odict
 
 
+@obs_cache_scope()
+def _go_shear_type(md, shear_mbobs, shear_str, band_data, seed):
+    """
+    run detection and measurements for a single metacal type over all of the
+    shear band combinations
+
+    This function is at the module level so that it can be sent to worker
+    processes.
+
+    Parameters
+    ----------
+    md: Metadetect
+        The metadetect object to use.
+    shear_mbobs: ngmix.MultiBandObsList
+        The metacal images for this metacal type.
+    shear_str: str
+        The metacal type.
+    band_data: list of tuples
+        A list of (shear_bands, det_bands, kdata) for each shear band combination.
+    seed: int
+        The seed for the random number generator for this metacal type.
+
+    Returns
+    -------
+    res: list
+        The results for each shear band combination.
+    """
+    rng = np.random.RandomState(seed=seed)
+    return [
+        md._detect_and_measure(
+            shear_mbobs=shear_mbobs,
+            shear_str=shear_str,
+            shear_bands=shear_bands,
+            det_bands=det_bands,
+            kdata=kdata,
+            rng=rng,
+        )
+        for shear_bands, det_bands, kdata in band_data
+    ]
+
+
+def _take(vals, inds):
+    """
+    get the entries of vals with the indices inds, or all of them if vals or
+    inds is None
+
+    arrays and detect.LazyMBObsList are indexed with their take method
+    """
+    if vals is None or inds is None:
+        return vals
+    if isinstance(vals, list):
+        return [vals[i] for i in inds]
+    return vals.take(inds)
+
+
 def _get_psf_stats(mbobs, global_flags):
     if global_flags != 0:
         flags = procflags.PSF_FAILURE | global_flags
@@ -890,33 +1469,83 @@ def _clip_and_round(vals_in, dim):
     return vals.astype('i4')
 
 
+def _get_added_dtype():
+    """
+    get the dtype of the columns added to the fit results in
+    Metadetect._add_positions_and_psf
+    """
+    return [
+        ('sx_row', 'f4'),
+        ('sx_col', 'f4'),
+        ('sx_row_noshear', 'f4'),
+        ('sx_col_noshear', 'f4'),
+        ('ormask', 'i4'),
+        ('mfrac', 'f4'),
+        ('bmask', 'i4'),
+        ('mfrac_img', 'f4'),
+        ('ormask_noshear', 'i4'),
+        ('mfrac_noshear', 'f4'),
+        ('bmask_noshear', 'i4'),
+        ("det_bands", "U%d" % MAX_NUM_SHEAR_BANDS),
+        ('psfrec_flags', 'i4'),  # psfrec is the original psf
+        ('psfrec_g', 'f8', 2),
+        ('psfrec_T', 'f8'),
+    ]
+
+
 def _fill_in_mask_col(*, mask_region, rows, cols, mask):
+    """
+    get the mask values at the positions, ORed over a square region of half
+    width mask_region if mask_region > 1
+
+    The mask can be made with _dilate_mask ahead of time and passed with
+    mask_region=1 to sample the same mask at several sets of positions.
+    """
     dims = mask.shape
     rclip = _clip_and_round(rows, dims[0])
     cclip = _clip_and_round(cols, dims[1])
 
     if mask_region > 1:
-        res = np.zeros_like(rows, dtype=np.int32)
-        for ind in range(rows.size):
-            lr = int(min(
-                dims[0]-1,
-                max(0, rclip[ind] - mask_region)))
-            ur = int(min(
-                dims[0]-1,
-                max(0, rclip[ind] + mask_region)))
-
-            lc = int(min(
-                dims[1]-1,
-                max(0, cclip[ind] - mask_region)))
-            uc = int(min(
-                dims[1]-1,
-                max(0, cclip[ind] + mask_region)))
-
-            res[ind] = np.bitwise_or.reduce(
-                mask[lr:ur+1, lc:uc+1],
-                axis=None,
-            )
-    else:
-        res = mask[rclip, cclip].astype(np.int32)
+        mask = _dilate_mask(mask_region=mask_region, mask=mask)
+
+    return mask[rclip, cclip].astype(np.int32)
+
+
+def _dilate_mask(*, mask_region, mask):
+    """
+    OR each pixel of the mask with the pixels within a square region of half
+    width mask_region around it, ignoring the pixels off of the image
+
+    The square region is done as two 1d passes.
+    """
+    if mask_region <= 1:
+        return mask
+
+    dmask = _dilate_mask_1d(mask, mask_region)
+    dmask = _dilate_mask_1d(dmask.T, mask_region).T
+    return dmask
+
+
+def _dilate_mask_1d(mask, half_width):
+    """
+    OR each row of the mask with the rows within half_width of it
+
+    The OR over a window of width 2 * half_width + 1 is done by ORing windows of
+    doubling size and then ORing the two, possibly overlapping, windows of
+    the largest size that cover the full window, so that it takes
+    log2(half_width) passes over the mask.
+    """
+    nrows = mask.shape[0]
+    width = 2 * half_width + 1
+
+    padded = np.zeros((nrows + 2 * half_width, ) + mask.shape[1:], dtype=mask.dtype)
+    padded[half_width:half_width + nrows] = mask
+
+    # after each pass the row i holds the OR of the rows i to i + size - 1
+    dmask = padded
+    size = 1
+    while 2 * size <= width:
+        dmask = dmask[:-size] | dmask[size:]
+        size *= 2
 
-    return res
+    return dmask[:nrows] | dmask[width - size:width - size + nrows]
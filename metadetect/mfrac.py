@@ -1,8 +1,11 @@
 import ngmix
 import numpy as np
 
-from .detect import CatalogMEDSifier
 from .defaults import BMASK_EDGE
+from .util import count_in_boxes
+
+# the maximum number of pixels in the apertures for a chunk of objects
+MFRAC_CHUNK_NPIX = 2**20
 
 
 def measure_mfrac(
@@ -20,6 +23,14 @@ def measure_mfrac(
     of single-epoch images that are masked in each pixel of a coadd. It
     computes a Gaussian-weighted average of the image at a list of locations.
 
+    The averages are computed for all locations at once. They are the same as
+    measuring each object on a stamp of size `box_sizes` made with
+    `metadetect.detect.CatalogMEDSifier`. Pixels off of the image or with
+    the `BMASK_EDGE` bit set are ignored and the Gaussian is renormalized over
+    the remaining pixels within a radius of 2 * `fwhm`. Objects with a
+    non-positive box size, no pixels with positive weight in their stamp or
+    no pixels in their aperture get a value of 1.
+
     Parameters
     ----------
     mfrac : np.ndarray
@@ -48,39 +59,89 @@ def measure_mfrac(
     if fwhm is None:
         fwhm = 1.2
 
-    obs = obs.copy()
-    obs.set_image(mfrac)
-
-    gauss_wgt = ngmix.GMixModel(
-        [0, 0, 0, 0, ngmix.moments.fwhm_to_T(fwhm), 1],
-        'gauss',
-    )
-    mbobs = ngmix.MultiBandObsList()
-    obslist = ngmix.ObsList()
-    mbobs.append(obslist)
-    obslist.append(obs)
-    m = CatalogMEDSifier(mbobs, x, y, box_sizes).get_meds(0)
-    mfracs = []
-    for i in range(x.shape[0]):
-        try:
-            if box_sizes[i] > 0:
-                obs = m.get_obs(i, 0)
-                wgt = obs.weight.copy()
-                msk = (obs.bmask & BMASK_EDGE) != 0
-                wgt[msk] = 0
-                wgt[~msk] = 1
-                obs.set_weight(wgt)
-
-                stats = gauss_wgt.get_weighted_sums(
-                    obs,
-                    fwhm * 2,
-                )
-                # this is the weighted average in the image using the
-                # Gaussian as the weight.
-                mfracs.append(stats["sums"][5] / stats["wsum"])
-            else:
-                mfracs.append(1.0)
-        except ngmix.GMixFatalError:
-            mfracs.append(1.0)
-
-    return np.array(mfracs)
+    x = np.atleast_1d(x)
+    y = np.atleast_1d(y)
+    box_sizes = np.atleast_1d(box_sizes)
+    mfracs = np.ones(x.shape[0])
+
+    dims = mfrac.shape
+    jac = obs.jacobian
+    if obs.has_bmask():
+        msk = (obs.bmask & BMASK_EDGE) != 0
+    else:
+        msk = np.zeros(dims, dtype=bool)
+
+    # the stamps and their centers are computed in the same way as in
+    # CatalogMEDSifier and the MEDS Jacobian, including the use of 32 bit floats
+    half_box_sizes = box_sizes // 2
+    row_starts, row_cens = _get_stamp_starts_and_cens(y, half_box_sizes)
+    col_starts, col_cens = _get_stamp_starts_and_cens(x, half_box_sizes)
+
+    # the stamps without any pixels with positive weight cannot be measured
+    has_wgt = count_in_boxes(
+        obs.weight > 0,
+        row_starts,
+        col_starts,
+        box_sizes,
+    ) > 0
+    inds, = np.where((box_sizes > 0) & has_wgt)
+    if inds.size == 0:
+        return mfracs
+
+    # the aperture is the circle of radius 2 * fwhm, so we only need the
+    # pixels in the square that holds it
+    maxrad2 = (2 * fwhm)**2
+    sigma2 = ngmix.moments.fwhm_to_T(fwhm) / 2
+    min_scale = np.min(np.linalg.svd(
+        [[jac.dvdrow, jac.dvdcol], [jac.dudrow, jac.dudcol]],
+        compute_uv=False,
+    ))
+    rad = int(np.ceil(2 * fwhm / min_scale)) + 1
+    doff, coff = np.mgrid[-rad:rad + 1, -rad:rad + 1]
+    doff = doff.ravel()
+    coff = coff.ravel()
+
+    nchunk = max(MFRAC_CHUNK_NPIX // doff.size, 1)
+    for start in range(0, inds.size, nchunk):
+        _inds = inds[start:start + nchunk]
+
+        rows = np.floor(row_cens[_inds]).astype(np.int64)[:, None] + doff
+        cols = np.floor(col_cens[_inds]).astype(np.int64)[:, None] + coff
+        drow = rows - row_cens[_inds, None]
+        dcol = cols - col_cens[_inds, None]
+        v = jac.dvdrow * drow + jac.dvdcol * dcol
+        u = jac.dudrow * drow + jac.dudcol * dcol
+        rad2 = u * u + v * v
+
+        use = (
+            (rad2 < maxrad2)
+            & (rows >= 0)
+            & (rows < dims[0])
+            & (cols >= 0)
+            & (cols < dims[1])
+            & (rows >= row_starts[_inds, None])
+            & (rows < row_starts[_inds, None] + box_sizes[_inds, None])
+            & (cols >= col_starts[_inds, None])
+            & (cols < col_starts[_inds, None] + box_sizes[_inds, None])
+        )
+        np.clip(rows, 0, dims[0] - 1, out=rows)
+        np.clip(cols, 0, dims[1] - 1, out=cols)
+        use &= ~msk[rows, cols]
+
+        wgts = np.exp(-0.5 * rad2 / sigma2)
+        wgts[~use] = 0
+        wsum = wgts.sum(axis=1)
+        sums = (wgts * mfrac[rows, cols]).sum(axis=1)
+
+        good = wsum > 0
+        mfracs[_inds[good]] = sums[good] / wsum[good]
+
+    return mfracs
+
+
+def _get_stamp_starts_and_cens(vals, half_box_sizes):
+    vals = np.asarray(vals, dtype=np.float32)
+    starts = vals.astype(np.int32) - half_box_sizes + 1
+    starts = starts.clip(min=0).astype(np.int64)
+    cens = starts + (vals - starts).astype(np.float32).astype(np.float64)
+    return starts, cens
@@ -0,0 +1,1085 @@
+"""
+Batch versions of the moments measurements used by the weighted average
+fitters and the adaptive moments fitter.
+
+These functions measure the moments for many observations at once, in a single
+numba kernel for the Gaussian-weighted and adaptive moments and in stacked FFTs
+for the pre-PSF moments, instead of calling the ngmix fitter once per
+observation.
+"""
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+from numba import njit
+
+import ngmix
+import ngmix.flags
+import ngmix.prepsfmom
+from ngmix.moments import make_mom_result, fwhm_to_T
+
+# ngmix only evaluates the Gaussian weight function out to this chi2
+GAUSS_MAX_CHI2 = 25.0
+
+# the PSF Fourier modes are clipped at this fraction of the maximum amplitude
+# before deconvolution
+MIN_PSF_FRAC = 1e-5
+
+# the maximum number of stamps that are FFTed at once to bound the memory use
+MAX_FFT_BATCH_SIZE = 64
+
+# the defaults of ngmix.admom.AdmomFitter for the batch adaptive moments
+ADMOM_MAXITER = 200
+ADMOM_SHIFTMAX = 5.0
+ADMOM_ETOL = 1.0e-5
+ADMOM_TTOL = 1.0e-3
+
+# the batch adaptive moments start from a round weight function with this FWHM
+# for objects without a guess for T
+ADMOM_GUESS_FWHM = 1.2
+
+# the adaptive moments fail if the determinant of a covariance is below this
+ADMOM_LOW_DETVAL = 1.0e-200
+
+ADMOM_LOW_DET_FLAG = ngmix.flags.LOW_DET
+ADMOM_NONPOS_FLUX_FLAG = ngmix.flags.NONPOS_FLUX
+ADMOM_NONPOS_SIZE_FLAG = ngmix.flags.NONPOS_SIZE
+ADMOM_SHIFT_FLAG = ngmix.flags.CEN_SHIFT
+ADMOM_MAXITER_FLAG = ngmix.flags.MAXITER
+
+# the default maximum number of entries of each kind in a FourierCache
+FOURIER_CACHE_MAXSIZE = 64
+
+
+class FourierCache(object):
+    """A bounded least-recently-used cache of the Fourier-space moments kernels
+    and PSF transforms used by the batch pre-PSF moments.
+
+    The moments kernels only depend on the kernel, its FWHM, the smoothing FWHM,
+    the FFT dimension and the Jacobian matrix, so they are typically the same for
+    every object in a run. The PSF transforms are keyed on the FFT dimension and
+    the contents of the PSF image, so they are reused for all of the objects that
+    share a PSF image.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        The maximum number of entries of each kind that are kept. The least
+        recently used entries are dropped first. Default is
+        FOURIER_CACHE_MAXSIZE.
+
+    Attributes
+    ----------
+    hits : dict
+        The number of cache hits for the "kernels" and "psf" entries.
+    misses : dict
+        The number of cache misses for the "kernels" and "psf" entries.
+    """
+    def __init__(self, maxsize=FOURIER_CACHE_MAXSIZE):
+        self.maxsize = maxsize
+        self._data = {"kernels": OrderedDict(), "psf": OrderedDict()}
+        self.hits = {kind: 0 for kind in self._data}
+        self.misses = {kind: 0 for kind in self._data}
+
+    def __len__(self):
+        return sum(len(data) for data in self._data.values())
+
+    def clear(self):
+        """Remove all entries and reset the hit and miss counters."""
+        for kind, data in self._data.items():
+            data.clear()
+            self.hits[kind] = 0
+            self.misses[kind] = 0
+
+    def get_stats(self):
+        """Get the cache statistics.
+
+        Returns
+        -------
+        stats : dict
+            A dictionary with the number of "hits", "misses" and entries "size"
+            for each of the "kernels" and "psf" entries.
+        """
+        return {
+            kind: dict(
+                hits=self.hits[kind],
+                misses=self.misses[kind],
+                size=len(data),
+            )
+            for kind, data in self._data.items()
+        }
+
+    def get_kernels(self, *, kernel, fwhm, fft_dim, jac, fwhm_smooth=0):
+        """Get the moments kernels. See `get_fourier_kernels` for the
+        parameters. The returned arrays must not be modified."""
+        key = (kernel, fwhm, fwhm_smooth, fft_dim, tuple(jac[2:]))
+        return self._get(
+            "kernels",
+            key,
+            lambda: get_fourier_kernels(
+                kernel=kernel,
+                fwhm=fwhm,
+                fwhm_smooth=fwhm_smooth,
+                fft_dim=fft_dim,
+                jac=jac,
+            ),
+        )
+
+    def get_psf_rfft(self, *, psf_image, fft_dim):
+        """Get the real FFT of a zero-padded PSF image normalized to unit flux.
+        See `get_psf_rfft` for the parameters. The returned array must not be
+        modified."""
+        key = (fft_dim, _get_array_hash(psf_image))
+        return self._get(
+            "psf",
+            key,
+            lambda: get_psf_rfft(psf_images=psf_image[None], fft_dim=fft_dim)[0],
+        )
+
+    def _get(self, kind, key, func):
+        data = self._data[kind]
+        if key in data:
+            self.hits[kind] += 1
+            data.move_to_end(key)
+            return data[key]
+
+        self.misses[kind] += 1
+        val = func()
+        data[key] = val
+        while len(data) > self.maxsize:
+            data.popitem(last=False)
+        return val
+
+
+_FOURIER_CACHE = FourierCache()
+
+
+def get_fourier_cache():
+    """Get the FourierCache shared by the metadetect runs in this process.
+
+    Returns
+    -------
+    cache : FourierCache
+        The shared cache. Its hit and miss counters accumulate over all of the
+        runs in this process.
+    """
+    return _FOURIER_CACHE
+
+
+def supports_batch(fitter):
+    """Test if a fitter has a batch version in this module.
+
+    Parameters
+    ----------
+    fitter : ngmix fitter
+        The fitter to test.
+
+    Returns
+    -------
+    supported : bool
+        True if `measure_moments_batch` can be used for the fitter.
+    """
+    return isinstance(
+        fitter,
+        (ngmix.gaussmom.GaussMom, ngmix.prepsfmom.PrePSFMom),
+    )
+
+
+def measure_moments_batch(*, fitter, obs_list, no_psf=False, fourier_cache=None):
+    """Measure the moments of a list of observations in batches.
+
+    The observations are grouped by image shape (and for the pre-PSF moments by
+    PSF image shape and Jacobian) and the moments of each group are computed at
+    once. For the Gaussian-weighted moments, the results agree with those from
+    `fitter.go` to floating point precision. For the pre-PSF moments, the
+    Fourier-space kernels are computed analytically and the results agree with
+    those from `fitter.go` up to the discretization of the kernels.
+
+    Parameters
+    ----------
+    fitter : ngmix fitter
+        The fitter whose measurement is done in batch. See `supports_batch`.
+    obs_list : list of ngmix.Observation
+        The observations to measure.
+    no_psf : bool, optional
+        If True, the pre-PSF moments are measured without deconvolving the PSF.
+        This option is used to measure the PSF itself. It is ignored for the
+        Gaussian-weighted moments. Default is False.
+    fourier_cache : FourierCache, optional
+        If not None, the pre-PSF moments kernels and PSF transforms are looked
+        up in and stored to this cache. It is ignored for the Gaussian-weighted
+        moments. Default is None.
+
+    Returns
+    -------
+    res : list of dict
+        The moments results, one per observation, in the same format as
+        those from `fitter.go`.
+    """
+    if not supports_batch(fitter):
+        raise ValueError(
+            "Fitter %s does not have a batch version!" % fitter.__class__.__name__
+        )
+
+    if isinstance(fitter, ngmix.prepsfmom.PrePSFMom):
+        return _measure_prepsfmom_batch(
+            fitters=[fitter], obs_list=obs_list, no_psf=no_psf,
+            fourier_cache=fourier_cache,
+        )[0]
+
+    all_res = [None] * len(obs_list)
+    for inds in _group_by_shape(obs_list):
+        images, weights, jacs = _stack_obs([obs_list[i] for i in inds])
+        sums, sums_cov, wsum, npix = get_gaussmom_sums(
+            images=images, weights=weights, jacs=jacs, T=fwhm_to_T(fitter.fwhm),
+        )
+        for k, i in enumerate(inds):
+            res = make_mom_result(sums[k], sums_cov[k], wsum[k])
+            res["wsum"] = wsum[k]
+            res["npix"] = npix[k]
+            all_res[i] = res
+
+    return all_res
+
+
+def get_gaussmom_sums(*, images, weights, jacs, T):
+    """Compute the Gaussian-weighted moment sums for a stack of images.
+
+    The weight function is a round Gaussian with peak value of unity centered
+    at the Jacobian center of each image. Pixels with zero weight are ignored.
+
+    Parameters
+    ----------
+    images : np.ndarray
+        The images, shape (nobs, ny, nx).
+    weights : np.ndarray
+        The inverse variance weight maps, shape (nobs, ny, nx).
+    jacs : np.ndarray
+        The Jacobians, shape (nobs, 6). See `get_jacobian_array`.
+    T : float
+        The T of the Gaussian weight function.
+
+    Returns
+    -------
+    sums : np.ndarray
+        The moment sums, shape (nobs, 6).
+    sums_cov : np.ndarray
+        The covariance of the moment sums, shape (nobs, 6, 6).
+    wsum : np.ndarray
+        The sum of the weight function over the pixels, shape (nobs,).
+    npix : np.ndarray
+        The number of pixels used, shape (nobs,).
+    """
+    nobs = images.shape[0]
+    sums = np.zeros((nobs, 6), dtype=np.float64)
+    sums_cov = np.zeros((nobs, 6, 6), dtype=np.float64)
+    wsum = np.zeros(nobs, dtype=np.float64)
+    npix = np.zeros(nobs, dtype=np.int64)
+    _gaussmom_sums_kernel(
+        images.astype(np.float64, copy=False),
+        weights.astype(np.float64, copy=False),
+        jacs.astype(np.float64, copy=False),
+        T,
+        sums,
+        sums_cov,
+        wsum,
+        npix,
+    )
+    return sums, sums_cov, wsum, npix
+
+
+@njit
+def _gaussmom_sums_kernel(images, weights, jacs, T, sums, sums_cov, wsum, npix):
+    nobs, ny, nx = images.shape
+    sigma2 = T / 2.0
+    F = np.zeros(6)
+    for i in range(nobs):
+        row0 = jacs[i, 0]
+        col0 = jacs[i, 1]
+        dvdrow = jacs[i, 2]
+        dvdcol = jacs[i, 3]
+        dudrow = jacs[i, 4]
+        dudcol = jacs[i, 5]
+        for row in range(ny):
+            for col in range(nx):
+                ivar = weights[i, row, col]
+                if ivar <= 0:
+                    continue
+
+                v = dvdrow * (row - row0) + dvdcol * (col - col0)
+                u = dudrow * (row - row0) + dudcol * (col - col0)
+                rad2 = u * u + v * v
+                chi2 = rad2 / sigma2
+                if chi2 >= GAUSS_MAX_CHI2:
+                    continue
+
+                w = np.exp(-0.5 * chi2)
+                wdata = w * images[i, row, col]
+                w2var = w * w / ivar
+
+                F[0] = v
+                F[1] = u
+                F[2] = u * u - v * v
+                F[3] = 2.0 * v * u
+                F[4] = rad2
+                F[5] = 1.0
+
+                wsum[i] += w
+                npix[i] += 1
+                for j in range(6):
+                    sums[i, j] += wdata * F[j]
+                    for k in range(6):
+                        sums_cov[i, j, k] += w2var * F[j] * F[k]
+
+
+def measure_admom_batch(
+    *, obs_list, T_guess, g_guess=None, maxiter=ADMOM_MAXITER,
+    shiftmax=ADMOM_SHIFTMAX, etol=ADMOM_ETOL, Ttol=ADMOM_TTOL,
+):
+    """Measure the adaptive moments of a list of observations in batches.
+
+    The observations are grouped by image shape and the adaptive moments of
+    each group are iterated together in a single numba kernel. Each object
+    stops iterating when it has converged or failed. The iteration is the same
+    as that of `ngmix.admom.AdmomFitter` with a single try from the guess, so
+    that the results agree with those from `fitter.go` up to the convergence
+    tolerances.
+
+    Parameters
+    ----------
+    obs_list : list of ngmix.Observation
+        The observations to measure.
+    T_guess : np.ndarray
+        The initial T of the weight function for each observation. Non-finite
+        or non-positive values are replaced by the T of a Gaussian with a FWHM
+        of `ADMOM_GUESS_FWHM`.
+    g_guess : np.ndarray, optional
+        The initial reduced shear of the weight function for each observation,
+        shape (nobs, 2). Default of None starts from round weight functions.
+    maxiter : int, optional
+        The maximum number of iterations. Default is `ADMOM_MAXITER`.
+    shiftmax : float, optional
+        The maximum shift of the center of the weight function from the
+        Jacobian center in the u, v coordinates. Default is `ADMOM_SHIFTMAX`.
+    etol : float, optional
+        The tolerance on the change in each component of the ellipticity for
+        convergence. Default is `ADMOM_ETOL`.
+    Ttol : float, optional
+        The tolerance on the fractional change in T for convergence. Default is
+        `ADMOM_TTOL`.
+
+    Returns
+    -------
+    res : list of dict
+        The adaptive moments results, one per observation, with the flags,
+        numiter, T, T_err, e, e_err, e_cov and s2n in the same format as those
+        from `fitter.go`. T and e are those of the converged weight function.
+        The errors on e are the Bernstein & Jarvis (2002) errors 2 / s2n for
+        Gaussian objects and the fractional error on T is that of the ratio of
+        the weighted moment sums.
+    """
+    nobs = len(obs_list)
+    T_guess = np.array(T_guess, dtype=np.float64, copy=True).reshape(nobs)
+    bad = ~np.isfinite(T_guess) | (T_guess <= 0)
+    T_guess[bad] = fwhm_to_T(ADMOM_GUESS_FWHM)
+    if g_guess is None:
+        e_guess = np.zeros((nobs, 2))
+    else:
+        g_guess = np.asarray(g_guess, dtype=np.float64).reshape(nobs, 2)
+        gsq = np.sum(g_guess**2, axis=1)
+        e_guess = 2 * g_guess / (1 + gsq[:, None])
+        e_guess[~np.isfinite(gsq) | (gsq >= 1)] = 0
+
+    # the weight function parameters [row, col, irr, irc, icc] start at the
+    # Jacobian center
+    wts = np.zeros((nobs, 5))
+    wts[:, 2] = T_guess / 2 * (1 - e_guess[:, 0])
+    wts[:, 3] = T_guess / 2 * e_guess[:, 1]
+    wts[:, 4] = T_guess / 2 * (1 + e_guess[:, 0])
+
+    all_res = [None] * nobs
+    for inds in _group_by_shape(obs_list):
+        images, weights, jacs = _stack_obs([obs_list[i] for i in inds])
+        wt = wts[inds]
+        sums = np.zeros((len(inds), 6), dtype=np.float64)
+        sums_cov = np.zeros((len(inds), 6, 6), dtype=np.float64)
+        flags = np.zeros(len(inds), dtype=np.int64)
+        numiter = np.zeros(len(inds), dtype=np.int64)
+        _admom_kernel(
+            images.astype(np.float64, copy=False),
+            weights.astype(np.float64, copy=False),
+            jacs.astype(np.float64, copy=False),
+            wt,
+            maxiter,
+            shiftmax,
+            etol,
+            Ttol,
+            sums,
+            sums_cov,
+            flags,
+            numiter,
+        )
+        for k, i in enumerate(inds):
+            all_res[i] = _make_admom_result(
+                wt[k], sums[k], sums_cov[k], flags[k], numiter[k],
+            )
+
+    return all_res
+
+
+def _make_admom_result(wt, sums, sums_cov, flags, numiter):
+    res = {
+        "flags": int(flags),
+        "T_flags": int(flags),
+        "numiter": int(numiter),
+        "pars": np.array([
+            wt[0], wt[1], wt[4] - wt[2], 2 * wt[3], wt[2] + wt[4], 1.0,
+        ]),
+        "sums": sums,
+        "sums_cov": sums_cov,
+        "T": np.nan,
+        "T_err": np.nan,
+        "s2n": np.nan,
+        "e": np.array([np.nan, np.nan]),
+        "e_err": np.array([np.nan, np.nan]),
+        "e_cov": np.diag([np.nan, np.nan]),
+    }
+    if flags != 0:
+        return res
+
+    mres = make_mom_result(sums, sums_cov)
+    res["flags"] |= mres["flags"]
+    res["T_flags"] |= mres["T_flags"]
+    T = res["pars"][4]
+    if res["T_flags"] == 0:
+        res["T"] = T
+        res["T_err"] = mres["T_err"] * T / mres["T"]
+
+    if res["flags"] == 0:
+        res["s2n"] = mres["s2n"]
+        res["e"] = res["pars"][2:4] / T
+        res["e_err"] = np.array([2.0, 2.0]) / mres["s2n"]
+        res["e_cov"] = np.diag(res["e_err"]**2)
+
+    return res
+
+
+@njit
+def _admom_kernel(
+    images, weights, jacs, wt, maxiter, shiftmax, etol, Ttol,
+    sums, sums_cov, flags, numiter,
+):
+    nobs = images.shape[0]
+    orig = wt[:, :2].copy()
+    old = np.full((nobs, 3), np.nan)
+    done = np.zeros(nobs, dtype=np.bool_)
+    for it in range(maxiter):
+        nactive = 0
+        for i in range(nobs):
+            if done[i]:
+                continue
+
+            nactive += 1
+            numiter[i] = it + 1
+            flags[i] = _admom_step(
+                images[i], weights[i], jacs[i], wt[i], orig[i], old[i],
+                shiftmax, etol, Ttol, sums[i], sums_cov[i],
+            )
+            # the step returns -1 when the moments have converged
+            if flags[i] != 0:
+                done[i] = True
+                if flags[i] < 0:
+                    flags[i] = 0
+
+        if nactive == 0:
+            break
+
+    for i in range(nobs):
+        if not done[i]:
+            flags[i] = ADMOM_MAXITER_FLAG
+
+
+@njit
+def _admom_step(
+    image, weight, jac, wt, orig, old, shiftmax, etol, Ttol, sums, sums_cov,
+):
+    det = wt[2] * wt[4] - wt[3] * wt[3]
+    if det < ADMOM_LOW_DETVAL:
+        return ADMOM_LOW_DET_FLAG
+
+    # first the weight function is recentered on the weighted centroid
+    _admom_sums(image, weight, jac, wt, det, sums, sums_cov, False)
+    if sums[5] <= 0:
+        return ADMOM_NONPOS_FLUX_FLAG
+
+    wt[0] = sums[0] / sums[5]
+    wt[1] = sums[1] / sums[5]
+    if abs(wt[0] - orig[0]) > shiftmax or abs(wt[1] - orig[1]) > shiftmax:
+        return ADMOM_SHIFT_FLAG
+
+    # then the moments are measured about the new center
+    _admom_sums(image, weight, jac, wt, det, sums, sums_cov, True)
+    if sums[5] <= 0:
+        return ADMOM_NONPOS_FLUX_FLAG
+
+    finv = 1.0 / sums[5]
+    M1 = sums[2] * finv
+    M2 = sums[3] * finv
+    T = sums[4] * finv
+    if T <= 0:
+        return ADMOM_NONPOS_SIZE_FLAG
+
+    Irr = 0.5 * (T - M1)
+    Icc = 0.5 * (T + M1)
+    Irc = 0.5 * M2
+    e1 = (Icc - Irr) / T
+    e2 = 2 * Irc / T
+    if (
+        abs(e1 - old[0]) < etol
+        and abs(e2 - old[1]) < etol
+        and abs(T / old[2] - 1.0) < Ttol
+    ):
+        return -1
+
+    # the weight function is divided out of the measured moments to get the
+    # next weight function
+    detm = Irr * Icc - Irc * Irc
+    detw = wt[2] * wt[4] - wt[3] * wt[3]
+    if detm <= ADMOM_LOW_DETVAL or detw <= ADMOM_LOW_DETVAL:
+        return ADMOM_LOW_DET_FLAG
+
+    Nrr = Icc / detm - wt[4] / detw
+    Ncc = Irr / detm - wt[2] / detw
+    Nrc = -Irc / detm + wt[3] / detw
+    detn = Nrr * Ncc - Nrc * Nrc
+    if detn <= ADMOM_LOW_DETVAL:
+        return ADMOM_LOW_DET_FLAG
+
+    wt[2] = Ncc / detn
+    wt[3] = -Nrc / detn
+    wt[4] = Nrr / detn
+    old[0] = e1
+    old[1] = e2
+    old[2] = T
+    return 0
+
+
+@njit
+def _admom_sums(image, weight, jac, wt, det, sums, sums_cov, do_moments):
+    ny, nx = image.shape
+    row0 = jac[0]
+    col0 = jac[1]
+    dvdrow = jac[2]
+    dvdcol = jac[3]
+    dudrow = jac[4]
+    dudcol = jac[5]
+    norm = 1.0 / (2.0 * np.pi * np.sqrt(det))
+    idet = 1.0 / det
+
+    sums[:] = 0
+    sums_cov[:, :] = 0
+    F = np.zeros(6)
+    for row in range(ny):
+        for col in range(nx):
+            ivar = weight[row, col]
+            if ivar <= 0:
+                continue
+
+            v = dvdrow * (row - row0) + dvdcol * (col - col0)
+            u = dudrow * (row - row0) + dudcol * (col - col0)
+            vmod = v - wt[0]
+            umod = u - wt[1]
+            chi2 = (
+                wt[4] * vmod * vmod
+                + wt[2] * umod * umod
+                - 2.0 * wt[3] * vmod * umod
+            ) * idet
+            if chi2 >= GAUSS_MAX_CHI2:
+                continue
+
+            w = norm * np.exp(-0.5 * chi2)
+            wdata = w * image[row, col]
+            if not do_moments:
+                sums[0] += wdata * v
+                sums[1] += wdata * u
+                sums[5] += wdata
+                continue
+
+            w2var = w * w / ivar
+            F[0] = v
+            F[1] = u
+            F[2] = umod * umod - vmod * vmod
+            F[3] = 2.0 * vmod * umod
+            F[4] = umod * umod + vmod * vmod
+            F[5] = 1.0
+            for j in range(6):
+                sums[j] += wdata * F[j]
+                for k in range(6):
+                    sums_cov[j, k] += w2var * F[j] * F[k]
+
+
+def measure_moments_batch_multi(
+    *, fitters, obs_list, no_psf=False, fourier_cache=None,
+):
+    """Measure the moments of a list of observations for several fitters.
+
+    The pre-PSF moments fitters with the same padding factor share the FFTs of
+    the images and PSF images, so that each additional pre-PSF fitter only costs
+    the sums over its Fourier-space kernels. The results for each fitter are
+    identical to those from `measure_moments_batch`.
+
+    Parameters
+    ----------
+    fitters : list of ngmix fitters
+        The fitters whose measurements are done in batch. See `supports_batch`.
+    obs_list : list of ngmix.Observation
+        The observations to measure.
+    no_psf : bool, optional
+        If True, the pre-PSF moments are measured without deconvolving the PSF.
+        See `measure_moments_batch`. Default is False.
+    fourier_cache : FourierCache, optional
+        If not None, the pre-PSF moments kernels and PSF transforms are looked
+        up in and stored to this cache. Default is None.
+
+    Returns
+    -------
+    res : list of list of dict
+        The moments results for each fitter, one per observation, in the same
+        format as those from `fitter.go`.
+    """
+    for fitter in fitters:
+        if not supports_batch(fitter):
+            raise ValueError(
+                "Fitter %s does not have a batch version!"
+                % fitter.__class__.__name__
+            )
+
+    all_res = [None] * len(fitters)
+    prepsf_inds = {}
+    for i, fitter in enumerate(fitters):
+        if isinstance(fitter, ngmix.prepsfmom.PrePSFMom):
+            prepsf_inds.setdefault(
+                getattr(fitter, "pad_factor", 4), [],
+            ).append(i)
+        else:
+            all_res[i] = measure_moments_batch(fitter=fitter, obs_list=obs_list)
+
+    for inds in prepsf_inds.values():
+        _all_res = _measure_prepsfmom_batch(
+            fitters=[fitters[i] for i in inds],
+            obs_list=obs_list,
+            no_psf=no_psf,
+            fourier_cache=fourier_cache,
+        )
+        for i, res in zip(inds, _all_res):
+            all_res[i] = res
+
+    return all_res
+
+
+def _measure_prepsfmom_batch(*, fitters, obs_list, no_psf, fourier_cache):
+    kernels = []
+    for fitter in fitters:
+        kernels.append(dict(
+            kernel=(
+                "ksigma"
+                if isinstance(fitter, ngmix.prepsfmom.KSigmaMom)
+                else "pgauss"
+            ),
+            fwhm=fitter.fwhm,
+            fwhm_smooth=getattr(fitter, "fwhm_smooth", 0),
+        ))
+    pad_factor = getattr(fitters[0], "pad_factor", 4)
+
+    all_res = [[None] * len(obs_list) for _ in fitters]
+    for inds in _group_by_shape_and_jacobian(obs_list, no_psf):
+        for start in range(0, len(inds), MAX_FFT_BATCH_SIZE):
+            _inds = inds[start:start + MAX_FFT_BATCH_SIZE]
+            _obs_list = [obs_list[i] for i in _inds]
+            images, weights, jacs = _stack_obs(_obs_list)
+            if no_psf:
+                psf_images = None
+                psf_jacs = None
+            else:
+                psf_images, _, psf_jacs = _stack_obs([obs.psf for obs in _obs_list])
+
+            all_sums = get_prepsfmom_sums_multi(
+                images=images,
+                weights=weights,
+                jacs=jacs,
+                psf_images=psf_images,
+                psf_jacs=psf_jacs,
+                kernels=kernels,
+                pad_factor=pad_factor,
+                fourier_cache=fourier_cache,
+            )
+            for res, (sums, sums_cov, sums_norm) in zip(all_res, all_sums):
+                for k, i in enumerate(_inds):
+                    res[i] = make_mom_result(sums[k], sums_cov[k], sums_norm)
+
+    return all_res
+
+
+def get_prepsfmom_sums(
+    *, images, weights, jacs, kernel, fwhm, psf_images=None, psf_jacs=None,
+    fwhm_smooth=0, pad_factor=4, fourier_cache=None,
+):
+    """Compute the pre-PSF moment sums for a stack of images.
+
+    The images and PSF images are zero-padded and FFTed together. The PSF is
+    deconvolved and the moments are computed by summing the products of the
+    deconvolved image and the analytic Fourier-space moment kernels. Following
+    ngmix, the first two moments (the centroid) are not measured and are set
+    to NaN.
+
+    Parameters
+    ----------
+    images : np.ndarray
+        The images, shape (nobs, ny, nx).
+    weights : np.ndarray
+        The inverse variance weight maps, shape (nobs, ny, nx).
+    jacs : np.ndarray
+        The Jacobians, shape (nobs, 6). See `get_jacobian_array`. All of the
+        images must have the same Jacobian matrix, but their centers can differ.
+    kernel : str
+        The moments kernel. One of "pgauss" or "ksigma".
+    fwhm : float
+        The FWHM of the moments kernel.
+    psf_images : np.ndarray, optional
+        The PSF images, shape (nobs, npsf_y, npsf_x). If None, the PSF is not
+        deconvolved. Default is None.
+    psf_jacs : np.ndarray, optional
+        The PSF Jacobians, shape (nobs, 6). Only used for the centers of the
+        PSF images. Required if `psf_images` is given.
+    fwhm_smooth : float, optional
+        The FWHM of a Gaussian used to smooth the images before measuring the
+        moments. Default is 0.
+    pad_factor : float, optional
+        The images are zero-padded to this factor times the largest image
+        dimension before the FFTs. Default is 4.
+    fourier_cache : FourierCache, optional
+        If not None, the moments kernels and the PSF transforms are looked up
+        in and stored to this cache. Default is None.
+
+    Returns
+    -------
+    sums : np.ndarray
+        The moment sums, shape (nobs, 6).
+    sums_cov : np.ndarray
+        The covariance of the moment sums, shape (nobs, 6, 6).
+    sums_norm : float
+        The sum of the moments weight function over the pixels.
+    """
+    return get_prepsfmom_sums_multi(
+        images=images,
+        weights=weights,
+        jacs=jacs,
+        psf_images=psf_images,
+        psf_jacs=psf_jacs,
+        kernels=[dict(kernel=kernel, fwhm=fwhm, fwhm_smooth=fwhm_smooth)],
+        pad_factor=pad_factor,
+        fourier_cache=fourier_cache,
+    )[0]
+
+
+def get_prepsfmom_sums_multi(
+    *, images, weights, jacs, kernels, psf_images=None, psf_jacs=None,
+    pad_factor=4, fourier_cache=None,
+):
+    """Compute the pre-PSF moment sums for a stack of images for several
+    moments kernels.
+
+    The images and PSF images are FFTed once and the sums for each kernel are
+    computed from the shared transforms. See `get_prepsfmom_sums` for the
+    details.
+
+    Parameters
+    ----------
+    images : np.ndarray
+        The images, shape (nobs, ny, nx).
+    weights : np.ndarray
+        The inverse variance weight maps, shape (nobs, ny, nx).
+    jacs : np.ndarray
+        The Jacobians, shape (nobs, 6). See `get_prepsfmom_sums`.
+    kernels : list of dict
+        The moments kernels. Each entry has the keys "kernel", "fwhm" and
+        "fwhm_smooth". See `get_prepsfmom_sums`.
+    psf_images : np.ndarray, optional
+        The PSF images, shape (nobs, npsf_y, npsf_x). If None, the PSF is not
+        deconvolved. Default is None.
+    psf_jacs : np.ndarray, optional
+        The PSF Jacobians, shape (nobs, 6). Required if `psf_images` is given.
+    pad_factor : float, optional
+        The images are zero-padded to this factor times the largest image
+        dimension before the FFTs. Default is 4.
+    fourier_cache : FourierCache, optional
+        If not None, the moments kernels and the PSF transforms are looked up
+        in and stored to this cache. Default is None.
+
+    Returns
+    -------
+    all_sums : list of tuple
+        The tuple (sums, sums_cov, sums_norm) for each kernel. See
+        `get_prepsfmom_sums`.
+    """
+    dims = list(images.shape[1:])
+    if psf_images is not None:
+        dims += list(psf_images.shape[1:])
+    fft_dim = int(max(dims) * pad_factor)
+    eff_pad_factor = fft_dim / max(images.shape[1:])
+
+    kim = _zero_pad_and_rfft(images, fft_dim)
+    im_row, im_col = _get_padded_cen(jacs, images.shape, fft_dim)
+
+    if psf_images is not None:
+        if fourier_cache is not None:
+            kpsf = [
+                fourier_cache.get_psf_rfft(psf_image=psf_image, fft_dim=fft_dim)
+                for psf_image in psf_images
+            ]
+        else:
+            kpsf = get_psf_rfft(psf_images=psf_images, fft_dim=fft_dim)
+        psf_row, psf_col = _get_padded_cen(psf_jacs, psf_images.shape, fft_dim)
+    else:
+        kpsf = None
+        psf_row = 0.0
+        psf_col = 0.0
+
+    # each Fourier mode is independent with a variance equal to the total variance
+    # in the image, which we correct for the padding
+    tot_var = np.array([np.sum(1.0 / wgt[wgt > 0]) for wgt in weights])
+    tot_var *= eff_pad_factor**2
+
+    all_sums = []
+    for kernel in kernels:
+        if fourier_cache is not None:
+            fkernels = fourier_cache.get_kernels(
+                fft_dim=fft_dim, jac=jacs[0], **kernel,
+            )
+        else:
+            fkernels = get_fourier_kernels(fft_dim=fft_dim, jac=jacs[0], **kernel)
+
+        all_sums.append(_get_prepsfmom_sums_from_rfft(
+            kim=kim,
+            kpsf=kpsf,
+            drow=im_row - psf_row,
+            dcol=im_col - psf_col,
+            tot_var=tot_var,
+            fkernels=fkernels,
+            fft_dim=fft_dim,
+        ))
+
+    return all_sums
+
+
+def _get_prepsfmom_sums_from_rfft(
+    *, kim, kpsf, drow, dcol, tot_var, fkernels, fft_dim,
+):
+    nobs = kim.shape[0]
+    msk = fkernels["msk"]
+    kim = kim[:, msk]
+
+    if kpsf is not None:
+        kpsf = np.stack([_kpsf[msk] for _kpsf in kpsf])
+
+        # the small modes of the PSF are clipped
+        abs_kpsf = np.abs(kpsf)
+        clip = abs_kpsf <= MIN_PSF_FRAC
+        if np.any(clip):
+            kpsf[clip] = kpsf[clip] / abs_kpsf[clip] * MIN_PSF_FRAC
+        kim /= kpsf
+        inv_psf2 = 1.0 / np.abs(kpsf)**2
+    else:
+        inv_psf2 = np.ones((1, kim.shape[1]))
+
+    # this phase moves the center of the object to the origin
+    kim *= np.exp(2.0j * np.pi * (
+        fkernels["f_row"][msk][None, :] * drow[:, None]
+        + fkernels["f_col"][msk][None, :] * dcol[:, None]
+    ))
+
+    # the sums below are inverse FFTs evaluated only at the origin
+    # we use the real FFT so the modes in the half plane are weighted to account
+    # for the missing ones
+    fkerns = np.stack([
+        fkernels["fkp"][msk],
+        fkernels["fkc"][msk],
+        fkernels["fkr"][msk],
+        fkernels["fkf"][msk],
+    ])
+    wfkerns = fkerns * fkernels["wgt"][msk][None, :]
+    df2 = 1.0 / fft_dim**2
+
+    sums = np.zeros((nobs, 6), dtype=np.float64)
+    sums[:, 0:2] = np.nan
+    sums[:, 2:] = np.dot(kim.real, wfkerns.T) * df2
+
+    mode_cov = np.einsum("nk,ik,jk->nij", inv_psf2, wfkerns, fkerns) * df2 * df2
+    sums_cov = np.zeros((nobs, 6, 6), dtype=np.float64)
+    sums_cov[:, 2:, 2:] = mode_cov * tot_var[:, None, None]
+
+    return sums, sums_cov, fkernels["fkf"][0, 0]
+
+
+def get_fourier_kernels(*, kernel, fwhm, fft_dim, jac, fwhm_smooth=0):
+    """Compute the Fourier-space moment kernels for the pre-PSF moments.
+
+    The kernels are built with the kernel functions of `ngmix.prepsfmom` so that
+    the batch moments agree with `ngmix.prepsfmom.PrePSFMom` to round-off. They
+    are the discrete Fourier transforms of the weight function times
+    [u^2 - v^2, 2uv, u^2 + v^2, 1] for an image with the weight function centered
+    at the origin. The kernels are returned for the half plane of frequencies
+    used by `numpy.fft.rfft2`.
+
+    Parameters
+    ----------
+    kernel : str
+        The moments kernel. One of "pgauss" or "ksigma".
+    fwhm : float
+        The FWHM of the moments kernel.
+    fft_dim : int
+        The dimension of the FFT.
+    jac : np.ndarray
+        The Jacobian array. See `get_jacobian_array`.
+    fwhm_smooth : float, optional
+        The FWHM of a Gaussian used to smooth the image before measuring the
+        moments. Default is 0.
+
+    Returns
+    -------
+    kernels : dict
+        A dictionary with the kernels "fkp", "fkc", "fkr" and "fkf", the
+        frequencies "f_row" and "f_col" in cycles per pixel, the half plane
+        weights "wgt", and the boolean mask "msk" of the modes where the
+        kernels are non-zero.
+    """
+    if kernel == "pgauss":
+        kernel_func = ngmix.prepsfmom._gauss_kernels
+    elif kernel == "ksigma":
+        kernel_func = ngmix.prepsfmom._ksigma_kernels
+    else:
+        raise ValueError("kernel '%s' not recognized!" % kernel)
+
+    dvdrow, dvdcol, dudrow, dudcol = jac[2:]
+    ngmix_kernels = kernel_func(
+        fft_dim, fwhm, dvdrow, dvdcol, dudrow, dudcol, fwhm_smooth,
+    )
+
+    # ngmix packs the kernels into the modes where they are non-zero and uses the
+    # full plane of frequencies of `numpy.fft.fft2`, so we unpack them and keep
+    # the columns of the half plane
+    nhalf = fft_dim // 2 + 1
+    full_msk = ngmix_kernels["msk"]
+    kernels = {}
+    for name in ["fkf", "fkr", "fkp", "fkc"]:
+        fk = np.zeros((fft_dim, fft_dim), dtype=np.float64)
+        fk[full_msk] = np.real(ngmix_kernels[name])
+        kernels[name] = fk[:, :nhalf]
+    kernels["msk"] = full_msk[:, :nhalf]
+
+    # the frequencies match the ones ngmix uses for the centering phase, so the
+    # Nyquist column is at -1/2 cycles per pixel
+    freq = np.fft.fftfreq(fft_dim)
+    kernels["f_row"] = freq[:, None] * np.ones((1, nhalf))
+    kernels["f_col"] = freq[None, :nhalf] * np.ones((fft_dim, 1))
+
+    # the modes in the half plane stand in for their complex conjugates except
+    # for the first and the Nyquist columns
+    wgt = np.ones((fft_dim, nhalf)) * 2.0
+    wgt[:, 0] = 1.0
+    if fft_dim % 2 == 0:
+        wgt[:, -1] = 1.0
+    kernels["wgt"] = wgt
+
+    return kernels
+
+
+def get_psf_rfft(*, psf_images, fft_dim):
+    """Compute the real FFTs of zero-padded PSF images normalized to unit flux.
+
+    Parameters
+    ----------
+    psf_images : np.ndarray
+        The PSF images, shape (nobs, npsf_y, npsf_x).
+    fft_dim : int
+        The dimension of the FFT.
+
+    Returns
+    -------
+    kpsf : np.ndarray
+        The PSF transforms, shape (nobs, fft_dim, fft_dim // 2 + 1).
+    """
+    kpsf = _zero_pad_and_rfft(psf_images, fft_dim)
+    return kpsf / kpsf[:, 0:1, 0:1]
+
+
+def _zero_pad_and_rfft(images, fft_dim):
+    nobs, ny, nx = images.shape
+    pad_row, pad_col = _get_pad(images.shape, fft_dim)
+    pim = np.zeros((nobs, fft_dim, fft_dim), dtype=np.float64)
+    pim[:, pad_row:pad_row + ny, pad_col:pad_col + nx] = images
+    return np.fft.rfft2(pim)
+
+
+def _get_pad(shape, fft_dim):
+    return (fft_dim - shape[-2]) // 2, (fft_dim - shape[-1]) // 2
+
+
+def _get_padded_cen(jacs, shape, fft_dim):
+    pad_row, pad_col = _get_pad(shape, fft_dim)
+    return jacs[:, 0] + pad_row, jacs[:, 1] + pad_col
+
+
+def _get_array_hash(arr):
+    arr = np.ascontiguousarray(arr)
+    h = hashlib.sha1()
+    h.update(str((arr.shape, arr.dtype.str)).encode("ascii"))
+    h.update(arr.tobytes())
+    return h.hexdigest()
+
+
+def get_jacobian_array(jacobian):
+    """Get the parameters of an ngmix Jacobian as an array.
+
+    Parameters
+    ----------
+    jacobian : ngmix.Jacobian
+        The Jacobian.
+
+    Returns
+    -------
+    jac : np.ndarray
+        The array [row0, col0, dvdrow, dvdcol, dudrow, dudcol].
+    """
+    row0, col0 = jacobian.get_cen()
+    return np.array([
+        row0, col0,
+        jacobian.dvdrow, jacobian.dvdcol,
+        jacobian.dudrow, jacobian.dudcol,
+    ])
+
+
+def _group_by_shape(obs_list):
+    groups = {}
+    for i, obs in enumerate(obs_list):
+        groups.setdefault(obs.image.shape, []).append(i)
+    return list(groups.values())
+
+
+def _group_by_shape_and_jacobian(obs_list, no_psf):
+    groups = {}
+    for i, obs in enumerate(obs_list):
+        key = (
+            obs.image.shape,
+            None if no_psf else obs.psf.image.shape,
+            tuple(get_jacobian_array(obs.jacobian)[2:]),
+        )
+        groups.setdefault(key, []).append(i)
+    return list(groups.values())
+
+
+def _stack_obs(obs_list):
+    images = np.stack([obs.image for obs in obs_list])
+    weights = np.stack([obs.weight for obs in obs_list])
+    jacs = np.stack([get_jacobian_array(obs.jacobian) for obs in obs_list])
+    return images, weights, jacs
@@ -0,0 +1,260 @@
+import numpy as np
+import ngmix
+import pytest
+
+from ..detect import CatalogMEDSifier, LazyMBObsList
+from ..defaults import BMASK_EDGE
+from ..util import get_obs_flags, obs_cache_scope
+from .. import procflags
+
+
+def _make_mbobs(rng, nband=2, dims=(61, 53)):
+    mbobs = ngmix.MultiBandObsList()
+    for band in range(nband):
+        psf_obs = ngmix.Observation(
+            image=rng.uniform(size=(21, 21)),
+            jacobian=ngmix.DiagonalJacobian(scale=0.2, row=10, col=10),
+        )
+        obs = ngmix.Observation(
+            image=rng.normal(size=dims),
+            weight=rng.uniform(size=dims, low=1, high=2),
+            bmask=rng.randint(low=0, high=8, size=dims).astype(np.int32),
+            noise=rng.normal(size=dims),
+            jacobian=ngmix.DiagonalJacobian(scale=0.2, row=30, col=26),
+            psf=psf_obs,
+        )
+        obslist = ngmix.ObsList()
+        obslist.append(obs)
+        mbobs.append(obslist)
+    return mbobs
+
+
+@pytest.mark.parametrize("type", ["image", "weight", "seg", "bmask", "noise"])
+def test_stamp_cubes_get_cutout(type):
+    rng = np.random.RandomState(seed=45)
+    mbobs = _make_mbobs(rng)
+    dims = mbobs[0][0].image.shape
+
+    nobj = 40
+    x = rng.uniform(size=nobj, low=0, high=dims[1] - 1)
+    y = rng.uniform(size=nobj, low=0, high=dims[0] - 1)
+    box_sizes = rng.choice([8, 16, 32], size=nobj).astype(np.int32)
+    seg = rng.randint(low=0, high=nobj, size=dims).astype(np.int32)
+
+    medsifier = CatalogMEDSifier(mbobs, x, y, box_sizes, seg=seg)
+    mbm = medsifier.get_multiband_meds()
+    mbm_cubes = medsifier.get_multiband_meds(stamp_cubes=True)
+
+    nedge = 0
+    for iobj in range(nobj):
+        start_row = medsifier.cat['orig_start_row'][iobj, 0]
+        start_col = medsifier.cat['orig_start_col'][iobj, 0]
+        if (
+            start_row + box_sizes[iobj] > dims[0]
+            or start_col + box_sizes[iobj] > dims[1]
+        ):
+            nedge += 1
+
+        for band in range(len(mbobs)):
+            expected = mbm.mlist[band].get_cutout(iobj, 0, type=type)
+            cutout = mbm_cubes.mlist[band].get_cutout(iobj, 0, type=type)
+            assert cutout.dtype == expected.dtype
+            assert not cutout.flags.writeable
+            np.testing.assert_array_equal(cutout, expected)
+
+    assert nedge > 0
+
+
+def test_stamp_cubes_skip():
+    rng = np.random.RandomState(seed=50)
+    mbobs = _make_mbobs(rng)
+    dims = mbobs[0][0].image.shape
+
+    nobj = 20
+    x = rng.uniform(size=nobj, low=0, high=dims[1] - 1)
+    y = rng.uniform(size=nobj, low=0, high=dims[0] - 1)
+    box_sizes = rng.choice([8, 16], size=nobj).astype(np.int32)
+    box_sizes[:2] = 32
+    skip = rng.uniform(size=nobj) < 0.5
+    skip[:2] = True
+
+    medsifier = CatalogMEDSifier(mbobs, x, y, box_sizes)
+    mbm = medsifier.get_multiband_meds()
+    mbm_cubes = medsifier.get_multiband_meds(stamp_cubes=True, skip=skip)
+
+    for iobj in range(nobj):
+        for band in range(len(mbobs)):
+            if skip[iobj]:
+                with pytest.raises(ValueError):
+                    mbm_cubes.mlist[band].get_cutout(iobj, 0, type="image")
+            else:
+                np.testing.assert_array_equal(
+                    mbm_cubes.mlist[band].get_cutout(iobj, 0, type="image"),
+                    mbm.mlist[band].get_cutout(iobj, 0, type="image"),
+                )
+
+    # only the stamps of the objects that are not skipped are gathered
+    cubes = mbm_cubes.mlist[0]._stamp_cubes
+    for box_size in [8, 16, 32]:
+        cube = cubes.get_cube(box_size, "image")
+        assert cube.shape[0] == np.sum((box_sizes == box_size) & ~skip)
+
+
+@pytest.mark.parametrize("weight_type", ["weight", "uberseg"])
+def test_stamp_cubes_get_mbobs_list(weight_type):
+    rng = np.random.RandomState(seed=46)
+    mbobs = _make_mbobs(rng)
+    dims = mbobs[0][0].image.shape
+
+    nobj = 10
+    x = rng.uniform(size=nobj, low=0, high=dims[1] - 1)
+    y = rng.uniform(size=nobj, low=0, high=dims[0] - 1)
+    box_sizes = np.full(nobj, 16, dtype=np.int32)
+    seg = rng.randint(low=0, high=nobj + 1, size=dims).astype(np.int32)
+
+    medsifier = CatalogMEDSifier(mbobs, x, y, box_sizes, seg=seg)
+    mbm = medsifier.get_multiband_meds()
+    mbobs_list = mbm.get_mbobs_list(weight_type=weight_type)
+    mbm_cubes = medsifier.get_multiband_meds(stamp_cubes=True)
+    mbobs_list_cubes = mbm_cubes.get_mbobs_list(weight_type=weight_type)
+
+    # the weight types that zero pixels do so in copies of the stamps
+    cubes = mbm_cubes.mlist[0]._stamp_cubes
+    for band in range(len(mbobs)):
+        np.testing.assert_array_equal(
+            cubes.get_cube(16, "weight")[:, band],
+            [
+                mbm.mlist[band].get_cutout(iobj, 0, type="weight")
+                for iobj in range(nobj)
+            ],
+        )
+
+    for _mbobs, _mbobs_cubes in zip(mbobs_list, mbobs_list_cubes):
+        for obslist, obslist_cubes in zip(_mbobs, _mbobs_cubes):
+            obs = obslist[0]
+            obs_cubes = obslist_cubes[0]
+            np.testing.assert_array_equal(obs.image, obs_cubes.image)
+            np.testing.assert_array_equal(obs.weight, obs_cubes.weight)
+            np.testing.assert_array_equal(obs.bmask, obs_cubes.bmask)
+            np.testing.assert_array_equal(obs.noise, obs_cubes.noise)
+            assert obs.jacobian.get_cen() == obs_cubes.jacobian.get_cen()
+
+
+def test_shared_psf():
+    rng = np.random.RandomState(seed=47)
+    mbobs = _make_mbobs(rng)
+    dims = mbobs[0][0].image.shape
+
+    nobj = 10
+    x = rng.uniform(size=nobj, low=0, high=dims[1] - 1)
+    y = rng.uniform(size=nobj, low=0, high=dims[0] - 1)
+    box_sizes = np.full(nobj, 16, dtype=np.int32)
+
+    medsifier = CatalogMEDSifier(mbobs, x, y, box_sizes)
+    mbobs_list = medsifier.get_multiband_meds().get_mbobs_list()
+    mbobs_list_shared = medsifier.get_multiband_meds(
+        shared_psf=True,
+    ).get_mbobs_list()
+
+    for band in range(len(mbobs)):
+        psf_obs = mbobs_list_shared[0][band][0].psf
+        assert psf_obs is not mbobs_list_shared[0][1 - band][0].psf
+
+        for _mbobs, _mbobs_shared in zip(mbobs_list, mbobs_list_shared):
+            assert _mbobs_shared[band][0].psf is psf_obs
+
+            obs = _mbobs[band][0]
+            np.testing.assert_array_equal(obs.psf.image, psf_obs.image)
+            np.testing.assert_array_equal(obs.psf.weight, psf_obs.weight)
+            assert obs.psf.jacobian.get_cen() == psf_obs.jacobian.get_cen()
+
+
+@pytest.mark.parametrize("bmask_flags", [0, 2**2, 2**2 | BMASK_EDGE])
+def test_get_stamp_flags(bmask_flags):
+    rng = np.random.RandomState(seed=48)
+    mbobs = _make_mbobs(rng)
+    dims = mbobs[0][0].image.shape
+    for obslist in mbobs:
+        obs = obslist[0]
+        with obs.writeable():
+            obs.bmask[:, :] = 0
+            obs.bmask[rng.randint(dims[0], size=4), rng.randint(dims[1], size=4)] = 2**2
+            obs.bmask[rng.randint(dims[0], size=4), rng.randint(dims[1], size=4)] = 2**3
+            obs.weight[:20, :20] = 0
+
+    nobj = 40
+    x = rng.uniform(size=nobj, low=0, high=dims[1] - 1)
+    y = rng.uniform(size=nobj, low=0, high=dims[0] - 1)
+    box_sizes = rng.choice([4, 8, 16], size=nobj).astype(np.int32)
+
+    medsifier = CatalogMEDSifier(mbobs, x, y, box_sizes)
+    stamp_flags = medsifier.get_stamp_flags(bmask_flags)
+    assert stamp_flags.shape == (nobj, len(mbobs))
+
+    mbobs_list = medsifier.get_multiband_meds(stamp_cubes=True).get_mbobs_list()
+    for _mbobs, _stamp_flags in zip(mbobs_list, stamp_flags):
+        for obslist, flags in zip(_mbobs, _stamp_flags):
+            assert flags == get_obs_flags(obslist[0], bmask_flags=bmask_flags)
+
+    for flag in [procflags.ZERO_WEIGHTS, procflags.EDGE_HIT]:
+        if bmask_flags != 0 or flag == procflags.ZERO_WEIGHTS:
+            assert np.any((stamp_flags & flag) != 0)
+            assert not np.all((stamp_flags & flag) != 0)
+
+
+@obs_cache_scope()
+def test_lazy_mbobs_list():
+    rng = np.random.RandomState(seed=49)
+    mbobs = _make_mbobs(rng)
+    dims = mbobs[0][0].image.shape
+
+    nobj = 10
+    x = rng.uniform(size=nobj, low=0, high=dims[1] - 1)
+    y = rng.uniform(size=nobj, low=0, high=dims[0] - 1)
+    box_sizes = rng.choice([8, 16], size=nobj).astype(np.int32)
+
+    medsifier = CatalogMEDSifier(mbobs, x, y, box_sizes)
+    mbobs_list = medsifier.get_multiband_meds().get_mbobs_list()
+
+    ncalls = [0]
+    mbm = medsifier.get_multiband_meds()
+    get_mbobs = mbm.get_mbobs
+
+    def _counting_get_mbobs(*args, **kwargs):
+        ncalls[0] += 1
+        return get_mbobs(*args, **kwargs)
+
+    mbm.get_mbobs = _counting_get_mbobs
+    stamp_flags = np.full((nobj, len(mbobs)), procflags.EDGE_HIT, dtype=np.int32)
+    lazy_mbobs_list = LazyMBObsList(mbm, stamp_flags=stamp_flags, bmask_flags=2**2)
+    assert len(lazy_mbobs_list) == nobj
+    assert ncalls[0] == 0
+
+    # the objects are made once when they are accessed
+    sub_mbobs_list = lazy_mbobs_list.take([7, 2])
+    assert len(sub_mbobs_list) == 2
+    assert sub_mbobs_list[1] is lazy_mbobs_list[2]
+    assert ncalls[0] == 1
+    assert lazy_mbobs_list[-3] is sub_mbobs_list[0]
+    assert ncalls[0] == 2
+
+    assert isinstance(lazy_mbobs_list[1:4], list)
+    assert lazy_mbobs_list[1:4][1] is lazy_mbobs_list[2]
+    assert ncalls[0] == 4
+
+    assert len(list(lazy_mbobs_list)) == nobj
+    assert ncalls[0] == nobj
+    with pytest.raises(IndexError):
+        lazy_mbobs_list[nobj]
+
+    for _mbobs, _lazy_mbobs in zip(mbobs_list, lazy_mbobs_list):
+        for obslist, lazy_obslist in zip(_mbobs, _lazy_mbobs):
+            obs = obslist[0]
+            lazy_obs = lazy_obslist[0]
+            for name in ["image", "weight", "bmask", "noise"]:
+                np.testing.assert_array_equal(
+                    getattr(obs, name), getattr(lazy_obs, name),
+                )
+
+            # the flags are the ones given
+            assert get_obs_flags(lazy_obs, bmask_flags=2**2) == procflags.EDGE_HIT
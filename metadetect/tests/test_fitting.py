@@ -5,20 +5,32 @@ import ngmix
 import pytest
 
 from ngmix.gaussmom import GaussMom
-from ngmix.moments import fwhm_to_T
+from ngmix.moments import fwhm_to_T, make_mom_result
 
 from .sim import make_mbobs_sim
 from ..fitting import (
     fit_mbobs_wavg,
+    fit_mbobs_list_wavg,
+    fit_mbobs_list_wavg_multi,
+    fit_mbobs_list_joint,
+    is_fixed_by_stamp_flags,
+    make_flagged_fit_res,
+    _combine_band_fit_results,
+    _combine_band_fit_results_arrays,
     _combine_fit_results_wavg,
     symmetrize_obs_weights,
+    get_symmetrized_obs,
     fit_all_psfs,
     _sum_bands_wavg,
     MOMNAME,
     _make_mom_res,
     combine_fit_res,
+    get_fit_res_dtype,
+    get_wavg_output_struct,
+    get_wavg_output_buffer,
 )
 from .. import procflags
+from ..util import get_obs_flags, obs_cache_scope
 
 
 def _print_res(res):
@@ -1232,6 +1244,41 @@ def test_fitting_symmetrize_obs_weights():
     assert np.array_equal(sym_obs.weight, sym_wgt)
 
 
+@obs_cache_scope()
+def test_fitting_get_symmetrized_obs():
+    rng = np.random.RandomState(seed=10)
+    obs = ngmix.Observation(
+        image=rng.normal(size=(13, 13)),
+        weight=np.ones((13, 13)),
+        bmask=np.zeros((13, 13), dtype=np.int32),
+        jacobian=ngmix.DiagonalJacobian(scale=0.2, row=6, col=6),
+    )
+    assert get_symmetrized_obs(obs) is obs
+
+    wgt = np.ones((13, 13))
+    wgt[2, 3:5] = 0
+    wgt[10, 12] = 0
+    obs.set_weight(wgt)
+    sym_obs = get_symmetrized_obs(obs)
+    assert sym_obs is not obs
+    assert get_symmetrized_obs(obs) is sym_obs
+    assert sym_obs.ignore_zero_weight is True
+    assert np.array_equal(sym_obs.weight, symmetrize_obs_weights(obs).weight)
+    assert np.array_equal(sym_obs.weight, np.rot90(sym_obs.weight))
+    assert np.array_equal(sym_obs.image, obs.image)
+    assert np.array_equal(sym_obs.bmask, obs.bmask)
+    assert sym_obs.jacobian.get_galsim_wcs() == obs.jacobian.get_galsim_wcs()
+
+    obs = ngmix.Observation(
+        image=np.zeros((13, 13)),
+        weight=np.zeros((13, 13)),
+        ignore_zero_weight=False,
+    )
+    sym_obs = get_symmetrized_obs(obs)
+    assert sym_obs.ignore_zero_weight is False
+    assert np.all(sym_obs.weight == 0)
+
+
 def test_fitting_fit_mbobs_wavg_wmom_tratio():
     fitter = GaussMom(1.2)
     seed = 10
@@ -1264,6 +1311,327 @@ def test_fitting_fit_mbobs_wavg_wmom_tratio():
     assert res["wmom_T_ratio"][0] > 1.5
 
 
+@pytest.mark.parametrize("shear_bands", [None, [0, 2]])
+def test_get_wavg_output_buffer(shear_bands):
+    buff = get_wavg_output_buffer(4, 3, "wmom", shear_bands=shear_bands)
+    res = get_wavg_output_struct(3, "wmom", shear_bands=shear_bands)
+    assert buff.shape == (4,)
+    assert buff.dtype == res.dtype
+    for i in range(4):
+        assert buff[i:i + 1].tobytes() == res.tobytes()
+
+    # the cached defaults cannot be changed through the outputs
+    buff["wmom_flags"] = 0
+    res["wmom_T"] = 10
+    new_res = get_wavg_output_struct(3, "wmom", shear_bands=shear_bands)
+    assert new_res["wmom_flags"] == procflags.NO_ATTEMPT
+    assert np.isnan(new_res["wmom_T"])
+
+
+@pytest.mark.parametrize("shear_bands", [None, [0], [1, 2]])
+def test_fitting_fit_mbobs_list_wavg_out(shear_bands):
+    fitter = GaussMom(1.2)
+    nband = 3
+    mbobs_list = [make_mbobs_sim(seed, nband) for seed in [10, 11, 12]]
+    mbobs_list[1][2][0].bmask[10, 10] = 1
+
+    res = fit_mbobs_list_wavg(
+        mbobs_list=mbobs_list,
+        fitter=fitter,
+        bmask_flags=1,
+        shear_bands=shear_bands,
+    )
+    ores = np.hstack([
+        fit_mbobs_wavg(
+            mbobs=mbobs,
+            fitter=fitter,
+            bmask_flags=1,
+            shear_bands=shear_bands,
+        )
+        for mbobs in mbobs_list
+    ])
+    assert res.dtype == ores.dtype
+    for name in res.dtype.names:
+        np.testing.assert_array_equal(res[name], ores[name], err_msg=name)
+
+
+@pytest.mark.parametrize("shear_bands", [None, [1, 2]])
+@pytest.mark.parametrize("fitter,symmetrize", [
+    (GaussMom(1.2), True),
+    (GaussMom(1.2), False),
+    ("admom", True),
+    ("gauss", False),
+])
+def test_make_flagged_fit_res(fitter, symmetrize, shear_bands):
+    nband = 3
+    mbobs_list = [make_mbobs_sim(seed, nband) for seed in [10, 11, 12, 13]]
+    mbobs_list[0][2][0].bmask[10, 10] = 1
+    for obslist in mbobs_list[1]:
+        with obslist[0].writeable():
+            obslist[0].ignore_zero_weight = False
+            obslist[0].weight[:, :] = 0
+    for obslist in mbobs_list[2]:
+        obslist[0].bmask[0, 0] = 1
+
+    stamp_flags = np.array([
+        [get_obs_flags(obslist[0], bmask_flags=1) for obslist in mbobs]
+        for mbobs in mbobs_list
+    ])
+    is_wavg = not isinstance(fitter, str)
+    is_fixed = is_fixed_by_stamp_flags(
+        stamp_flags=stamp_flags, is_wavg=is_wavg, symmetrize=symmetrize,
+    )
+    if is_wavg:
+        model = "wmom"
+        assert np.array_equal(is_fixed, [False, True, not symmetrize, False])
+        res = fit_mbobs_list_wavg(
+            mbobs_list=mbobs_list,
+            fitter=fitter,
+            bmask_flags=1,
+            shear_bands=shear_bands,
+            symmetrize=symmetrize,
+        )
+    else:
+        model = "am" if fitter == "admom" else fitter
+        assert np.array_equal(is_fixed, [True, True, True, False])
+        res = fit_mbobs_list_joint(
+            mbobs_list=mbobs_list,
+            fitter_name=fitter,
+            bmask_flags=1,
+            rng=np.random.RandomState(seed=10),
+            shear_bands=shear_bands,
+            symmetrize=symmetrize,
+        )
+
+    # only ZERO_WEIGHTS fixes the results if more flags can be set
+    assert np.array_equal(
+        is_fixed_by_stamp_flags(
+            stamp_flags=stamp_flags, is_wavg=is_wavg, symmetrize=symmetrize,
+            exact=False,
+        ),
+        [False, True, False, False],
+    )
+
+    fres = make_flagged_fit_res(
+        stamp_flags=stamp_flags[is_fixed],
+        model=model,
+        is_wavg=is_wavg,
+        shear_bands=shear_bands,
+    )
+    assert fres.dtype == res.dtype
+    for name in res.dtype.names:
+        np.testing.assert_array_equal(
+            fres[name], res[name][is_fixed], err_msg=name,
+        )
+
+
+def test_fitting_fit_mbobs_list_wavg_band_res_cache():
+    fitter = GaussMom(1.2)
+    nband = 3
+    mbobs_list = [make_mbobs_sim(seed, nband) for seed in [10, 11]]
+
+    band_res_cache = {}
+    for shear_bands in [None, [0], [1, 2]]:
+        res = fit_mbobs_list_wavg(
+            mbobs_list=mbobs_list,
+            fitter=fitter,
+            bmask_flags=0,
+            shear_bands=shear_bands,
+        )
+        cres = fit_mbobs_list_wavg(
+            mbobs_list=mbobs_list,
+            fitter=fitter,
+            bmask_flags=0,
+            shear_bands=shear_bands,
+            band_res_cache=band_res_cache,
+        )
+        assert len(band_res_cache) == len(mbobs_list) * nband
+        for name in res.dtype.names:
+            np.testing.assert_array_equal(res[name], cres[name])
+
+
+@pytest.mark.parametrize("fitter", [
+    GaussMom(1.2),
+    ngmix.prepsfmom.PGaussMom(2.0),
+])
+def test_fitting_fit_mbobs_list_wavg_psf_res_cache(fitter):
+    nband = 3
+    # the same seed gives the same PSFs so they should be fit only once
+    mbobs_list = [make_mbobs_sim(10, nband) for _ in range(3)]
+    mbobs_list.append(make_mbobs_sim(11, nband))
+
+    psf_res_cache = {}
+    res = fit_mbobs_list_wavg(
+        mbobs_list=mbobs_list,
+        fitter=fitter,
+        bmask_flags=0,
+    )
+    cres = fit_mbobs_list_wavg(
+        mbobs_list=mbobs_list,
+        fitter=fitter,
+        bmask_flags=0,
+        psf_res_cache=psf_res_cache,
+    )
+    assert len(psf_res_cache) == 2 * nband
+    for name in res.dtype.names:
+        np.testing.assert_array_equal(res[name], cres[name])
+
+
+@pytest.mark.parametrize("fitter,rtol", [
+    (GaussMom(1.2), 1e-6),
+    (ngmix.prepsfmom.PGaussMom(2.0), 1e-4),
+    (ngmix.prepsfmom.KSigmaMom(2.0), 1e-4),
+])
+@pytest.mark.parametrize("shear_bands", [None, [0], [1, 2]])
+@pytest.mark.parametrize("symmetrize", [True, False])
+def test_fitting_fit_mbobs_list_wavg_batch(shear_bands, symmetrize, fitter, rtol):
+    nband = 3
+    mbobs_list = [
+        make_mbobs_sim(seed, nband, band_image_sizes=[35, 41, 35])
+        for seed in [10, 11, 12]
+    ]
+    # flag one band to make sure flagged bands are not measured
+    mbobs_list[1][2][0].bmask[10, 10] = 1
+    # and remove a band
+    mbobs_list[2][0] = ngmix.ObsList()
+
+    res = fit_mbobs_list_wavg(
+        mbobs_list=mbobs_list,
+        fitter=fitter,
+        bmask_flags=1,
+        shear_bands=shear_bands,
+        symmetrize=symmetrize,
+    )
+    bres = fit_mbobs_list_wavg(
+        mbobs_list=mbobs_list,
+        fitter=fitter,
+        bmask_flags=1,
+        shear_bands=shear_bands,
+        symmetrize=symmetrize,
+        batch=True,
+    )
+    assert res.dtype == bres.dtype
+    for name in res.dtype.names:
+        if res[name].dtype.kind in ["f", "c"]:
+            np.testing.assert_allclose(
+                res[name], bres[name], rtol=rtol, atol=1e-12, err_msg=name,
+            )
+        else:
+            np.testing.assert_array_equal(res[name], bres[name], err_msg=name)
+
+
+@pytest.mark.parametrize("shear_bands", [None, [1, 2]])
+@pytest.mark.parametrize("symmetrize", [True, False])
+def test_fitting_fit_mbobs_list_wavg_multi(shear_bands, symmetrize):
+    nband = 3
+    mbobs_list = [
+        make_mbobs_sim(seed, nband, band_image_sizes=[35, 41, 35])
+        for seed in [10, 11, 12]
+    ]
+    mbobs_list[1][2][0].bmask[10, 10] = 1
+    mbobs_list[2][0] = ngmix.ObsList()
+
+    fitters = [
+        ngmix.prepsfmom.PGaussMom(2.0),
+        ngmix.prepsfmom.KSigmaMom(2.5),
+        GaussMom(1.2),
+    ]
+    fwhm_regs = [0, 0.8, 0]
+    all_res = fit_mbobs_list_wavg_multi(
+        mbobs_list=mbobs_list,
+        fitters=fitters,
+        bmask_flags=1,
+        shear_bands=shear_bands,
+        fwhm_regs=fwhm_regs,
+        symmetrize=symmetrize,
+    )
+    assert len(all_res) == len(fitters)
+    for fitter, fwhm_reg, mres in zip(fitters, fwhm_regs, all_res):
+        res = fit_mbobs_list_wavg(
+            mbobs_list=mbobs_list,
+            fitter=fitter,
+            bmask_flags=1,
+            shear_bands=shear_bands,
+            fwhm_reg=fwhm_reg,
+            symmetrize=symmetrize,
+            batch=True,
+        )
+        assert res.dtype == mres.dtype
+        for name in res.dtype.names:
+            np.testing.assert_array_equal(res[name], mres[name], err_msg=name)
+
+
+def _make_random_fres(rng, no_cen):
+    if rng.uniform() < 0.1:
+        return dict(flags=procflags.EDGE_HIT, wgt=0, obj_res=None, psf_res=None)
+
+    all_res = []
+    for _ in range(2):
+        sums = rng.normal(size=6)
+        sums[4] = np.abs(sums[4]) + 0.5
+        sums[5] = np.abs(sums[5]) + 1
+        if rng.uniform() < 0.1:
+            sums[5] *= -1
+        if rng.uniform() < 0.1:
+            sums[4] *= -1
+        if rng.uniform() < 0.05:
+            sums[5] = 0
+        amat = rng.normal(size=(6, 6))
+        sums_cov = np.dot(amat, amat.T) + np.eye(6)
+        if rng.uniform() < 0.05:
+            sums_cov[5, 5] = -1
+        if rng.uniform() < 0.05:
+            sums_cov[2, 2] = 0
+        if no_cen:
+            sums[:2] = np.nan
+            sums_cov[:2, :] = 0
+            sums_cov[:, :2] = 0
+        sums_norm = rng.choice([rng.uniform(low=0.5, high=2), np.nan])
+        all_res.append(make_mom_result(sums, sums_cov, sums_norm))
+
+    wgt = rng.uniform(low=0.5, high=2) if rng.uniform() > 0.05 else 0.0
+    return dict(flags=0, wgt=wgt, obj_res=all_res[0], psf_res=all_res[1])
+
+
+@pytest.mark.parametrize("nband", [1, 2, 4])
+@pytest.mark.parametrize("shear_bands", [None, [0], [1, 2], []])
+@pytest.mark.parametrize("fwhm_reg", [0, 0.8])
+@pytest.mark.parametrize("no_cen", [True, False])
+def test_combine_band_fit_results_arrays(nband, shear_bands, fwhm_reg, no_cen):
+    if shear_bands is not None and any(b >= nband for b in shear_bands):
+        pytest.skip("shear bands are not in the data")
+
+    rng = np.random.RandomState(seed=nband)
+    all_fres_list = [
+        [_make_random_fres(rng, no_cen) for _ in range(nband)]
+        for _ in range(50)
+    ]
+
+    res = np.hstack([
+        _combine_band_fit_results(
+            all_fres=all_fres,
+            model="wmom",
+            shear_bands=shear_bands,
+            fwhm_reg=fwhm_reg,
+        )
+        for all_fres in all_fres_list
+    ])
+    ares = _combine_band_fit_results_arrays(
+        all_fres_list=all_fres_list,
+        model="wmom",
+        shear_bands=shear_bands,
+        fwhm_reg=fwhm_reg,
+    )
+    assert res.dtype == ares.dtype
+    for name in res.dtype.names:
+        if res[name].dtype.kind == "f":
+            np.testing.assert_allclose(
+                res[name], ares[name], rtol=1e-12, atol=0, err_msg=name,
+            )
+        else:
+            np.testing.assert_array_equal(res[name], ares[name], err_msg=name)
+
+
 @pytest.mark.parametrize("fwhm_reg", [0, 0.8])
 @pytest.mark.parametrize("has_nan", [True, False])
 @pytest.mark.parametrize("zero_flux", [True, False])
@@ -1449,3 +1817,27 @@ def test_combine_fit_res():
     np.testing.assert_array_equal(res["a"], np.array([0.3, 2.3], dtype="f4"))
     np.testing.assert_array_equal(res["b"], np.array([1.4, 4.6], dtype="f8"))
     np.testing.assert_array_equal(res["shear_bands"], np.array([0, 2], dtype="i4"))
+
+
+def test_combine_fit_res_out():
+    models = ["wmom", "pgauss", "am"]
+    all_res = [
+        get_wavg_output_buffer(3, 2, model, shear_bands=[0, 1])
+        for model in models
+    ]
+    for i, (res, model) in enumerate(zip(all_res, models)):
+        res[model + "_T"] = np.arange(3) + i
+
+    expected = combine_fit_res(all_res)
+
+    dt = get_fit_res_dtype(models=models, nband=2)
+    out = np.zeros(3, dtype=dt + [("x", "f4")])
+    res = combine_fit_res(all_res, out=out)
+    assert res is out
+    assert res.dtype.names[:-1] == expected.dtype.names
+    for col in expected.dtype.names:
+        np.testing.assert_array_equal(res[col], expected[col])
+
+    with pytest.raises(RuntimeError) as e:
+        combine_fit_res(all_res, out=np.zeros(2, dtype=dt))
+    assert "same length" in str(e.value)
@@ -1,5 +1,8 @@
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import ngmix
+import ngmix.gaussmom
 
 import pytest
 
@@ -7,7 +10,11 @@ from .sim import make_mbobs_sim
 from ..fitting import (
     fit_mbobs_admom,
     fit_mbobs_list_joint,
+    fit_mbobs_list_admom_batch,
+    fit_mbobs_list_wavg,
     make_coadd_obs,
+    make_coadd_obs_list,
+    get_fit_guesses,
     get_admom_runner,
     symmetrize_obs_weights,
     fit_mbobs_gauss,
@@ -499,6 +506,386 @@ def test_fit_mbobs_list_joint_seeding(shear_bands, fname, coadd, symmetrize):
         )
 
 
+@pytest.mark.parametrize("shear_bands", [None, [0], [2, 3, 1]])
+@pytest.mark.parametrize("fname,coadd", [
+    ("am", False),
+    ("gauss", False),
+    ("gauss", True),
+])
+def test_fit_mbobs_list_joint_psf_fit_cache(shear_bands, fname, coadd):
+    # the objects all have the same PSFs so they should be fit only once
+    mbobs_list = [make_mbobs_sim(45, 4, wcs_var_scale=0) for _ in range(3)]
+    res = fit_mbobs_list_joint(
+        mbobs_list=mbobs_list,
+        fitter_name=fname,
+        bmask_flags=0,
+        rng=np.random.RandomState(seed=4235),
+        shear_bands=shear_bands,
+        coadd=coadd,
+    )
+
+    mbobs_list = [make_mbobs_sim(45, 4, wcs_var_scale=0) for _ in range(3)]
+    psf_fit_cache = {}
+    cres = fit_mbobs_list_joint(
+        mbobs_list=mbobs_list,
+        fitter_name=fname,
+        bmask_flags=0,
+        rng=np.random.RandomState(seed=4235),
+        shear_bands=shear_bands,
+        coadd=coadd,
+        psf_fit_cache=psf_fit_cache,
+    )
+
+    if fname == "am" or coadd:
+        assert len(psf_fit_cache[fname]) == 1
+    elif shear_bands is None:
+        assert len(psf_fit_cache[fname]) == 4
+    else:
+        assert len(psf_fit_cache[fname]) == len(shear_bands)
+
+    n = fname + "_"
+    for col in ["flags", "psf_flags", "obj_flags"]:
+        np.testing.assert_array_equal(res[n + col], cres[n + col])
+    assert np.all(cres[n + "psf_T"] == cres[n + "psf_T"][0])
+    for col in ["psf_T", "psf_g", "T", "g"]:
+        np.testing.assert_allclose(
+            res[n + col], cres[n + col], rtol=0, atol=1e-4, err_msg=col,
+        )
+
+
+def _make_full_stamp_cat():
+    cat = np.zeros(1, dtype=[("x", "f8"), ("y", "f8"), ("box_size", "i4")])
+    cat["x"] = 22
+    cat["y"] = 22
+    cat["box_size"] = 45
+    return cat
+
+
+@pytest.mark.parametrize("shear_bands", [None, [1, 2]])
+@pytest.mark.parametrize("fname", ["am", "gauss"])
+def test_fit_mbobs_list_joint_coadd_obs_list(shear_bands, fname):
+    # the stamps cover the full images so the coadds of the images and of the
+    # stamps are the same
+    mbobs_list = [make_mbobs_sim(45, 4, wcs_var_scale=0) for _ in range(3)]
+    res = fit_mbobs_list_joint(
+        mbobs_list=mbobs_list,
+        fitter_name=fname,
+        bmask_flags=0,
+        rng=np.random.RandomState(seed=4235),
+        shear_bands=shear_bands,
+        coadd=True,
+    )
+
+    mbobs_list = [make_mbobs_sim(45, 4, wcs_var_scale=0) for _ in range(3)]
+    coadd_obs_list = []
+    for mbobs in mbobs_list:
+        _coadd_obs_list = make_coadd_obs_list(
+            mbobs=mbobs, shear_bands=shear_bands, cat=_make_full_stamp_cat(),
+        )
+        assert len(_coadd_obs_list) == 1
+
+        coadd_obs, flags = make_coadd_obs(mbobs, shear_bands=shear_bands)
+        assert flags == 0
+        np.testing.assert_allclose(_coadd_obs_list[0].image, coadd_obs.image)
+        np.testing.assert_allclose(_coadd_obs_list[0].weight, coadd_obs.weight)
+        coadd_obs_list.append(_coadd_obs_list[0])
+
+    cres = fit_mbobs_list_joint(
+        mbobs_list=mbobs_list,
+        fitter_name=fname,
+        bmask_flags=0,
+        rng=np.random.RandomState(seed=4235),
+        shear_bands=shear_bands,
+        coadd=True,
+        coadd_obs_list=coadd_obs_list,
+    )
+
+    n = fname + "_"
+    for col in ["flags", "psf_flags", "obj_flags"]:
+        np.testing.assert_array_equal(res[n + col], cres[n + col])
+    for col in ["psf_T", "psf_g", "T", "g"]:
+        np.testing.assert_allclose(
+            res[n + col], cres[n + col], rtol=0, atol=1e-4, err_msg=col,
+        )
+
+
+def _get_mom(T, e1, e2):
+    return np.array([[T * (1 - e1) / 2, T * e2 / 2], [T * e2 / 2, T * (1 + e1) / 2]])
+
+
+def _get_T_g(mom):
+    T = mom[0, 0] + mom[1, 1]
+    e = np.array([mom[1, 1] - mom[0, 0], 2 * mom[0, 1]]) / T
+    return T, e / (1 + np.sqrt(1 - np.sum(e**2)))
+
+
+def test_get_fit_guesses():
+    res = np.zeros(4, dtype=[
+        ("wmom_flags", "i4"), ("wmom_T", "f8"), ("wmom_g", "f8", 2),
+        ("wmom_psf_T", "f8"), ("wmom_psf_g", "f8", 2),
+    ])
+    res["wmom_T"] = [0.3, 0.3, -0.1, 0.3]
+    res["wmom_g"] = [[0.1, 0.05], [0.1, 0.05], [0.1, 0.05], [0.9, 0.9]]
+    res["wmom_psf_T"] = 0.2
+    res["wmom_flags"] = [0, 1, 0, 0]
+
+    guesses = get_fit_guesses(res, "wmom", target="am", fwhm=1.2)
+    assert np.isfinite(guesses["T"][0])
+    assert np.all(np.isnan(guesses["T"][1:]))
+
+    with pytest.raises(ValueError):
+        get_fit_guesses(res, "wmom", target="am")
+    with pytest.raises(ValueError):
+        get_fit_guesses(res, "wmom", target="wmom", fwhm=1.2)
+    with pytest.raises(ValueError):
+        get_fit_guesses(res, "admom", target="am")
+
+
+@pytest.mark.parametrize("target", ["am", "gauss"])
+@pytest.mark.parametrize("model,fwhm_reg", [
+    ("wmom", 0), ("wmom_reg0.80", 0.8), ("pgauss", 0), ("am", 0), ("gauss", 0),
+])
+def test_get_fit_guesses_convert(model, fwhm_reg, target):
+    # a Gaussian object convolved with a Gaussian PSF
+    mom_pre = _get_mom(0.6, 0.2, -0.1)
+    mom_psf = _get_mom(0.4, 0.05, 0.02)
+    mom_obs = mom_pre + mom_psf
+    fwhm = 1.2
+    mom_w_inv = np.eye(2) * 2 / ngmix.moments.fwhm_to_T(fwhm)
+
+    kind = model.split("_")[0]
+    is_pre_psf = kind in ["pgauss", "gauss"]
+    mom = mom_pre if is_pre_psf else mom_obs
+    psf_mom = mom_psf
+    if kind in ["wmom", "pgauss"]:
+        # the moments of the weighted profiles
+        mom = np.linalg.inv(np.linalg.inv(mom) + mom_w_inv)
+        psf_mom = np.linalg.inv(np.linalg.inv(psf_mom) + mom_w_inv)
+
+    T, g = _get_T_g(mom)
+    psf_T, psf_g = _get_T_g(psf_mom)
+    if kind != "gauss":
+        # the moments fitters measure e
+        g = 2 * g / (1 + np.sum(g**2))
+        psf_g = 2 * psf_g / (1 + np.sum(psf_g**2))
+    if fwhm_reg > 0:
+        g = g * T / (T + ngmix.moments.fwhm_to_T(fwhm_reg))
+
+    n = model + "_"
+    res = np.zeros(1, dtype=[
+        (n + "flags", "i4"), (n + "T", "f8"), (n + "g", "f8", 2),
+        (n + "psf_T", "f8"), (n + "psf_g", "f8", 2),
+    ])
+    res[n + "T"] = T
+    res[n + "g"] = g
+    res[n + "psf_T"] = psf_T
+    res[n + "psf_g"] = psf_g
+
+    guesses = get_fit_guesses(
+        res,
+        model,
+        target=target,
+        fwhm=fwhm if kind in ["wmom", "pgauss"] else None,
+        fwhm_reg=fwhm_reg,
+    )
+    T_expected, g_expected = _get_T_g(mom_pre if target == "gauss" else mom_obs)
+    np.testing.assert_allclose(guesses["T"][0], T_expected, rtol=1e-10)
+    np.testing.assert_allclose(guesses["g"][0], g_expected, rtol=0, atol=1e-10)
+
+
+@pytest.mark.parametrize("target", ["am", "gauss"])
+def test_fit_mbobs_list_joint_guesses_wmom(target):
+    mbobs_list = [make_mbobs_sim(45 + i, 4, wcs_var_scale=0) for i in range(5)]
+    wres = fit_mbobs_list_wavg(
+        mbobs_list=mbobs_list,
+        fitter=ngmix.gaussmom.GaussMom(1.2),
+        bmask_flags=0,
+    )
+
+    def _run(guesses):
+        fit_stats = {}
+        res = fit_mbobs_list_joint(
+            mbobs_list=mbobs_list,
+            fitter_name=target,
+            bmask_flags=0,
+            rng=np.random.RandomState(seed=4235),
+            coadd=True,
+            guesses=guesses,
+            fit_stats=fit_stats,
+        )
+        return res, fit_stats
+
+    res, fit_stats = _run(None)
+    guesses = get_fit_guesses(wres, "wmom", target=target, fwhm=1.2)
+    assert np.all(np.isfinite(guesses["T"]))
+
+    # the converted guesses are closer to the results than the raw moments
+    n = target + "_"
+    assert np.all(res[n + "flags"] == 0)
+    assert np.all(
+        np.abs(guesses["T"] - res[n + "T"]) < np.abs(wres["wmom_T"] - res[n + "T"])
+    )
+
+    # and the warm started fits take fewer iterations than the cold starts
+    gres, warm_fit_stats = _run(guesses)
+    assert warm_fit_stats["nwarm"] == 5
+    assert warm_fit_stats["niter"] < fit_stats["niter"]
+    np.testing.assert_array_equal(res[n + "flags"], gres[n + "flags"])
+
+
+@pytest.mark.parametrize("fname", ["am", "gauss"])
+def test_fit_mbobs_list_joint_guesses(fname):
+    mbobs_list = [make_mbobs_sim(45 + i, 4, wcs_var_scale=0) for i in range(5)]
+    fit_stats = {}
+    res = fit_mbobs_list_joint(
+        mbobs_list=mbobs_list,
+        fitter_name=fname,
+        bmask_flags=0,
+        rng=np.random.RandomState(seed=4235),
+        coadd=True,
+        fit_stats=fit_stats,
+    )
+    assert fit_stats["nfit"] == 5
+    assert fit_stats["nwarm"] == 0
+
+    # the fits started from their own results are the same and take fewer
+    # iterations
+    guesses = get_fit_guesses(res, fname, target=fname)
+    assert np.all(np.isfinite(guesses["T"]))
+    warm_fit_stats = {}
+    wres = fit_mbobs_list_joint(
+        mbobs_list=mbobs_list,
+        fitter_name=fname,
+        bmask_flags=0,
+        rng=np.random.RandomState(seed=4235),
+        coadd=True,
+        guesses=guesses,
+        fit_stats=warm_fit_stats,
+    )
+    assert warm_fit_stats["nfit"] == 5
+    assert warm_fit_stats["nwarm"] == 5
+    assert warm_fit_stats["niter"] < fit_stats["niter"]
+
+    n = fname + "_"
+    for col in ["flags", "psf_flags", "obj_flags"]:
+        np.testing.assert_array_equal(res[n + col], wres[n + col])
+    for col in ["psf_T", "psf_g", "T", "g"]:
+        np.testing.assert_allclose(
+            res[n + col], wres[n + col], rtol=0, atol=1e-4, err_msg=col,
+        )
+
+
+@pytest.mark.parametrize("fname", ["am", "gauss"])
+def test_fit_mbobs_list_joint_n_workers(fname):
+    mbobs_list = [make_mbobs_sim(45 + i, 4, wcs_var_scale=0) for i in range(5)]
+
+    def _run(**kwargs):
+        return fit_mbobs_list_joint(
+            mbobs_list=mbobs_list,
+            fitter_name=fname,
+            bmask_flags=0,
+            rng=np.random.RandomState(seed=4235),
+            **kwargs,
+        )
+
+    res = _run(n_workers=1, chunk_size=2)
+    for kwargs in [
+        dict(n_workers=2, chunk_size=2),
+        dict(n_workers=2, chunk_size=1),
+        dict(n_workers=1),
+    ]:
+        pres = _run(**kwargs)
+        for col in res.dtype.names:
+            np.testing.assert_array_equal(res[col], pres[col], err_msg=col)
+
+    # a pool given by the caller can be used for several calls
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        for _ in range(2):
+            pres = _run(n_workers=2, chunk_size=2, executor=executor)
+            for col in res.dtype.names:
+                np.testing.assert_array_equal(res[col], pres[col], err_msg=col)
+
+    # the serial fits use a single random number stream, so they only agree
+    # to the fitting tolerance
+    sres = _run()
+    n = fname + "_"
+    for col in ["flags", "psf_flags", "obj_flags"]:
+        np.testing.assert_array_equal(res[n + col], sres[n + col])
+    for col in ["psf_T", "psf_g", "T", "g"]:
+        np.testing.assert_allclose(
+            res[n + col], sres[n + col], rtol=0, atol=1e-3, err_msg=col,
+        )
+
+
+@pytest.mark.parametrize("symmetrize", [True, False])
+def test_fit_mbobs_list_joint_admom_batch(symmetrize):
+    mbobs_list = [make_mbobs_sim(45 + i, 4, wcs_var_scale=0) for i in range(5)]
+    mbobs_list[2][1] = ngmix.ObsList()
+
+    all_res = []
+    for batch in [False, True]:
+        all_res.append(fit_mbobs_list_joint(
+            mbobs_list=mbobs_list,
+            fitter_name="am",
+            bmask_flags=0,
+            rng=np.random.RandomState(seed=4235),
+            symmetrize=symmetrize,
+            batch=batch,
+        ))
+    res, bres = all_res
+
+    # the PSFs are fit in the same way and the objects agree to the tolerances
+    # of the adaptive moments
+    for col in ["am_flags", "am_psf_flags", "am_obj_flags", "am_T_flags"]:
+        np.testing.assert_array_equal(res[col], bres[col], err_msg=col)
+    assert bres["am_flags"][2] == procflags.NO_ATTEMPT | procflags.MISSING_BAND
+    for col in ["am_psf_T", "am_psf_g"]:
+        np.testing.assert_array_equal(res[col], bres[col], err_msg=col)
+    for col in ["am_T", "am_T_ratio", "am_g", "am_s2n", "am_g_cov"]:
+        np.testing.assert_allclose(
+            res[col], bres[col], rtol=1e-2, atol=1e-4, err_msg=col,
+        )
+    assert np.all(np.isfinite(bres["am_T_err"][bres["am_flags"] == 0]))
+
+    # the batch fits start from the guesses if given
+    guesses = get_fit_guesses(res, "am", target="am")
+    fit_stats = {}
+    gres = fit_mbobs_list_admom_batch(
+        mbobs_list=mbobs_list,
+        bmask_flags=0,
+        rng=np.random.RandomState(seed=4235),
+        symmetrize=symmetrize,
+        guesses=guesses,
+        fit_stats=fit_stats,
+    )
+    assert fit_stats["nfit"] == 4
+    assert fit_stats["nwarm"] == 4
+    np.testing.assert_array_equal(gres["am_flags"], bres["am_flags"])
+    for col in ["am_T", "am_g"]:
+        np.testing.assert_allclose(
+            gres[col], bres[col], rtol=1e-2, atol=1e-4, err_msg=col,
+        )
+
+
+def test_fit_mbobs_list_joint_batch_gauss():
+    mbobs_list = [make_mbobs_sim(45, 4, wcs_var_scale=0)]
+    with pytest.raises(ValueError):
+        fit_mbobs_list_joint(
+            mbobs_list=mbobs_list,
+            fitter_name="gauss",
+            bmask_flags=0,
+            rng=np.random.RandomState(seed=4235),
+            batch=True,
+        )
+
+
+def test_make_coadd_obs_list_oneband():
+    mbobs = make_mbobs_sim(45, 4, wcs_var_scale=0)
+    assert make_coadd_obs_list(
+        mbobs=mbobs, shear_bands=[1], cat=_make_full_stamp_cat(),
+    ) is None
+
+
 @pytest.mark.parametrize("case", [
     "missing_band",
     "too_many_bands",
@@ -17,6 +17,7 @@ from .. import detect
 from .. import metadetect
 from .. import fitting
 from .. import procflags
+from ..driver import run_many
 from .sim import Sim
 
 
@@ -512,7 +513,7 @@ def test_metadetect_fitter_fwhm_smooth(model):
     )
     md.go()
     res = md.result
-    assert md._fitters[0].fwhm_smooth == 0
+    assert md._fitter_cfgs[0].fitter.fwhm_smooth == 0
 
     config["weight"]["fwhm_smooth"] = 0.8
     md = metadetect.Metadetect(
@@ -520,7 +521,7 @@ def test_metadetect_fitter_fwhm_smooth(model):
     )
     md.go()
     res_smooth = md.result
-    assert md._fitters[0].fwhm_smooth == 0.8
+    assert md._fitter_cfgs[0].fitter.fwhm_smooth == 0.8
 
     for shear in ["noshear", "1p", "1m", "2p", "2m"]:
         msk = res[shear][model + "_flags"] == 0
@@ -831,6 +832,424 @@ def test_metadetect_with_color_is_same():
     print("time per:", total_time/ntrial)
 
 
+@pytest.mark.parametrize("model", ["wmom", "am"])
+def test_metadetect_n_workers(model):
+    nband = 3
+    config = {}
+    config.update(copy.deepcopy(TEST_METADETECT_CONFIG))
+    config["model"] = model
+    shear_band_combs = [[0, 1, 2], [1, 2]]
+
+    all_res = []
+    for n_workers in [1, 2]:
+        rng = np.random.RandomState(seed=116)
+        sim = Sim(rng, config={"nband": nband})
+        mbobs = sim.get_mbobs()
+        all_res.append(metadetect.do_metadetect(
+            config, mbobs, np.random.RandomState(seed=11),
+            shear_band_combs=shear_band_combs,
+            n_workers=n_workers,
+        ))
+
+    res, res_pool = all_res
+    for shear in ["noshear", "1p", "1m", "2p", "2m"]:
+        assert res[shear].dtype == res_pool[shear].dtype
+        for col in res[shear].dtype.names:
+            if col == "shear_bands" or col == "det_bands":
+                assert np.array_equal(res[shear][col], res_pool[shear][col])
+            else:
+                np.testing.assert_array_equal(
+                    res[shear][col],
+                    res_pool[shear][col],
+                    err_msg=col,
+                )
+
+
+def test_metadetect_joint_n_workers(monkeypatch):
+    config = {}
+    config.update(copy.deepcopy(TEST_METADETECT_CONFIG))
+    config.pop("model", None)
+    config.pop("weight", None)
+
+    def _run(fitter_n_workers, n_workers=None):
+        config["fitters"] = [
+            {"model": "am", "n_workers": fitter_n_workers},
+            {"model": "gauss", "n_workers": fitter_n_workers},
+        ]
+        rng = np.random.RandomState(seed=117)
+        sim = Sim(rng, config={"nband": 3})
+        md = metadetect.Metadetect(
+            config, sim.get_mbobs(), np.random.RandomState(seed=12),
+            n_workers=n_workers,
+        )
+        md.go()
+        assert md._joint_executor is None
+        return md
+
+    def _check_equal(res, pres):
+        for shear in ["noshear", "1p", "1m", "2p", "2m"]:
+            for col in res[shear].dtype.names:
+                if col == "shear_bands" or col == "det_bands":
+                    assert np.array_equal(res[shear][col], pres[shear][col])
+                else:
+                    np.testing.assert_array_equal(
+                        res[shear][col], pres[shear][col], err_msg=col,
+                    )
+
+    # all of the joint fits of a run share a single pool
+    pools = []
+
+    class _CountingExecutor(metadetect.ProcessPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            pools.append(self)
+
+    monkeypatch.setattr(metadetect, "ProcessPoolExecutor", _CountingExecutor)
+    res = _run(1).result
+    assert len(pools) == 0
+    _check_equal(res, _run(2).result)
+    assert len(pools) == 1
+
+    # the metacal type workers fit the objects serially
+    md = _run(2, n_workers=2)
+    wmd = md._get_worker_copy()
+    for fcfg in wmd._fitter_cfgs:
+        assert wmd._get_joint_pool(fcfg) == (1, None)
+    _check_equal(_run(1, n_workers=1).result, md.result)
+
+
+@pytest.mark.parametrize("model,rtol", [
+    ("wmom", 1e-6),
+    ("pgauss", 1e-4),
+    ("ksigma", 1e-4),
+])
+def test_metadetect_batch(model, rtol):
+    nband = 3
+    config = {}
+    config.update(copy.deepcopy(TEST_METADETECT_CONFIG))
+    config["model"] = model
+    if model != "wmom":
+        config["weight"]["fwhm"] = 2.0
+    shear_band_combs = [[0, 1, 2], [1, 2]]
+
+    all_res = []
+    for batch in [False, True]:
+        config["batch"] = batch
+        rng = np.random.RandomState(seed=116)
+        sim = Sim(rng, config={"nband": nband})
+        mbobs = sim.get_mbobs()
+        all_res.append(metadetect.do_metadetect(
+            config, mbobs, np.random.RandomState(seed=11),
+            shear_band_combs=shear_band_combs,
+        ))
+
+    res, res_batch = all_res
+    for shear in ["noshear", "1p", "1m", "2p", "2m"]:
+        assert res[shear].dtype == res_batch[shear].dtype
+        for col in res[shear].dtype.names:
+            if res[shear][col].dtype.kind == "f":
+                np.testing.assert_allclose(
+                    res[shear][col],
+                    res_batch[shear][col],
+                    rtol=rtol,
+                    atol=1e-12,
+                    err_msg=col,
+                )
+            else:
+                assert np.array_equal(res[shear][col], res_batch[shear][col]), col
+
+
+def test_metadetect_batch_multi():
+    nband = 3
+    fitters = [
+        {"model": "pgauss", "weight": {"fwhm": 2.0}, "batch": True},
+        {"model": "ksigma", "weight": {"fwhm": 2.5}, "batch": True},
+        {"model": "wmom", "weight": {"fwhm": 1.2}, "batch": True},
+    ]
+    shear_band_combs = [[0, 1, 2], [1, 2]]
+
+    def _run(fitters):
+        config = {}
+        config.update(copy.deepcopy(TEST_METADETECT_CONFIG))
+        del config["model"]
+        del config["weight"]
+        config["fitters"] = copy.deepcopy(fitters)
+        rng = np.random.RandomState(seed=116)
+        sim = Sim(rng, config={"nband": nband})
+        mbobs = sim.get_mbobs()
+        return metadetect.do_metadetect(
+            config, mbobs, np.random.RandomState(seed=11),
+            shear_band_combs=shear_band_combs,
+        )
+
+    # the other columns like mfrac depend on the first fitter
+    res = _run(fitters)
+    for fitter in fitters:
+        sep_res = _run([fitter])
+        for shear in ["noshear", "1p", "1m", "2p", "2m"]:
+            cols = [
+                col for col in sep_res[shear].dtype.names
+                if col.startswith(fitter["model"] + "_")
+            ]
+            assert len(cols) > 0
+            for col in cols:
+                assert np.array_equal(
+                    res[shear][col], sep_res[shear][col], equal_nan=True,
+                ), col
+
+
+def test_metadetect_guess_from():
+    nband = 3
+    fitters = [
+        {"model": "wmom", "weight": {"fwhm": 1.2}},
+        {"model": "am"},
+    ]
+
+    def _run(fitters):
+        config = {}
+        config.update(copy.deepcopy(TEST_METADETECT_CONFIG))
+        del config["model"]
+        del config["weight"]
+        config["fitters"] = copy.deepcopy(fitters)
+        rng = np.random.RandomState(seed=116)
+        sim = Sim(rng, config={"nband": nband})
+        mbobs = sim.get_mbobs()
+        return metadetect.do_metadetect(
+            config, mbobs, np.random.RandomState(seed=11),
+        )
+
+    res = _run(fitters)
+    fitters[1]["guess_from"] = "wmom"
+    res_guess = _run(fitters)
+    for shear in ["noshear", "1p", "1m", "2p", "2m"]:
+        for col in ["am_flags", "wmom_flags", "wmom_g", "wmom_T"]:
+            assert np.array_equal(res[shear][col], res_guess[shear][col]), col
+
+        msk = res[shear]["am_flags"] == 0
+        assert np.any(msk)
+        for col in ["am_T", "am_g"]:
+            np.testing.assert_allclose(
+                res[shear][col][msk], res_guess[shear][col][msk],
+                rtol=0, atol=1e-4, err_msg=col,
+            )
+
+    fitters[1]["guess_from"] = "pgauss"
+    with pytest.raises(ValueError):
+        _run(fitters)
+
+
+def test_metadetect_fitter_cfgs():
+    rng = np.random.RandomState(seed=116)
+    sim = Sim(rng, config={"nband": 3})
+    mbobs = sim.get_mbobs()
+
+    config = {}
+    config.update(copy.deepcopy(TEST_METADETECT_CONFIG))
+    config.pop("model", None)
+    config.pop("weight", None)
+    config["fitters"] = [
+        {"model": "pgauss", "weight": {"fwhm": 2.0, "fwhm_reg": 0.8},
+         "batch": True},
+        {"model": "admom", "psf_fit_cache": True, "guess_from": "pgauss_reg0.80",
+         "n_workers": 2, "symmetrize": False},
+        {"model": "gauss", "coadd": True, "image_coadd": True, "batch": True},
+    ]
+    md = metadetect.Metadetect(config, mbobs, rng)
+
+    pcfg, acfg, gcfg = md._fitter_cfgs
+    assert md._get_fitter_models() == ["pgauss_reg0.80", "am", "gauss"]
+    assert pcfg.is_wavg and pcfg.batch and pcfg.symmetrize
+    assert pcfg.fwhm == 2.0 and pcfg.fwhm_reg == 0.8
+    assert pcfg.guess_from is None and pcfg.n_workers is None
+
+    assert not acfg.is_wavg and not acfg.symmetrize and not acfg.batch
+    assert acfg.fitter == "admom" and acfg.fwhm == 1.2
+    assert acfg.psf_fit_cache and acfg.n_workers == 2
+    assert acfg.guess_from == "pgauss_reg0.80"
+
+    # the batch option is only used by the adaptive moments joint fitter
+    assert gcfg.coadd and gcfg.image_coadd and not gcfg.batch
+
+    config["n_workers"] = 2
+    with pytest.raises(RuntimeError):
+        metadetect.Metadetect(config, mbobs, rng)
+
+
+@pytest.mark.parametrize("weight_type", ["weight", "uberseg"])
+@pytest.mark.parametrize("fitters", [
+    [{"model": "am"}, {"model": "gauss"}],
+    [{"model": "wmom", "weight": {"fwhm": 1.2}, "symmetrize": False},
+     {"model": "am"}],
+])
+def test_metadetect_stamp_flags(fitters, weight_type, monkeypatch):
+    nband = 3
+
+    def _run():
+        config = {}
+        config.update(copy.deepcopy(TEST_METADETECT_CONFIG))
+        del config["model"]
+        del config["weight"]
+        config["fitters"] = copy.deepcopy(fitters)
+        config["meds"]["weight_type"] = weight_type
+        rng = np.random.RandomState(seed=116)
+        sim = Sim(rng, config={"nband": nband})
+        mbobs = sim.get_mbobs()
+        # the stamps of the objects on the left half of the image hit the
+        # bmask_flags in all bands
+        for obslist in mbobs:
+            obslist[0].bmask[:, :112] |= 2**30
+        return metadetect.do_metadetect(
+            config, mbobs, np.random.RandomState(seed=11),
+        )
+
+    nfixed = [0]
+    get_fit_inds = metadetect.Metadetect._get_fit_inds
+
+    def _counting_get_fit_inds(self, stamp_flags):
+        fit_inds = get_fit_inds(self, stamp_flags)
+        if fit_inds is not None:
+            nfixed[0] += len(stamp_flags) - len(fit_inds)
+        return fit_inds
+
+    all_mbobs_lists = []
+    do_detect = metadetect.Metadetect._do_detect
+
+    def _saving_do_detect(*args, **kwargs):
+        cat, mbobs_list, stamp_flags = do_detect(*args, **kwargs)
+        all_mbobs_lists.append(mbobs_list)
+        return cat, mbobs_list, stamp_flags
+
+    monkeypatch.setattr(
+        metadetect.Metadetect, "_get_fit_inds", _counting_get_fit_inds,
+    )
+    monkeypatch.setattr(metadetect.Metadetect, "_do_detect", _saving_do_detect)
+    res = _run()
+
+    # the observations are only made for the objects that are fit
+    assert sum(len(mbobs_list._mbobs) for mbobs_list in all_mbobs_lists) == (
+        sum(len(mbobs_list) for mbobs_list in all_mbobs_lists) - nfixed[0]
+    )
+
+    # the stamps with the uberseg weights can have more flags, so their
+    # objects are fit unless all of their weights are zero
+    if weight_type == "weight":
+        assert nfixed[0] > 0
+    else:
+        assert nfixed[0] == 0
+
+    # the results are the same as those from fitting all of the objects
+    monkeypatch.setattr(
+        fitting,
+        "is_fixed_by_stamp_flags",
+        lambda stamp_flags, **kwargs: np.zeros(len(stamp_flags), dtype=bool),
+    )
+    nfixed[0] = 0
+    res_fit = _run()
+    assert nfixed[0] == 0
+    for shear in ["noshear", "1p", "1m", "2p", "2m"]:
+        assert np.any((res[shear]["am_flags"] & procflags.EDGE_HIT) != 0)
+        assert res[shear].dtype == res_fit[shear].dtype
+        for col in res[shear].dtype.names:
+            np.testing.assert_array_equal(
+                res[shear][col], res_fit[shear][col], err_msg=col,
+            )
+
+
+@pytest.mark.parametrize("det_band_combs", [None, "shear_bands"])
+def test_metadetect_detect_cache(det_band_combs, monkeypatch):
+    nband = 3
+    config = {}
+    config.update(copy.deepcopy(TEST_METADETECT_CONFIG))
+    shear_band_combs = [[0, 1, 2], [0, 1], [1, 2]]
+
+    ncalls = [0]
+    medsifier_class = detect.MEDSifier
+
+    def _counting_medsifier(*args, **kwargs):
+        ncalls[0] += 1
+        return medsifier_class(*args, **kwargs)
+
+    monkeypatch.setattr(detect, "MEDSifier", _counting_medsifier)
+    rng = np.random.RandomState(seed=116)
+    sim = Sim(rng, config={"nband": nband})
+    mbobs = sim.get_mbobs()
+    md = metadetect.Metadetect(
+        config, mbobs, np.random.RandomState(seed=11),
+        shear_band_combs=shear_band_combs,
+        det_band_combs=det_band_combs,
+    )
+    md.go()
+    res_cached = md.result
+
+    if det_band_combs is None:
+        assert ncalls[0] == 5
+    else:
+        assert ncalls[0] == 5 * len(shear_band_combs)
+    assert not hasattr(md, "_shear_caches")
+
+    # the results for each shear band combination are the same as if it was
+    # run by itself
+    for i, shear_bands in enumerate(shear_band_combs):
+        rng = np.random.RandomState(seed=116)
+        sim = Sim(rng, config={"nband": nband})
+        mbobs = sim.get_mbobs()
+        res = metadetect.do_metadetect(
+            config, mbobs, np.random.RandomState(seed=11),
+            shear_band_combs=[shear_bands],
+            det_band_combs=(
+                None if det_band_combs is None else [shear_band_combs[i]]
+            ),
+        )
+        sbstr = "".join("%s" % b for b in shear_bands)
+        for shear in ["noshear", "1p", "1m", "2p", "2m"]:
+            msk = res_cached[shear]["shear_bands"] == sbstr
+            for col in res[shear].dtype.names:
+                if col == "shear_bands" or col == "det_bands":
+                    assert np.array_equal(res[shear][col], res_cached[shear][col][msk])
+                else:
+                    np.testing.assert_array_equal(
+                        res[shear][col],
+                        res_cached[shear][col][msk],
+                        err_msg=col,
+                    )
+
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_metadetect_run_many(n_workers):
+    config = {}
+    config.update(copy.deepcopy(TEST_METADETECT_CONFIG))
+
+    nslice = 3
+    seeds = [10, 11, 12]
+    all_mbobs = [
+        Sim(np.random.RandomState(seed=116 + i)).get_mbobs()
+        for i in range(nslice)
+    ]
+
+    slice_ids = []
+    for slice_id, res in run_many(
+        config, iter(all_mbobs), seeds, n_workers=n_workers, max_in_flight=2,
+    ):
+        slice_ids.append(slice_id)
+        res_serial = metadetect.do_metadetect(
+            copy.deepcopy(config),
+            all_mbobs[slice_id],
+            np.random.RandomState(seed=seeds[slice_id]),
+        )
+        for shear in ["noshear", "1p", "1m", "2p", "2m"]:
+            for col in res[shear].dtype.names:
+                if col == "shear_bands" or col == "det_bands":
+                    assert np.array_equal(res[shear][col], res_serial[shear][col])
+                else:
+                    np.testing.assert_array_equal(
+                        res[shear][col],
+                        res_serial[shear][col],
+                        err_msg=col,
+                    )
+
+    assert sorted(slice_ids) == list(range(nslice))
+
+
 @pytest.mark.parametrize("mask_region", [1, 7])
 def test_fill_in_mask_col(mask_region):
     rng = np.random.RandomState(seed=10)
@@ -858,6 +1277,36 @@ def test_fill_in_mask_col(mask_region):
         )[0]
 
 
+@pytest.mark.parametrize("mask_region", [2, 5, 16, 80])
+def test_fill_in_mask_col_edges(mask_region):
+    rng = np.random.RandomState(seed=mask_region)
+
+    dims = (37, 52)
+    mask = rng.randint(low=0, high=2**20, size=dims).astype(np.int32)
+    mask[rng.uniform(size=dims) > 0.02] = 0
+    rows = rng.uniform(low=-5, high=dims[0] + 5, size=100)
+    cols = rng.uniform(low=-5, high=dims[1] + 5, size=100)
+
+    vals = metadetect._fill_in_mask_col(
+        mask_region=mask_region,
+        rows=rows,
+        cols=cols,
+        mask=mask,
+    )
+    assert vals.dtype == np.int32
+
+    for val, row, col in zip(vals, rows, cols):
+        row = int(np.clip(np.rint(row), 0, dims[0]-1))
+        col = int(np.clip(np.rint(col), 0, dims[1]-1))
+        assert val == np.bitwise_or.reduce(
+            mask[
+                max(row-mask_region, 0):row+mask_region+1,
+                max(col-mask_region, 0):col+mask_region+1
+            ],
+            axis=None,
+        )
+
+
 def test_get_psf_stats():
     rng = np.random.RandomState(seed=10)
     sim = Sim(rng)
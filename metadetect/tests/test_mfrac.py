@@ -1,6 +1,9 @@
 import numpy as np
 import ngmix
+import pytest
 
+from ..defaults import BMASK_EDGE
+from ..detect import CatalogMEDSifier
 from ..mfrac import measure_mfrac
 
 
@@ -32,3 +35,87 @@ def test_measure_mfrac_neg_bbox():
     assert mes[0] > 0.4 and mes[0] < 0.6
     assert mes[1] == 1.0
     assert mes[2] == 1.0
+
+
+def _measure_mfrac_stamps(*, mfrac, x, y, box_sizes, obs, fwhm):
+    # the original per-object implementation with MEDS stamps
+    obs = obs.copy()
+    obs.set_image(mfrac)
+
+    gauss_wgt = ngmix.GMixModel(
+        [0, 0, 0, 0, ngmix.moments.fwhm_to_T(fwhm), 1],
+        'gauss',
+    )
+    mbobs = ngmix.MultiBandObsList()
+    obslist = ngmix.ObsList()
+    mbobs.append(obslist)
+    obslist.append(obs)
+    m = CatalogMEDSifier(mbobs, x, y, box_sizes).get_meds(0)
+    mfracs = []
+    for i in range(x.shape[0]):
+        try:
+            if box_sizes[i] > 0:
+                obs = m.get_obs(i, 0)
+                wgt = obs.weight.copy()
+                msk = (obs.bmask & BMASK_EDGE) != 0
+                wgt[msk] = 0
+                wgt[~msk] = 1
+                obs.set_weight(wgt)
+
+                stats = gauss_wgt.get_weighted_sums(
+                    obs,
+                    fwhm * 2,
+                )
+                mfracs.append(stats["sums"][5] / stats["wsum"])
+            else:
+                mfracs.append(1.0)
+        except ngmix.GMixFatalError:
+            mfracs.append(1.0)
+
+    return np.array(mfracs)
+
+
+@pytest.mark.parametrize("fwhm", [0.8, 1.2, 2.0])
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_measure_mfrac_stamps(fwhm, seed):
+    rng = np.random.RandomState(seed=seed)
+    dims = (91, 73)
+    mfrac = rng.uniform(size=dims)
+    bmask = np.zeros(dims, dtype=np.int32)
+    bmask[rng.uniform(size=dims) < 0.05] = BMASK_EDGE
+    bmask[rng.uniform(size=dims) < 0.05] |= 4
+
+    nobj = 50
+    x = rng.uniform(size=nobj, low=-2, high=dims[1] + 2)
+    y = rng.uniform(size=nobj, low=-2, high=dims[0] + 2)
+    box_sizes = rng.choice([-9990, 0, 16, 32, 48], size=nobj).astype(np.int32)
+
+    obs = ngmix.Observation(
+        image=np.zeros_like(mfrac),
+        bmask=bmask,
+        weight=np.ones_like(mfrac),
+        jacobian=ngmix.Jacobian(
+            row=45, col=36,
+            dudcol=0.263, dudrow=0.01,
+            dvdcol=-0.005, dvdrow=0.27,
+        ),
+    )
+    obs.psf = obs.copy()
+
+    mes = measure_mfrac(
+        mfrac=mfrac,
+        x=x,
+        y=y,
+        box_sizes=box_sizes,
+        obs=obs,
+        fwhm=fwhm,
+    )
+    expected = _measure_mfrac_stamps(
+        mfrac=mfrac,
+        x=x,
+        y=y,
+        box_sizes=box_sizes,
+        obs=obs,
+        fwhm=fwhm,
+    )
+    np.testing.assert_allclose(mes, expected, atol=1e-5)
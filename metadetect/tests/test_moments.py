@@ -0,0 +1,256 @@
+import numpy as np
+import ngmix
+
+import pytest
+
+from ngmix.gaussmom import GaussMom
+from ngmix.prepsfmom import PGaussMom, KSigmaMom
+from ngmix.moments import fwhm_to_T
+
+from .sim import make_mbobs_sim
+from ..fitting import MOMNAME
+from ..moments import (
+    measure_admom_batch,
+    measure_moments_batch,
+    measure_moments_batch_multi,
+    supports_batch,
+    get_prepsfmom_sums,
+    get_fourier_kernels,
+    get_jacobian_array,
+    FourierCache,
+)
+
+
+def _get_obs_list(seed, nband=4):
+    mbobs = make_mbobs_sim(
+        seed,
+        nband,
+        band_image_sizes=[33, 45, 33, 47][:nband],
+    )
+    obs_list = []
+    for obslist in mbobs:
+        obs_list.append(obslist[0])
+        obs_list.append(obslist[0].psf)
+    return obs_list
+
+
+@pytest.mark.parametrize("fwhm", [1.2, 2.0])
+def test_measure_moments_batch_gaussmom(fwhm):
+    fitter = GaussMom(fwhm)
+    obs_list = _get_obs_list(10) + _get_obs_list(11)
+    assert supports_batch(fitter)
+
+    all_res = measure_moments_batch(fitter=fitter, obs_list=obs_list)
+    assert len(all_res) == len(obs_list)
+    for obs, res in zip(obs_list, all_res):
+        res1 = fitter.go(obs)
+        assert res["flags"] == res1["flags"]
+        for col in [MOMNAME, MOMNAME + "_cov", "flux", "flux_err", "T", "e"]:
+            np.testing.assert_allclose(
+                res[col], res1[col], rtol=1e-6, atol=1e-12, err_msg=col,
+            )
+
+
+@pytest.mark.parametrize("fitter", [
+    PGaussMom(2.0),
+    PGaussMom(1.2, fwhm_smooth=0.8),
+    KSigmaMom(2.0),
+])
+@pytest.mark.parametrize("no_psf", [True, False])
+def test_measure_moments_batch_prepsfmom(fitter, no_psf):
+    if no_psf:
+        obs_list = _get_obs_list(10)[1::2] + _get_obs_list(11)[1::2]
+    else:
+        obs_list = _get_obs_list(10)[::2] + _get_obs_list(11)[::2]
+    assert supports_batch(fitter)
+
+    all_res = measure_moments_batch(
+        fitter=fitter, obs_list=obs_list, no_psf=no_psf,
+    )
+    assert len(all_res) == len(obs_list)
+    for obs, res in zip(obs_list, all_res):
+        res1 = fitter.go(obs, no_psf=no_psf)
+        assert res["flags"] == res1["flags"]
+
+        # the pre-PSF moments do not measure the centroid
+        assert np.all(np.isnan(res[MOMNAME][0:2]))
+        np.testing.assert_array_equal(res[MOMNAME][0:2], res1[MOMNAME][0:2])
+
+        # the sums only differ by the order of the operations
+        np.testing.assert_allclose(
+            res[MOMNAME][2:],
+            res1[MOMNAME][2:],
+            rtol=1e-10,
+            atol=1e-12 * np.abs(res1[MOMNAME][5]),
+        )
+        np.testing.assert_allclose(
+            res[MOMNAME + "_cov"][2:, 2:],
+            res1[MOMNAME + "_cov"][2:, 2:],
+            rtol=1e-10,
+            atol=1e-12 * np.abs(res1[MOMNAME + "_cov"][5, 5]),
+        )
+        for col in ["flux", "flux_err", "T", "e"]:
+            np.testing.assert_allclose(
+                res[col], res1[col], rtol=1e-10, atol=1e-12, err_msg=col,
+            )
+
+
+@pytest.mark.parametrize("no_psf", [True, False])
+def test_measure_moments_batch_multi(no_psf):
+    fitters = [
+        PGaussMom(2.0),
+        GaussMom(1.2),
+        KSigmaMom(2.5),
+        PGaussMom(1.2, fwhm_smooth=0.8),
+        PGaussMom(2.0, pad_factor=2),
+    ]
+    if no_psf:
+        obs_list = _get_obs_list(10)[1::2] + _get_obs_list(11)[1::2]
+    else:
+        obs_list = _get_obs_list(10)[::2] + _get_obs_list(11)[::2]
+
+    all_res = measure_moments_batch_multi(
+        fitters=fitters, obs_list=obs_list, no_psf=no_psf,
+    )
+    assert len(all_res) == len(fitters)
+    for fitter, multi_res in zip(fitters, all_res):
+        sep_res = measure_moments_batch(
+            fitter=fitter, obs_list=obs_list, no_psf=no_psf,
+        )
+        assert len(multi_res) == len(obs_list)
+        for res, mres in zip(sep_res, multi_res):
+            assert res["flags"] == mres["flags"]
+            for col in [MOMNAME, MOMNAME + "_cov", "flux", "flux_err", "T"]:
+                np.testing.assert_array_equal(res[col], mres[col], err_msg=col)
+
+
+@pytest.mark.parametrize("fwhm", [1.2, 2.0])
+def test_get_prepsfmom_sums_nopsf(fwhm):
+    # without a PSF, the pre-PSF Gaussian moments are the real-space ones
+    obs = _get_obs_list(10)[0]
+    images = obs.image[None, :, :]
+    weights = obs.weight[None, :, :]
+    jacs = get_jacobian_array(obs.jacobian)[None, :]
+
+    sums, sums_cov, sums_norm = get_prepsfmom_sums(
+        images=images, weights=weights, jacs=jacs, kernel="pgauss", fwhm=fwhm,
+    )
+
+    rows, cols = np.mgrid[0:images.shape[1], 0:images.shape[2]]
+    row0, col0, dvdrow, dvdcol, dudrow, dudcol = jacs[0]
+    v = dvdrow * (rows - row0) + dvdcol * (cols - col0)
+    u = dudrow * (rows - row0) + dudcol * (cols - col0)
+    wgt = np.exp(-0.5 * (u**2 + v**2) / (fwhm_to_T(fwhm) / 2))
+    true_sums = [
+        np.sum(wgt * images[0] * (u**2 - v**2)),
+        np.sum(wgt * images[0] * 2 * u * v),
+        np.sum(wgt * images[0] * (u**2 + v**2)),
+        np.sum(wgt * images[0]),
+    ]
+
+    assert np.all(np.isnan(sums[0, :2]))
+    np.testing.assert_allclose(sums[0, 2:], true_sums, rtol=1e-6, atol=0)
+    np.testing.assert_allclose(sums_norm, np.sum(wgt), rtol=1e-6, atol=0)
+
+
+@pytest.mark.parametrize("kernel", ["pgauss", "ksigma"])
+def test_get_fourier_kernels_peak(kernel):
+    fft_dim = 128
+    jac = get_jacobian_array(
+        ngmix.DiagonalJacobian(scale=0.2, row=0, col=0)
+    )
+    kernels = get_fourier_kernels(
+        kernel=kernel, fwhm=1.5, fft_dim=fft_dim, jac=jac,
+    )
+    wgt = np.fft.irfft2(kernels["fkf"], s=(fft_dim, fft_dim))
+    assert np.allclose(wgt[0, 0], 1.0)
+    assert np.allclose(np.max(wgt), 1.0)
+
+
+@pytest.mark.parametrize("fitter", [PGaussMom(2.0), KSigmaMom(2.0)])
+def test_measure_moments_batch_fourier_cache(fitter):
+    obs_list = _get_obs_list(10)[::2] + _get_obs_list(10)[::2]
+    all_res = measure_moments_batch(fitter=fitter, obs_list=obs_list)
+
+    fourier_cache = FourierCache()
+    for _ in range(2):
+        cache_res = measure_moments_batch(
+            fitter=fitter, obs_list=obs_list, fourier_cache=fourier_cache,
+        )
+        for res, cres in zip(all_res, cache_res):
+            assert res["flags"] == cres["flags"]
+            np.testing.assert_array_equal(res[MOMNAME], cres[MOMNAME])
+            np.testing.assert_array_equal(
+                res[MOMNAME + "_cov"], cres[MOMNAME + "_cov"],
+            )
+
+    # each of the four bands in the sim has its own WCS and PSF
+    stats = fourier_cache.get_stats()
+    assert stats["kernels"]["misses"] == 4
+    assert stats["kernels"]["hits"] == 4
+    assert stats["psf"]["misses"] == 4
+    assert stats["psf"]["hits"] == 2 * len(obs_list) - 4
+    assert len(fourier_cache) == 8
+
+    fourier_cache.clear()
+    assert len(fourier_cache) == 0
+    assert fourier_cache.get_stats()["psf"]["hits"] == 0
+
+
+def test_fourier_cache_lru():
+    jac = get_jacobian_array(
+        ngmix.DiagonalJacobian(scale=0.2, row=0, col=0)
+    )
+    fourier_cache = FourierCache(maxsize=2)
+    for fwhm in [1.0, 2.0, 1.0, 3.0, 2.0]:
+        fourier_cache.get_kernels(
+            kernel="pgauss", fwhm=fwhm, fft_dim=64, jac=jac,
+        )
+
+    # 2.0 is dropped when 3.0 is added since 1.0 was used more recently
+    stats = fourier_cache.get_stats()["kernels"]
+    assert stats["hits"] == 1
+    assert stats["misses"] == 4
+    assert stats["size"] == 2
+
+
+def test_measure_admom_batch():
+    obs_list = _get_obs_list(10) + _get_obs_list(11)
+    T_guess = fwhm_to_T(1.2)
+
+    all_res = measure_admom_batch(
+        obs_list=obs_list, T_guess=np.full(len(obs_list), T_guess),
+    )
+    assert len(all_res) == len(obs_list)
+    fitter = ngmix.admom.AdmomFitter()
+    for obs, res in zip(obs_list, all_res):
+        # starting from the same guess, the iterations are the same
+        res1 = fitter.go(
+            obs, ngmix.GMixModel([0, 0, 0, 0, T_guess, 1], "gauss"),
+        )
+        assert res["flags"] == res1["flags"] == 0
+        assert res["numiter"] == res1["numiter"]
+        for col in ["T", "e", "s2n"]:
+            np.testing.assert_allclose(
+                res[col], res1[col], rtol=1e-6, atol=1e-10, err_msg=col,
+            )
+
+
+def test_measure_admom_batch_flags():
+    obs_list = _get_obs_list(10)
+    obs_list[0].image = -obs_list[0].image
+
+    all_res = measure_admom_batch(
+        obs_list=obs_list, T_guess=np.full(len(obs_list), np.nan), maxiter=1,
+    )
+    assert all_res[0]["flags"] == ngmix.flags.NONPOS_FLUX
+    for res in all_res[1:]:
+        assert res["flags"] == ngmix.flags.MAXITER
+        assert res["numiter"] == 1
+
+
+def test_measure_moments_batch_unsupported():
+    fitter = ngmix.admom.AdmomFitter()
+    assert not supports_batch(fitter)
+    with pytest.raises(ValueError):
+        measure_moments_batch(fitter=fitter, obs_list=_get_obs_list(10))
@@ -0,0 +1,141 @@
+import numpy as np
+import ngmix
+
+from ..util import get_obs_cache, get_obs_stats, obs_cache_scope, writeable
+
+
+def _make_obs(rng):
+    dims = (21, 21)
+    weight = rng.uniform(size=dims, low=1, high=2)
+    weight[3, 4] = 0
+    bmask = np.zeros(dims, dtype=np.int32)
+    bmask[5, 6] = 2**3
+    bmask[7, 8] = 2**5
+    return ngmix.Observation(
+        image=rng.normal(size=dims),
+        weight=weight,
+        bmask=bmask,
+        jacobian=ngmix.DiagonalJacobian(scale=0.2, row=10, col=10),
+    )
+
+
+def test_get_obs_stats():
+    rng = np.random.RandomState(seed=10)
+    obs = _make_obs(rng)
+
+    stats = get_obs_stats(obs)
+    assert stats["any_pos_weight"]
+    assert not stats["all_pos_weight"]
+    assert not stats["all_zero_weight"]
+    assert stats["median_weight"] == np.median(obs.weight[obs.weight > 0])
+    assert stats["bmask_or"] == 2**3 | 2**5
+
+    # not cached outside of a scope
+    assert get_obs_stats(obs) is not stats
+
+    with obs_cache_scope():
+        stats = get_obs_stats(obs)
+
+        # cached
+        assert get_obs_stats(obs) is stats
+
+        # copies are not
+        assert get_obs_stats(obs.copy()) is not stats
+
+    assert get_obs_stats(obs) is not stats
+
+
+@obs_cache_scope()
+def test_get_obs_stats_invalidate():
+    rng = np.random.RandomState(seed=11)
+    obs = _make_obs(rng)
+    stats = get_obs_stats(obs)
+
+    with writeable(obs):
+        obs.weight[:, :] = 0
+        obs.bmask[0, 0] |= 2**10
+
+    new_stats = get_obs_stats(obs)
+    assert new_stats is not stats
+    assert not new_stats["any_pos_weight"]
+    assert new_stats["all_zero_weight"]
+    assert new_stats["median_weight"] == 0
+    assert new_stats["bmask_or"] == 2**3 | 2**5 | 2**10
+
+    obs.set_weight(np.ones_like(obs.image) * 4)
+    new_stats = get_obs_stats(obs)
+    assert new_stats["any_pos_weight"]
+    assert new_stats["all_pos_weight"]
+    assert new_stats["median_weight"] == 4
+
+
+def test_get_obs_cache():
+    rng = np.random.RandomState(seed=12)
+    obs = _make_obs(rng)
+
+    with obs_cache_scope():
+        cache = get_obs_cache(obs)
+        cache["a"] = 10
+        assert get_obs_cache(obs)["a"] == 10
+
+        # nested scopes share the data
+        with obs_cache_scope():
+            assert get_obs_cache(obs)["a"] == 10
+        assert get_obs_cache(obs)["a"] == 10
+
+        with writeable(obs):
+            pass
+        assert "a" not in get_obs_cache(obs)
+
+        get_obs_cache(obs)["a"] = 10
+        obs.set_image(obs.image.copy())
+        assert "a" not in get_obs_cache(obs)
+
+        get_obs_cache(obs)["a"] = 10
+
+    # the data are dropped when the scope exits
+    assert "a" not in get_obs_cache(obs)
+    get_obs_cache(obs)["a"] = 10
+    assert "a" not in get_obs_cache(obs)
+
+
+def test_get_obs_cache_views():
+    rng = np.random.RandomState(seed=14)
+    obs = _make_obs(rng)
+
+    with obs_cache_scope():
+        # the observation returns new views of its arrays on each access, which
+        # must not empty the cache
+        cache = get_obs_cache(obs)
+        cache["a"] = 10
+        for _ in range(3):
+            assert get_obs_cache(obs) is cache
+
+        # replacing any of the arrays does, even with the same shape
+        obs.set_image(obs.image.copy())
+        assert "a" not in get_obs_cache(obs)
+
+        get_obs_cache(obs)["a"] = 10
+        obs.set_weight(obs.weight.copy())
+        assert "a" not in get_obs_cache(obs)
+
+        get_obs_cache(obs)["a"] = 10
+        obs.set_bmask(obs.bmask.copy())
+        assert "a" not in get_obs_cache(obs)
+
+
+def test_get_obs_stats_in_place_edit():
+    rng = np.random.RandomState(seed=13)
+    obs = _make_obs(rng)
+
+    with obs_cache_scope():
+        assert get_obs_stats(obs)["any_pos_weight"]
+
+    # edits with the ngmix idiom outside of a scope are always seen
+    with obs.writeable():
+        obs.weight[:, :] = 0
+        obs.bmask[0, 0] |= 2**10
+    stats = get_obs_stats(obs)
+    assert not stats["any_pos_weight"]
+    assert stats["all_zero_weight"]
+    assert stats["bmask_or"] == 2**3 | 2**5 | 2**10
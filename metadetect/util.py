@@ -1,7 +1,18 @@
+import contextlib
 import logging
+import threading
+import weakref
+
+import numpy as np
+
+from . import procflags
 
 logger = logging.getLogger(__name__)
 
+# data computed from the pixels of observations for the current thread, see
+# get_obs_cache and obs_cache_scope
+_OBS_CACHE = threading.local()
+
 
 class Namer(object):
     """
@@ -30,3 +41,261 @@ class Namer(object):
                 n = '%s_%s' % (n, self.back)
 
         return n
+
+
+@contextlib.contextmanager
+def obs_cache_scope():
+    """Keep the data computed from the pixels of observations while in this
+    context. See `get_obs_cache`.
+
+    The data are dropped when the outermost scope exits, so that changes made
+    to the pixels after it, e.g. with `obs.writeable`, are never hidden by
+    stale data. Nested scopes share the data of the outermost one. This
+    function can also be used as a decorator.
+    """
+    if getattr(_OBS_CACHE, "data", None) is not None:
+        yield
+        return
+
+    _OBS_CACHE.data = weakref.WeakKeyDictionary()
+    try:
+        yield
+    finally:
+        _OBS_CACHE.data = None
+
+
+def get_obs_cache(obs):
+    """Get a dictionary for data computed from the pixels of an observation.
+
+    The dictionary is kept for each observation within an `obs_cache_scope`.
+    Outside of any scope, a new empty dictionary is returned each time. The
+    dictionary is emptied if the image, weight map or bit mask is replaced,
+    e.g. with `set_weight`. If the pixels are changed in place within a scope,
+    use `writeable` instead of `obs.writeable` so that the dictionary is emptied
+    as well.
+
+    Parameters
+    ----------
+    obs : ngmix.Observation
+        The observation.
+
+    Returns
+    -------
+    cache : dict
+        The dictionary for the observation.
+    """
+    obs_cache = getattr(_OBS_CACHE, "data", None)
+    if obs_cache is None:
+        return {}
+
+    arrays = [obs.image, obs.weight, obs.bmask if obs.has_bmask() else None]
+
+    entry = obs_cache.get(obs, None)
+    if entry is None or not all(
+        _is_same_buffer(key, arr) for key, arr in zip(entry["arrays"], arrays)
+    ):
+        entry = {
+            "arrays": [_get_buffer_key(arr) for arr in arrays],
+            "data": {},
+        }
+        obs_cache[obs] = entry
+
+    return entry["data"]
+
+
+def _get_root_array(arr):
+    while isinstance(arr.base, np.ndarray):
+        arr = arr.base
+    return arr
+
+
+def _get_buffer_key(arr):
+    # ngmix returns a new view of its arrays each time they are accessed, so we
+    # identify the pixels by the array that owns them and the memory the view
+    # covers rather than by the view itself
+    if arr is None:
+        return None
+
+    return (
+        weakref.ref(_get_root_array(arr)),
+        arr.__array_interface__["data"][0],
+        arr.shape,
+        arr.strides,
+    )
+
+
+def _is_same_buffer(key, arr):
+    if key is None or arr is None:
+        return key is None and arr is None
+
+    ref, data, shape, strides = key
+    return (
+        ref() is _get_root_array(arr)
+        and data == arr.__array_interface__["data"][0]
+        and shape == arr.shape
+        and strides == arr.strides
+    )
+
+
+def clear_obs_cache(obs):
+    """Empty the dictionary of an observation. See `get_obs_cache`.
+
+    Parameters
+    ----------
+    obs : ngmix.Observation
+        The observation.
+    """
+    obs_cache = getattr(_OBS_CACHE, "data", None)
+    if obs_cache is not None:
+        obs_cache.pop(obs, None)
+
+
+def get_obs_stats(obs):
+    """Get statistics of the weight map and bit mask of an observation.
+
+    The statistics are computed once per `obs_cache_scope` and kept with
+    `get_obs_cache`.
+
+    Parameters
+    ----------
+    obs : ngmix.Observation
+        The observation.
+
+    Returns
+    -------
+    stats : dict
+        A dictionary with entries
+
+            any_pos_weight : bool
+                True if any weight is positive.
+            all_pos_weight : bool
+                True if all of the weights are positive.
+            all_zero_weight : bool
+                True if all of the weights are zero.
+            median_weight : float
+                The median of the positive weights, or zero if there are none.
+            bmask_or : int
+                The bitwise OR of the bit mask, or zero if there is no bit mask.
+    """
+    cache = get_obs_cache(obs)
+    if "stats" not in cache:
+        weight = obs.weight
+        bmask = obs.bmask if obs.has_bmask() else None
+
+        msk = weight > 0
+        any_pos_weight = bool(np.any(msk))
+        cache["stats"] = {
+            "any_pos_weight": any_pos_weight,
+            "all_pos_weight": bool(np.all(msk)),
+            "all_zero_weight": bool(np.all(weight == 0)),
+            "median_weight": (
+                np.median(weight[msk]) if any_pos_weight else np.float64(0)
+            ),
+            "bmask_or": (
+                int(np.bitwise_or.reduce(bmask, axis=None))
+                if bmask is not None and bmask.size > 0
+                else 0
+            ),
+        }
+
+    return cache["stats"]
+
+
+def get_obs_flags(obs, *, bmask_flags):
+    """Get the flags for the weight map and bit mask of an observation.
+
+    The flags are computed with `get_obs_stats` unless they were set with
+    `set_obs_flags`.
+
+    Parameters
+    ----------
+    obs : ngmix.Observation
+        The observation.
+    bmask_flags : int
+        The bits in the bit mask that flag the observation.
+
+    Returns
+    -------
+    flags : int
+        `procflags.ZERO_WEIGHTS` if no weight is positive ORed with
+        `procflags.EDGE_HIT` if any of `bmask_flags` is set in the bit mask.
+    """
+    cache = get_obs_cache(obs)
+    key = ("flags", bmask_flags)
+    if key not in cache:
+        stats = get_obs_stats(obs)
+        flags = 0
+        if not stats["any_pos_weight"]:
+            flags |= procflags.ZERO_WEIGHTS
+        if (stats["bmask_or"] & bmask_flags) != 0:
+            flags |= procflags.EDGE_HIT
+        cache[key] = flags
+
+    return cache[key]
+
+
+def set_obs_flags(obs, *, bmask_flags, flags):
+    """Set the flags for the weight map and bit mask of an observation that were
+    computed without it, e.g. from the full image of a stamp. See `get_obs_flags`.
+
+    Parameters
+    ----------
+    obs : ngmix.Observation
+        The observation.
+    bmask_flags : int
+        The bits in the bit mask that flag the observation.
+    flags : int
+        The flags. They must be the same as those computed by `get_obs_flags`.
+    """
+    get_obs_cache(obs)[("flags", bmask_flags)] = int(flags)
+
+
+def count_in_boxes(img, row_starts, col_starts, box_sizes):
+    """Count the non-zero pixels of an image in square boxes with a summed-area
+    table.
+
+    Parameters
+    ----------
+    img : np.ndarray
+        The image.
+    row_starts : np.ndarray
+        The first row of each box.
+    col_starts : np.ndarray
+        The first column of each box.
+    box_sizes : np.ndarray
+        The size of each box.
+
+    Returns
+    -------
+    counts : np.ndarray
+        The number of non-zero pixels in each box. The parts of the boxes off of
+        the image are not counted.
+    """
+    dims = img.shape
+    sat = np.zeros((dims[0] + 1, dims[1] + 1), dtype=np.int64)
+    np.cumsum(img, axis=0, out=sat[1:, 1:])
+    np.cumsum(sat[1:, 1:], axis=1, out=sat[1:, 1:])
+
+    box_sizes = np.clip(box_sizes, 0, None)
+    r0 = np.clip(row_starts, 0, dims[0])
+    r1 = np.clip(row_starts + box_sizes, 0, dims[0])
+    c0 = np.clip(col_starts, 0, dims[1])
+    c1 = np.clip(col_starts + box_sizes, 0, dims[1])
+    return sat[r1, c1] - sat[r0, c1] - sat[r1, c0] + sat[r0, c0]
+
+
+@contextlib.contextmanager
+def writeable(obs):
+    """Make the data of an observation writeable with `obs.writeable` and
+    empty its cache on exit. See `get_obs_cache`.
+
+    Parameters
+    ----------
+    obs : ngmix.Observation
+        The observation.
+    """
+    try:
+        with obs.writeable():
+            yield obs
+    finally:
+        clear_obs_cache(obs)